@@ -0,0 +1,5 @@
+import sys
+
+from .run import main, parse_args
+
+sys.exit(main(parse_args()))
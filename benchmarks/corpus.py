@@ -0,0 +1,165 @@
+"""
+Generator of a synthetic, deterministic corpus for the benchmarks:
+
+    data/tgN/wk1/tgN.wk1.ed-lat1.xml  CTS editions (book/chapter/line textparts
+                                      with a refsDecl), with mixed-script
+                                      lines and an apparatus (the first edition
+                                      has most of the apps)
+    notes.json                        Markdown notes
+    greek.txt, beta.txt               polytonic Greek and the same text in beta code
+
+    python -m benchmarks.corpus OUT_DIR [--size medium]
+"""
+import argparse
+import json
+import os
+import random
+
+SIZES = {
+    "small": dict(editions=4, books=2, chapters=5, lines=20, apps=2000, notes=500, words=20_000),
+    "medium": dict(editions=20, books=4, chapters=20, lines=30, apps=50_000, notes=5000, words=200_000),
+    "large": dict(editions=100, books=12, chapters=30, lines=40, apps=200_000, notes=50_000, words=2_000_000),
+}
+
+# Greek words with their beta code
+GREEK = [
+    ("μῆνιν", "mh=nin"), ("ἄειδε", "a)/eide"), ("θεὰ", "qea\\"), ("Πηληϊάδεω", "*phlhi+a/dew"),
+    ("Ἀχιλῆος", "*)axilh=os"), ("οὐλομένην", "ou)lome/nhn"), ("ἣ", "h(\\"), ("μυρία", "muri/a"),
+    ("Ἀχαιοῖς", "*)axaioi=s"), ("ἄλγεα", "a)/lgea"), ("ἔθηκε", "e)/qhke"), ("πολλὰς", "polla\\s"),
+    ("δὲ", "de\\"), ("ἰφθίμους", "i)fqi/mous"), ("ψυχὰς", "yuxa\\s"), ("Ἄϊδι", "*)/ai+di"),
+    ("προΐαψεν", "proi/+ayen"), ("ἡρώων", "h(rw/wn"), ("αὐτοὺς", "au)tou\\s"), ("ἑλώρια", "e(lw/ria"),
+    ("τεῦχε", "teu=xe"), ("κύνεσσιν", "ku/nessin"), ("οἰωνοῖσί", "oi)wnoi=si/"), ("τε", "te"),
+    ("πᾶσι", "pa=si"),
+]
+LATIN = "arma virumque cano Troiae qui primus ab oris Italiam fato profugus Laviniaque venit litora".split()
+HEBREW = "שלום בראשית ברא אלהים את השמים".split()
+CYRILLIC = "слово въ началѣ бѣ и богъ".split()
+
+TEI_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<TEI xmlns="http://www.tei-c.org/ns/1.0">
+<teiHeader><fileDesc><titleStmt><title>{title}</title></titleStmt></fileDesc>
+<encodingDesc>
+<refsDecl n="CTS">
+<cRefPattern n="line" matchPattern="(\\w+)\\.(\\w+)\\.(\\w+)" replacementPattern="#xpath(/tei:TEI/tei:text/tei:body/tei:div/tei:div[@n='$1']/tei:div[@n='$2']/tei:l[@n='$3'])"/>
+<cRefPattern n="chapter" matchPattern="(\\w+)\\.(\\w+)" replacementPattern="#xpath(/tei:TEI/tei:text/tei:body/tei:div/tei:div[@n='$1']/tei:div[@n='$2'])"/>
+<cRefPattern n="book" matchPattern="(\\w+)" replacementPattern="#xpath(/tei:TEI/tei:text/tei:body/tei:div/tei:div[@n='$1'])"/>
+</refsDecl>
+</encodingDesc></teiHeader>
+"""
+
+
+def mixed_line(r):
+    words = [r.choice(LATIN) for _ in range(r.randint(5, 10))]
+    k = r.random()
+    if k < 0.2:
+        words.insert(r.randrange(len(words)), " ".join(r.choice(HEBREW) for _ in range(2)))
+    elif k < 0.35:
+        words.insert(r.randrange(len(words)), " ".join(r.choice(CYRILLIC) for _ in range(2)))
+    elif k < 0.5:
+        words.insert(r.randrange(len(words)), r.choice(GREEK)[0])
+    i = r.randrange(len(words))
+    words[i] = f"<hi>{words[i]}</hi>"
+    return " ".join(words)
+
+
+def edition(r, urn, books, chapters, lines, apps):
+    """An edition with (about) apps apps, divided over superior and inferior"""
+    refs = [
+        f"{b}.{c}.{l}"
+        for b in range(1, books + 1)
+        for c in range(1, chapters + 1)
+        for l in range(1, lines + 1)
+    ]
+    parts = [TEI_HEADER.format(title=urn)]
+    parts.append(f'<text><body><div type="edition" n="urn:cts:latinLit:{urn}" xml:lang="lat">\n')
+    for b in range(1, books + 1):
+        parts.append(f'<div type="textpart" subtype="book" n="{b}">\n')
+        for c in range(1, chapters + 1):
+            parts.append(f'<div type="textpart" subtype="chapter" n="{c}">\n')
+            for l in range(1, lines + 1):
+                parts.append(f'<l n="{l}">{mixed_line(r)}</l>\n')
+            parts.append("</div>\n")
+        parts.append("</div>\n")
+    parts.append('</div></body>\n<back><div type="apparatus">\n')
+    for app_type in ["superior", "inferior"]:
+        parts.append(f'<listApp type="{app_type}">\n')
+        for ref in sorted(r.choices(refs, k=apps // 2), key=lambda ref: [int(n) for n in ref.split(".")]):
+            word = r.choice(LATIN)
+            parts.append(
+                f'<app loc="urn:cts:latinLit:{urn}:{ref}"><lem wit="#A">{word}</lem>'
+                f'<rdg wit="#B">{word}que <hi rend="italic">sic</hi></rdg>'
+                f'<note xml:lang="en">see <ref target="#{ref}">{ref}</ref></note></app>\n'
+            )
+        parts.append("</listApp>\n")
+    parts.append("</div></back></text></TEI>\n")
+    return "".join(parts)
+
+
+def note(r, i):
+    parts = []
+    for _ in range(r.randint(1, 4)):
+        k = r.random()
+        words = " ".join(r.choice(LATIN) for _ in range(r.randint(3, 12)))
+        if k < 0.3:
+            parts.append(f"A note on _{words}_ with __{r.choice(GREEK)[0]}__ and `code`.")
+        elif k < 0.45:
+            parts.append("\n".join(f"{j}. {words}" for j in range(1, 4)))
+        elif k < 0.55:
+            parts.append(f"> {words}")
+        elif k < 0.65:
+            parts.append(f"See [{words}](http://example.org/{i}) and ![figure](fig{i}.png)")
+        elif k < 0.7:
+            parts.append(f"{words}<sup>{i}</sup>")
+        else:
+            parts.append(words)
+    return "\n\n".join(parts)
+
+
+def generate(out_dir, size="medium", seed=0):
+    """Generate the corpus of a size in SIZES in out_dir, returns the paths of its parts"""
+    params = SIZES[size]
+    r = random.Random(seed)
+    data_dir = os.path.join(out_dir, "data")
+    editions = []
+    for n in range(params["editions"]):
+        urn = f"tg{n}.wk1.ed-lat1"
+        work_dir = os.path.join(data_dir, f"tg{n}", "wk1")
+        os.makedirs(work_dir, exist_ok=True)
+        fname = os.path.join(work_dir, f"{urn}.xml")
+        # the first edition holds the bulk of the apparatus
+        apps = params["apps"] if n == 0 else 20
+        with open(fname, "w", encoding="utf-8") as f:
+            f.write(edition(r, urn, params["books"], params["chapters"], params["lines"], apps))
+        editions.append(fname)
+
+    notes_fname = os.path.join(out_dir, "notes.json")
+    with open(notes_fname, "w", encoding="utf-8") as f:
+        json.dump([note(r, i) for i in range(params["notes"])], f, ensure_ascii=False)
+
+    words = [r.choice(GREEK) for _ in range(params["words"])]
+    greek_fname, beta_fname = os.path.join(out_dir, "greek.txt"), os.path.join(out_dir, "beta.txt")
+    for fname, i in [(greek_fname, 0), (beta_fname, 1)]:
+        with open(fname, "w", encoding="utf-8") as f:
+            for start in range(0, len(words), 12):
+                f.write(" ".join(word[i] for word in words[start:start + 12]) + "\n")
+
+    return {
+        "data_dir": data_dir,
+        "editions": editions,
+        "notes": notes_fname,
+        "greek": greek_fname,
+        "beta": beta_fname,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic corpus for the benchmarks")
+    parser.add_argument("out_dir")
+    parser.add_argument("--size", choices=SIZES, default="medium")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(json.dumps(generate(args.out_dir, args.size, args.seed), indent=2))
+
+
+if __name__ == "__main__":
+    main()
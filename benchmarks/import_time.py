@@ -0,0 +1,53 @@
+"""
+Measure the import time of dh_utils.unicode and dh_utils.tei, and of the first
+access of the names that are loaded lazily, each in a fresh process. The
+import benchmark of the suite (python -m benchmarks --only import) only times
+importing both packages.
+
+    python -m benchmarks.import_time [--repeat 10]
+"""
+import argparse
+import subprocess
+import sys
+
+STATEMENTS = [
+    "import dh_utils.unicode",
+    "import dh_utils.tei",
+    "from dh_utils.tei import tag_script",
+    "from dh_utils.tei import md2tei",
+    "from dh_utils.unicode import beta2uni; beta2uni('a)/ndra')",
+]
+
+MEASURE = """
+import time
+start = time.perf_counter()
+{statement}
+print(time.perf_counter() - start)
+"""
+
+
+def measure(statement, repeat):
+    """Best time in seconds of statement, in repeat fresh processes"""
+    times = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", MEASURE.format(statement=statement)],
+            capture_output=True,
+            check=True,
+            text=True,
+        )
+        times.append(float(output.stdout))
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    for statement in STATEMENTS:
+        print(f"{measure(statement, args.repeat) * 1e3:7.1f} ms  {statement}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Compare the per-document latency of the tree engine (TEITreeprocessor) and the
+postprocessor engine (TEIPostprocessor) of dh_utils.tei.markdown on synthetic
+notes, checking that both give identical output.
+
+    python -m benchmarks.md2tei_engines [--documents 5000] [--extensions tables attr_list]
+"""
+import argparse
+import random
+import statistics
+import time
+
+from markdown import Markdown
+
+from dh_utils.tei.markdown import ToTEI
+
+WORDS = "lorem ipsum dolor sit amet Ἀχιλλεύς μῆνιν ἄειδε consectetur adipiscing".split()
+
+
+def synthetic_note(r, i):
+    parts = []
+    for _ in range(r.randint(1, 4)):
+        k = r.random()
+        words = " ".join(r.choice(WORDS) for _ in range(r.randint(3, 12)))
+        if k < 0.3:
+            parts.append(f"A note with _{words}_, __bold__ & `code`.")
+        elif k < 0.45:
+            parts.append("\n".join(f"{j}. {words}" for j in range(1, 4)))
+        elif k < 0.55:
+            parts.append(f"> {words}")
+        elif k < 0.62:
+            parts.append(f"## {words}")
+        elif k < 0.7:
+            parts.append(f"See [{words}](http://example.org/{i}) and ![figure](fig{i}.png)")
+        elif k < 0.75:
+            parts.append("| a | *b* |\n|---|---|\n| 1 | 2 |")
+        elif k < 0.8:
+            parts.append(f"{words}  \n{words}")
+        else:
+            parts.append(words)
+    return "\n\n".join(parts)
+
+
+def convert(md, text):
+    try:
+        return md.reset().convert(text)
+    except Exception as e:
+        return e
+
+
+def measure(md, texts):
+    results, latencies = [], []
+    for text in texts:
+        start = time.perf_counter()
+        results.append(convert(md, text))
+        latencies.append(time.perf_counter() - start)
+    return results, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--documents", type=int, default=5000)
+    parser.add_argument("--extensions", nargs="*", default=["tables"])
+    args = parser.parse_args()
+
+    r = random.Random(0)
+    texts = [synthetic_note(r, i) for i in range(args.documents)]
+    results = {}
+    for engine in ["postprocessor", "tree"]:
+        md = Markdown(extensions=args.extensions + [ToTEI(engine=engine)])
+        results[engine], latencies = measure(md, texts)
+        print(
+            f"{engine:<14} mean {statistics.mean(latencies) * 1e6:7.1f} us  "
+            f"median {statistics.median(latencies) * 1e6:7.1f} us  "
+            f"total {sum(latencies):6.2f}s"
+        )
+    differ = sum(
+        str(a) != str(b) or type(a) != type(b)
+        for a, b in zip(results["postprocessor"], results["tree"])
+    )
+    assert not differ, f"{differ} documents differ"
+
+
+if __name__ == "__main__":
+    main()
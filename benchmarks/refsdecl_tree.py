@@ -0,0 +1,66 @@
+"""
+Compare time and peak memory of the anytree reference tree and the compact
+structure-only mode of dh_utils.tei.refsdecl_generator on a synthetic work.
+
+    python -m benchmarks.refsdecl_tree [--books 24] [--chapters 50] [--lines 60]
+"""
+import argparse
+import time
+import tracemalloc
+
+from lxml import etree
+
+from dh_utils.tei import refsdecl_generator as rg
+
+TEI = "{http://www.tei-c.org/ns/1.0}"
+
+
+def synthetic_work(books, chapters, lines):
+    root = etree.Element(f"{TEI}TEI")
+    body = etree.SubElement(etree.SubElement(root, f"{TEI}text"), f"{TEI}body")
+    edition = etree.SubElement(body, f"{TEI}div", {"type": "edition", "n": "urn:cts:x"})
+    for b in range(1, books + 1):
+        book = etree.SubElement(edition, f"{TEI}div", {"type": "textpart", "subtype": "book", "n": str(b)})
+        for c in range(1, chapters + 1):
+            chapter = etree.SubElement(book, f"{TEI}div", {"type": "textpart", "subtype": "chapter", "n": str(c)})
+            for l in range(1, lines + 1):
+                etree.SubElement(chapter, f"{TEI}l", {"n": str(l)}).text = "lorem ipsum"
+    return root
+
+
+def anytree_mode(root):
+    return rg.build_refs_decl(rg.build_ref_tree(root), "p")
+
+
+def compact_mode(root):
+    return rg.refs_decl_from_paths(rg.structure_paths(root), "p")
+
+
+def measure(func, root):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(root)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return etree.tostring(result), seconds, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--books", type=int, default=24)
+    parser.add_argument("--chapters", type=int, default=50)
+    parser.add_argument("--lines", type=int, default=60)
+    args = parser.parse_args()
+
+    root = synthetic_work(args.books, args.chapters, args.lines)
+    print(f"{args.books * args.chapters * args.lines} lines")
+    results = {}
+    for name, func in [("anytree", anytree_mode), ("compact", compact_mode)]:
+        results[name] = refs_decl, seconds, peak = measure(func, root)
+        print(f"{name:<8} {seconds:8.3f}s  peak {peak / 2 ** 20:8.1f} MiB")
+    assert results["anytree"][0] == results["compact"][0], "refsDecls differ"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+"""
+Benchmarks of the dh_utils entry points on a synthetic corpus (see
+benchmarks.corpus). Every benchmark runs in a fresh process, and records the
+(best) wall time, the throughput and the peak memory (RSS) of that process.
+Results can be saved as a JSON baseline, and compared with a previous run.
+
+    python -m benchmarks [--size medium] [--output results.json] [--baseline previous.json]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+from . import corpus as corpus_
+
+try:
+    import resource
+except ImportError:  # e.g. on Windows
+    resource = None
+
+BENCHMARKS = {}
+
+
+def benchmark(name, unit):
+    """
+    Register a benchmark, a function that takes the corpus and returns
+    (prepare, run, units): prepare (or None) is called before every repetition
+    without being timed, run is timed (or returns its own time in seconds) and
+    units is the amount of work in unit, for the throughput. It returns None
+    if it cannot run (e.g. an optional dependency is not installed).
+    """
+
+    def decorator(func):
+        BENCHMARKS[name] = (func, unit)
+        return func
+
+    return decorator
+
+
+def _scratch(corpus, name):
+    path = os.path.join(corpus["scratch"], name)
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    return path
+
+
+def _copy_edition(corpus, name):
+    """Copy the first edition to a scratch directory, returns its new path"""
+    return shutil.copy(corpus["editions"][0], _scratch(corpus, name))
+
+
+def _copy_data(corpus, data_dir):
+    """Replace data_dir by a fresh copy of the data directory"""
+    shutil.rmtree(data_dir, ignore_errors=True)
+    shutil.copytree(corpus["data_dir"], data_dir)
+
+
+@benchmark("import", "imports")
+def bench_import(corpus):
+    code = (
+        "import time; start = time.perf_counter(); "
+        "import dh_utils.unicode, dh_utils.tei; print(time.perf_counter() - start)"
+    )
+
+    def run():
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, check=True, text=True)
+        return float(output.stdout)
+
+    return None, run, 1
+
+
+@benchmark("uni2beta", "characters")
+def bench_uni2beta(corpus):
+    from dh_utils.unicode import uni2beta
+
+    with open(corpus["greek"], encoding="utf-8") as f:
+        text = f.read()
+    return None, lambda: uni2beta(text), len(text)
+
+
+@benchmark("beta2uni", "characters")
+def bench_beta2uni(corpus):
+    from dh_utils.unicode import beta2uni
+
+    with open(corpus["beta"], encoding="utf-8") as f:
+        text = f.read()
+    beta2uni(text[:100])  # load the tables
+    return None, lambda: beta2uni(text), len(text)
+
+
+@benchmark("beta2uni_cltk", "characters")
+def bench_beta2uni_cltk(corpus):
+    from dh_utils.unicode import CLTK_NOT_FOUND, beta2uni_cltk
+
+    if CLTK_NOT_FOUND:
+        return None
+    with open(corpus["beta"], encoding="utf-8") as f:
+        text = f.read()
+    beta2uni_cltk(text[:100])  # import cltk
+    return None, lambda: beta2uni_cltk(text), len(text)
+
+
+@benchmark("tag_script_from_file", "MB")
+def bench_tag_script_from_file(corpus):
+    from dh_utils.tei import tag_script_from_file
+
+    # tag_script_from_file overwrites the file, so tag a fresh copy every time
+    fname = os.path.join(corpus["scratch"], "tag_script", os.path.basename(corpus["editions"][0]))
+    prepare = lambda: _copy_edition(corpus, "tag_script")
+    run = lambda: tag_script_from_file(fname, ["Hebr", "Cyrl"])
+    return prepare, run, os.path.getsize(corpus["editions"][0]) / 2 ** 20
+
+
+@benchmark("tag_script_stream", "MB")
+def bench_tag_script_stream(corpus):
+    from dh_utils.tei import tag_script_stream
+
+    output = os.path.join(_scratch(corpus, "tag_script_stream"), "tagged.xml")
+    run = lambda: tag_script_stream(corpus["editions"][0], ["Hebr", "Cyrl"], output=output)
+    return None, run, os.path.getsize(corpus["editions"][0]) / 2 ** 20
+
+
+@benchmark("md2tei", "documents")
+def bench_md2tei(corpus):
+    from dh_utils.tei import md2tei
+
+    with open(corpus["notes"], encoding="utf-8") as f:
+        notes = json.load(f)
+    return None, lambda: [md2tei(note) for note in notes], len(notes)
+
+
+@benchmark("md2tei_many", "documents")
+def bench_md2tei_many(corpus):
+    from dh_utils.tei import md2tei_many
+
+    with open(corpus["notes"], encoding="utf-8") as f:
+        notes = json.load(f)
+    return None, lambda: list(md2tei_many(notes)), len(notes)
+
+
+@benchmark("ResultCache.md2tei", "documents")
+def bench_result_cache(corpus):
+    from dh_utils.cache import ResultCache
+
+    with open(corpus["notes"], encoding="utf-8") as f:
+        notes = json.load(f)
+    # an export in which every note occurs four times, with a cold cache every run
+    export = notes * 4
+    random.Random(0).shuffle(export)
+
+    def run():
+        cache = ResultCache()
+        return [cache.md2tei(note) for note in export]
+
+    return None, run, len(export)
+
+
+@benchmark("crit_app.create", "apps")
+def bench_crit_app_create(corpus):
+    from dh_utils.tei import crit_app
+
+    # create writes its output next to the edition
+    data_dir = os.path.join(corpus["scratch"], "crit_app")
+    prepare = lambda: _copy_edition(corpus, "crit_app")
+    run = lambda: crit_app.create(
+        os.path.basename(corpus["editions"][0]), {"superior": "appcrit1", "inferior": "appcrit2"}, data_dir
+    )
+    with open(corpus["editions"][0], encoding="utf-8") as f:
+        apps = len(re.findall(r"<app\b", f.read()))
+    return prepare, run, apps
+
+
+@benchmark("refsdecl_generator.generate_for_path", "files")
+def bench_generate_for_path(corpus):
+    from dh_utils.tei import refsdecl_generator
+
+    run = lambda: list(refsdecl_generator.generate_for_path(corpus["data_dir"], update=False))
+    return None, run, len(corpus["editions"])
+
+
+@benchmark("refsdecl_generator.process_path --update", "files")
+def bench_refsdecl_update(corpus):
+    from dh_utils.tei import refsdecl_generator
+
+    data_dir = os.path.join(corpus["scratch"], "refsdecl_update")
+    prepare = lambda: _copy_data(corpus, data_dir)
+    run = lambda: list(refsdecl_generator.process_path(data_dir, update=True))
+    return prepare, run, len(corpus["editions"])
+
+
+@benchmark("pipeline.run", "files")
+def bench_pipeline(corpus):
+    from dh_utils.tei import pipeline
+
+    data_dir = os.path.join(corpus["scratch"], "pipeline")
+    prepare = lambda: _copy_data(corpus, data_dir)
+    stages = [
+        pipeline.RefsDecl(),
+        pipeline.TagScript(["Hebr", "Cyrl"]),
+        pipeline.CritApp({"superior": "appcrit1", "inferior": "appcrit2"}),
+    ]
+    return prepare, lambda: pipeline.run(data_dir, stages), len(corpus["editions"])
+
+
+@benchmark("cts_index.update", "files")
+def bench_cts_index(corpus):
+    from dh_utils.tei.cts_index import CTSIndex
+
+    index_fname = os.path.join(_scratch(corpus, "cts_index"), "index.sqlite")
+
+    def prepare():
+        if os.path.exists(index_fname):
+            os.remove(index_fname)
+
+    def run():
+        with CTSIndex(index_fname) as index:
+            index.update(corpus["data_dir"])
+
+    return prepare, run, len(corpus["editions"])
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return rss / 2 ** 20 if sys.platform == "darwin" else rss / 2 ** 10
+
+
+def measure(name, corpus, repeat):
+    """Run a benchmark repeat times (in the current process), None if it cannot run"""
+    func, unit = BENCHMARKS[name]
+    benchmark_ = func(corpus)
+    if benchmark_ is None:
+        return None
+    prepare, run, units = benchmark_
+    times = []
+    for _ in range(repeat):
+        if prepare is not None:
+            prepare()
+        start = time.perf_counter()
+        seconds = run()
+        times.append(seconds if isinstance(seconds, float) else time.perf_counter() - start)
+    seconds = min(times)
+    return {
+        "seconds": seconds,
+        "throughput": units / seconds,
+        "unit": unit,
+        "units": units,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_benchmarks(corpus, names=None, repeat=3):
+    """Run the benchmarks (all by default), each in a fresh process"""
+    results = {}
+    for name in names or BENCHMARKS:
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(1, mp_context=context) as executor:
+            result = executor.submit(measure, name, corpus, repeat).result()
+        if result is None:
+            print(f"Skipped {name}", file=sys.stderr)
+        else:
+            results[name] = result
+    return results
+
+
+def compare(results, baseline, threshold=0.2):
+    """
+    Regressions of results with respect to the results of a baseline: a list of
+    (name, metric, old, new) for the wall time or peak memory that increased
+    by more than threshold (a fraction)
+    """
+    regressions = []
+    for name, result in results.items():
+        old = baseline["results"].get(name)
+        if old is None:
+            continue
+        for metric in ["seconds", "peak_rss_mb"]:
+            if old.get(metric) and result.get(metric) and result[metric] > old[metric] * (1 + threshold):
+                regressions.append((name, metric, old[metric], result[metric]))
+    return regressions
+
+
+def print_results(results, baseline=None):
+    print(f"{'benchmark':<38} {'seconds':>9} {'throughput':>28} {'peak MB':>8}  change")
+    for name, result in results.items():
+        old = (baseline or {}).get("results", {}).get(name)
+        change = f"{result['seconds'] / old['seconds'] - 1:+.1%}" if old else ""
+        peak = f"{result['peak_rss_mb']:8.1f}" if result["peak_rss_mb"] is not None else f"{'':>8}"
+        throughput = f"{result['throughput']:,.1f} {result['unit']}/s"
+        print(f"{name:<38} {result['seconds']:9.4f} {throughput:>28} {peak}  {change}")
+
+
+def load_corpus(corpus_dir, size, seed=0):
+    """Generate the corpus in corpus_dir, unless it was already generated with the same settings"""
+    manifest_fname = os.path.join(corpus_dir, "corpus.json")
+    settings = {"size": size, "seed": seed}
+    if os.path.exists(manifest_fname):
+        with open(manifest_fname) as f:
+            manifest = json.load(f)
+        if manifest["settings"] == settings:
+            return manifest["corpus"]
+        shutil.rmtree(corpus_dir)
+    os.makedirs(corpus_dir, exist_ok=True)
+    corpus = corpus_.generate(corpus_dir, size, seed)
+    corpus["scratch"] = os.path.join(corpus_dir, "scratch")
+    with open(manifest_fname, "w") as f:
+        json.dump({"settings": settings, "corpus": corpus}, f, indent=2)
+    return corpus
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the dh_utils entry points")
+    parser.add_argument("--size", choices=corpus_.SIZES, default="medium", help="Size of the corpus")
+    parser.add_argument("--corpus", help="Directory to generate (and reuse) the corpus in")
+    parser.add_argument("--repeat", type=int, default=3, help="Repetitions per benchmark (best is used)")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, help="Only run these benchmarks")
+    parser.add_argument("--output", help="Save the results as JSON (e.g. as a new baseline)")
+    parser.add_argument("--baseline", help="Results of a previous run to compare with")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Flag increases of wall time or peak memory by more than this fraction",
+    )
+    return parser.parse_args()
+
+
+def main(args):
+    from dh_utils import __version__
+
+    tmp_dir = None
+    if args.corpus is None:
+        tmp_dir = args.corpus = tempfile.mkdtemp(prefix="dh_utils_benchmarks_")
+    try:
+        corpus = load_corpus(args.corpus, args.size)
+        results = run_benchmarks(corpus, args.only, args.repeat)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["meta"]["size"] != args.size:
+            print(f"Warning: the baseline was run with size {baseline['meta']['size']}", file=sys.stderr)
+    print_results(results, baseline)
+
+    if args.output:
+        meta = {
+            "dh_utils": __version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "size": args.size,
+            "repeat": args.repeat,
+            "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        }
+        with open(args.output, "w") as f:
+            json.dump({"meta": meta, "results": results}, f, indent=2)
+
+    regressions = compare(results, baseline, args.threshold) if baseline else []
+    for name, metric, old, new in regressions:
+        print(f"REGRESSION {name}: {metric} {old:.4f} -> {new:.4f} ({new / old - 1:+.1%})")
+    return int(bool(regressions))
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args()))
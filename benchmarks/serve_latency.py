@@ -0,0 +1,83 @@
+"""
+Compare the latency of conversions through a warm dh_utils.serve worker (one
+process, requests over a pipe) with spawning a Python process per call.
+
+    python -m benchmarks.serve_latency [--calls 20]
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+REQUESTS = {
+    "uni2beta": {"text_uni": "μῆνιν ἄειδε θεὰ Πηληϊάδεω Ἀχιλῆος"},
+    "beta2uni": {"text_beta": "mh=nin a)/eide qea\\ *phlhi+a/dew *)axilh=os"},
+    "md2tei": {"text": "Some *emphasis* and **bold** text with a [link](http://example.org)"},
+    "tag_script": {"string": "A Latin text with שלום and слово in it", "script": ["Hebr", "Cyrl"]},
+}
+
+# what a script calling the function once does
+SPAWN = """
+import json, sys
+from dh_utils.serve import call
+print(json.dumps(call(sys.argv[1], json.loads(sys.argv[2]))))
+"""
+
+
+def summary(name, method, latencies):
+    latencies = sorted(seconds * 1000 for seconds in latencies)
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    print(
+        f"{name:<6} {method:<11} mean {statistics.mean(latencies):8.2f}ms  "
+        f"median {statistics.median(latencies):8.2f}ms  p95 {p95:8.2f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--calls", type=int, default=20, help="Calls per method")
+    args = parser.parse_args()
+
+    for method, params in REQUESTS.items():
+        latencies = []
+        for _ in range(args.calls):
+            start = time.perf_counter()
+            subprocess.run(
+                [sys.executable, "-c", SPAWN, method, json.dumps(params)],
+                capture_output=True,
+                check=True,
+            )
+            latencies.append(time.perf_counter() - start)
+        summary("spawn", method, latencies)
+
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "dh_utils.serve"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    server.stdin.write(json.dumps({"id": 0, "method": "ping"}) + "\n")
+    server.stdin.flush()
+    server.stdout.readline()
+    print(f"server started in {(time.perf_counter() - start) * 1000:.0f}ms")
+    try:
+        for method, params in REQUESTS.items():
+            latencies = []
+            for i in range(args.calls):
+                start = time.perf_counter()
+                server.stdin.write(json.dumps({"id": i, "method": method, "params": params}) + "\n")
+                server.stdin.flush()
+                response = json.loads(server.stdout.readline())
+                latencies.append(time.perf_counter() - start)
+                assert response["id"] == i and "result" in response, response
+            summary("warm", method, latencies)
+    finally:
+        server.stdin.close()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
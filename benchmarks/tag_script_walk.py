@@ -0,0 +1,83 @@
+"""
+Compare tag_script_from_file, which tags the body in a single tree walk, with
+the implementation it replaced, which evaluated an XPath and reparsed the
+tagged string for every text node, on a synthetic edition. The outputs must
+be byte-identical.
+
+    python -m benchmarks.tag_script_walk [--chapters 50] [--script Hebr]
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+from xml.sax.saxutils import escape
+
+from lxml import etree
+
+from dh_utils.tei import tag_script, tag_script_from_file
+from dh_utils.tei.tag_script import DEFAULT_LCS
+
+from .corpus import edition
+
+XML_NS = "{http://www.w3.org/XML/1998/namespace}"
+
+
+def reparse_mode(fname, script, language_code=""):
+    """tag_script_from_file before the tree walk"""
+    if not language_code:
+        language_code = DEFAULT_LCS[script]
+    tree = etree.parse(fname)
+    root = tree.getroot()
+    NS = f"{{{root.nsmap[None]}}}" if None in root.nsmap.keys() else ""
+    for string in etree.ETXPath(f"//{NS}body//text()")(root):
+        parent = string.getparent()
+        new_content = escape(str(string))
+        if string.is_text:
+            lang_parent = parent.xpath("ancestor-or-self::*[@xml:lang][1]")
+        elif string.is_tail:
+            lang_parent = parent.xpath("ancestor::*[@xml:lang][1]")
+        if (not lang_parent) or (lang_parent[0].attrib[f"{XML_NS}lang"] != language_code):
+            new_content = tag_script(new_content, script, language_code, escape_xml=False)
+        new_xml_root = etree.fromstring(f"<root>{new_content}</root>")
+        if string.is_text:
+            parent.text = new_xml_root.text
+            for i, el in enumerate(new_xml_root.getchildren()):
+                parent.insert(i, el)
+        elif string.is_tail:
+            parent.tail = new_xml_root.text
+            grandparent = parent.getparent()
+            i_parent = grandparent.index(parent)
+            for i, el in enumerate(new_xml_root.getchildren()):
+                grandparent.insert(i_parent + 1 + i, el)
+    with open(fname, "w", encoding="utf-8") as f:
+        f.write(etree.tostring(tree, encoding="unicode"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--books", type=int, default=4)
+    parser.add_argument("--chapters", type=int, default=50)
+    parser.add_argument("--lines", type=int, default=50)
+    parser.add_argument("--script", default="Hebr")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source = os.path.join(tmp_dir, "source.xml")
+        with open(source, "w", encoding="utf-8") as f:
+            f.write(edition(random.Random(0), "tg.wk.ed-lat1", args.books, args.chapters, args.lines, 2000))
+        print(f"{os.path.getsize(source) / 2 ** 20:.1f} MiB")
+
+        outputs = {}
+        for name, func in [("reparse", reparse_mode), ("walk", tag_script_from_file)]:
+            outputs[name] = shutil.copy(source, os.path.join(tmp_dir, f"{name}.xml"))
+            start = time.perf_counter()
+            func(outputs[name], args.script)
+            print(f"{name:<8} {time.perf_counter() - start:8.3f}s")
+        with open(outputs["reparse"], "rb") as a, open(outputs["walk"], "rb") as b:
+            assert a.read() == b.read(), "outputs differ"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Compare the peak memory (RSS) of reading and writing a large TEI file through
+dh_utils.tei.xml_io with reading the file into bytes and building the output
+as a string first, each in a fresh process.
+
+    python -m benchmarks.xml_io_memory [--chapters 200]
+"""
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+
+from .corpus import edition
+
+VARIANTS = {
+    "bytes": """
+from lxml import etree
+with open(fname, "rb") as f:
+    root = etree.fromstring(f.read(), etree.XMLParser(huge_tree=True))
+with open(output, "w", encoding="utf-8") as f:
+    f.write(etree.tostring(root.getroottree(), encoding="unicode"))
+""",
+    "xml_io": """
+from dh_utils.tei import xml_io
+tree = xml_io.parse(fname)
+xml_io.write_tree(tree, output, xml_declaration=False)
+""",
+}
+
+MEASURE = """
+import resource, sys, time
+fname, output = sys.argv[1:]
+baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+{code}
+print(time.perf_counter() - start, baseline, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--books", type=int, default=10)
+    parser.add_argument("--chapters", type=int, default=200)
+    parser.add_argument("--lines", type=int, default=30)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fname = os.path.join(tmp_dir, "tg.wk.ed-lat1.xml")
+        with open(fname, "w", encoding="utf-8") as f:
+            f.write(edition(random.Random(0), "tg.wk.ed-lat1", args.books, args.chapters, args.lines, 0))
+        print(f"{os.path.getsize(fname) / 2 ** 20:.1f} MiB")
+
+        outputs = {}
+        for name, code in VARIANTS.items():
+            outputs[name] = os.path.join(tmp_dir, f"{name}.xml")
+            result = subprocess.run(
+                [sys.executable, "-c", MEASURE.format(code=code), fname, outputs[name]],
+                capture_output=True,
+                check=True,
+                text=True,
+            )
+            seconds, baseline, peak = result.stdout.split()
+            # ru_maxrss is in kilobytes on Linux
+            print(
+                f"{name:<8} {float(seconds):6.2f}s  peak {int(peak) / 2 ** 10:7.1f} MiB  "
+                f"(+{(int(peak) - int(baseline)) / 2 ** 10:.1f} MiB)"
+            )
+        with open(outputs["bytes"], "rb") as a, open(outputs["xml_io"], "rb") as b:
+            assert a.read() == b.read(), "outputs differ"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+"""
+An opt-in cache of the results of md2tei, tag_script, uni2beta and beta2uni,
+for exports in which the same snippets (notes, phrases, lemmata) are converted
+again and again. Results are kept in a bounded in-memory LRU and optionally in
+an SQLite database on disk, with the least recently used entries evicted when
+it exceeds a size. Entries are keyed on a hash of the function, its arguments
+and the versions it depends on (the package, markdown and the mapping tables),
+so a new version or changed tables never return stale results.
+
+    >>> from dh_utils.cache import ResultCache
+    >>> with ResultCache(path='export_cache.sqlite') as cache:
+    ...     tei = [cache.md2tei(note) for note in notes]
+    ...     print(cache.stats)
+"""
+import hashlib
+import inspect
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from . import __version__
+
+
+def _md2tei(text):
+    from .tei import md2tei_many
+    # reuses the Markdown instance of the thread, unlike md2tei
+    return next(md2tei_many([text], return_exceptions=False))
+
+def _tag_script(string, script=None, language_code='', escape_xml=True):
+    from .tei import tag_script
+    return tag_script(string, script, language_code, escape_xml)
+
+def _uni2beta(text_uni, normalize=True):
+    from .unicode import uni2beta
+    return uni2beta(text_uni, normalize)
+
+def _beta2uni(text_beta):
+    from .unicode import beta2uni
+    return beta2uni(text_beta)
+
+def _package_version():
+    return [__version__]
+
+def _markdown_version():
+    import markdown
+    return [__version__, markdown.__version__]
+
+def _tables_version():
+    from .unicode import tables_key
+    return list(tables_key())
+
+# Cacheable functions and the versions their results depend on
+FUNCTIONS = {
+    'md2tei': (_md2tei, _markdown_version),
+    'tag_script': (_tag_script, _package_version),
+    'uni2beta': (_uni2beta, _tables_version),
+    'beta2uni': (_beta2uni, _tables_version),
+}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+'''
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    # hits in the database, not in memory
+    disk_hits: int = 0
+    misses: int = 0
+    # calls with arguments that cannot be hashed (not JSON serializable)
+    uncached: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_rate(self):
+        calls = self.hits + self.disk_hits + self.misses
+        return (self.hits + self.disk_hits) / calls if calls else 0.0
+
+class _DiskStore:
+    """ Entries in an SQLite database, of at most max_bytes (of values) """
+
+    def __init__(self, fname, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(fname), timeout=30, check_same_thread=False)
+        # readers do not block the writer (e.g. of another process)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.connection.executescript(SCHEMA)
+        with self.connection:
+            # drop all entries of another package version or other tables, they
+            # can never be hit again
+            version = json.dumps(_tables_version())
+            row = self.connection.execute("SELECT value FROM meta WHERE name = 'version'").fetchone()
+            if row is None or row[0] != version:
+                self.connection.execute('DELETE FROM entries')
+                self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version,))
+        self.size = self._total_size()
+
+    def _total_size(self):
+        return self.connection.execute('SELECT coalesce(sum(size), 0) FROM entries').fetchone()[0]
+
+    def get(self, key):
+        with self.lock, self.connection:
+            row = self.connection.execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute('UPDATE entries SET accessed = ? WHERE key = ?', (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        """ Store value, returns the number of entries evicted """
+        value = json.dumps(value)
+        size = len(value)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)', (key, value, size, time.time())
+            )
+            self.size += size
+            if self.size <= self.max_bytes:
+                return 0
+            # other processes may have added or evicted entries as well
+            self.size = self._total_size()
+            return self._evict()
+
+    def _evict(self):
+        """ Remove the least recently used entries until 90% of max_bytes is left """
+        evicted = []
+        for key, size in self.connection.execute('SELECT key, size FROM entries ORDER BY accessed'):
+            if self.size <= 0.9 * self.max_bytes:
+                break
+            evicted.append((key,))
+            self.size -= size
+        self.connection.executemany('DELETE FROM entries WHERE key = ?', evicted)
+        return len(evicted)
+
+    def clear(self):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM entries')
+            self.size = 0
+
+    def close(self):
+        self.connection.close()
+
+class ResultCache:
+    """
+    Cache of the results of the functions in FUNCTIONS: at most maxsize results
+    in memory and, given a path, at most max_bytes (of serialized results) in an
+    SQLite database, which can be shared by processes and runs. Exceptions are
+    not cached.
+    """
+
+    def __init__(self, maxsize=4096, path=None, max_bytes=256 * 2 ** 20):
+        self.maxsize = maxsize
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = CacheStats()
+        self.disk = None
+        if path is not None:
+            path = os.path.expanduser(path)
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.disk = _DiskStore(path, max_bytes)
+        self._versions = {}
+        self._signatures = {name: inspect.signature(func) for name, (func, _) in FUNCTIONS.items()}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
+
+    def key(self, name, args, kwargs):
+        """ Hash of function name, its arguments (with defaults) and versions """
+        version = self._versions.get(name)
+        if version is None:
+            version = self._versions[name] = FUNCTIONS[name][1]()
+        bound = self._signatures[name].bind(*args, **kwargs)
+        bound.apply_defaults()
+        data = json.dumps([name, version, list(bound.arguments.values())], sort_keys=True)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def call(self, name, *args, **kwargs):
+        """ Call function name of FUNCTIONS with args and kwargs, or return the cached result """
+        func = FUNCTIONS[name][0]
+        try:
+            key = self.key(name, args, kwargs)
+        except TypeError:
+            # e.g. a set of scripts, or missing arguments (which func reports)
+            with self.lock:
+                self.stats.uncached += 1
+            return func(*args, **kwargs)
+
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.stats.hits += 1
+                return self.memory[key]
+        if self.disk is not None:
+            result = self.disk.get(key)
+            if result is not None:
+                self._remember(key, result)
+                with self.lock:
+                    self.stats.disk_hits += 1
+                return result
+
+        result = func(*args, **kwargs)
+        self._remember(key, result)
+        evicted = self.disk.put(key, result) if self.disk is not None else 0
+        with self.lock:
+            self.stats.misses += 1
+            self.stats.evictions += evicted
+        return result
+
+    def _remember(self, key, result):
+        with self.lock:
+            self.memory[key] = result
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.maxsize:
+                self.memory.popitem(last=False)
+                self.stats.evictions += 1
+
+    def clear(self):
+        """ Remove all entries, from memory and disk """
+        with self.lock:
+            self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def md2tei(self, text):
+        return self.call('md2tei', text)
+
+    def tag_script(self, string, script=None, language_code='', escape_xml=True):
+        return self.call('tag_script', string, script, language_code, escape_xml)
+
+    def uni2beta(self, text_uni, normalize=True):
+        return self.call('uni2beta', text_uni, normalize)
+
+    def beta2uni(self, text_beta):
+        return self.call('beta2uni', text_beta)
@@ -0,0 +1,247 @@
+"""
+A long-running worker for conversions, so that the imports, tables, compiled
+regular expressions and Markdown instances are loaded once instead of per
+call. It reads JSON lines requests from stdin (or a Unix socket), e.g.
+
+    {"id": 1, "method": "uni2beta", "params": {"text_uni": "λόγος"}}
+
+and writes a JSON line per request as soon as it is done (not necessarily in
+order), with the id of the request:
+
+    {"id": 1, "result": "lo/gos"}
+    {"id": 2, "error": {"type": "TEIPostprocessorError", "message": "..."}}
+
+Run it with python -m dh_utils.serve [--workers N] [--pool thread|process] [--socket PATH]
+[--cache [PATH]].
+"""
+import argparse
+import json
+import os
+import socketserver
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from dataclasses import asdict
+from functools import partial
+
+from . import cache as cache_
+
+
+def _detect_scripts(text):
+    from .tei import detect_scripts
+    return detect_scripts(text)
+
+def _ping():
+    return 'pong'
+
+def _cache_stats():
+    return None if _cache is None else {**asdict(_cache.stats), 'hit_rate': _cache.stats.hit_rate}
+
+METHODS = {
+    **{name: func for name, (func, _) in cache_.FUNCTIONS.items()},
+    'detect_scripts': _detect_scripts,
+    'ping': _ping,
+    'cache_stats': _cache_stats,
+}
+
+# the ResultCache of this process, see set_up
+_cache = None
+
+def warm_up():
+    """ Load the tables, compile the regular expressions and set up Markdown (of this thread) """
+    METHODS['md2tei']('*warm*')
+    METHODS['tag_script']('warm')
+    _detect_scripts('warm')
+    METHODS['beta2uni'](METHODS['uni2beta']('λόγος'))
+
+def set_up(cache_options=None):
+    """
+    Warm up, and with cache_options (the arguments of ResultCache) answer the
+    cacheable methods from a cache of this process
+    """
+    global _cache
+    if cache_options is not None and _cache is None:
+        _cache = cache_.ResultCache(**cache_options)
+    warm_up()
+
+def call(method, params=None):
+    """
+    Call a method in METHODS with params (a dict of keyword arguments or a list
+    of arguments), returns a response without id: {'result': ...} or
+    {'error': {'type': ..., 'message': ...}}
+    """
+    func = METHODS.get(method)
+    if func is None:
+        return {'error': {'type': 'MethodNotFound', 'message': f'Unknown method {method!r}'}}
+    if _cache is not None and method in cache_.FUNCTIONS:
+        func = partial(_cache.call, method)
+    try:
+        if isinstance(params, dict):
+            result = func(**params)
+        else:
+            result = func(*(params or []))
+    except Exception as e:
+        return {'error': {'type': type(e).__name__, 'message': str(e)}}
+    return {'result': result}
+
+class Worker:
+    """
+    Handles requests inline (workers=1) or on a pool of threads or processes,
+    with at most max_pending requests in flight: reading the next request
+    waits until a slot is free, so that input is not read faster than it can
+    be handled. With cache_options, results are cached (see set_up).
+    """
+
+    def __init__(self, workers=1, pool='thread', max_pending=None, cache_options=None):
+        self.executor = None
+        if workers > 1:
+            executor_class = ProcessPoolExecutor if pool == 'process' else ThreadPoolExecutor
+            self.executor = executor_class(workers, initializer=set_up, initargs=(cache_options,))
+        set_up(cache_options)
+        self.slots = threading.BoundedSemaphore(max_pending or 2 * max(workers, 1))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def handle(self, line, write):
+        """
+        Handle a request line, write is called with the response (possibly
+        from another thread). Returns a future, or None if the request was
+        handled inline.
+        """
+        try:
+            request = json.loads(line)
+            id_, method, params = request.get('id'), request['method'], request.get('params')
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            write({'id': None, 'error': {'type': 'InvalidRequest', 'message': str(e)}})
+            return None
+        if self.executor is None:
+            write({'id': id_, **call(method, params)})
+            return None
+
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(call, method, params)
+        except Exception as e:  # e.g. a broken process pool
+            self.slots.release()
+            write({'id': id_, 'error': {'type': type(e).__name__, 'message': str(e)}})
+            return None
+
+        def done(future):
+            self.slots.release()
+            try:
+                response = future.result()
+            except Exception as e:  # e.g. a broken process pool
+                response = {'error': {'type': type(e).__name__, 'message': str(e)}}
+            write({'id': id_, **response})
+
+        future.add_done_callback(done)
+        return future
+
+    def serve(self, infile, outfile):
+        """ Handle the requests of infile (lines) until it ends, and write the responses to outfile """
+        lock = threading.Lock()
+
+        def write(response):
+            try:
+                line = json.dumps(response)
+            except (TypeError, ValueError) as e:
+                line = json.dumps({'id': response.get('id'), 'error': {'type': type(e).__name__, 'message': str(e)}})
+            with lock:
+                outfile.write(line + '\n')
+                outfile.flush()
+
+        # futures in flight, which are discarded by the pool threads once done
+        pending, pending_lock = set(), threading.Lock()
+
+        def forget(future):
+            with pending_lock:
+                pending.discard(future)
+
+        for line in infile:
+            if not line.strip():
+                continue
+            future = self.handle(line, write)
+            if future is not None:
+                with pending_lock:
+                    pending.add(future)
+                future.add_done_callback(forget)
+        with pending_lock:
+            remaining = list(pending)
+        wait(remaining)
+
+def serve_socket(worker, socket_path):
+    """ Serve the connections to Unix socket socket_path (each in a thread), sharing worker """
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            infile = (line.decode('utf-8') for line in self.rfile)
+            worker.serve(infile, _SocketWriter(self.wfile))
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    with socketserver.ThreadingUnixStreamServer(socket_path, Handler) as server:
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(socket_path)
+
+class _SocketWriter:
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, text):
+        self.wfile.write(text.encode('ascii'))
+
+    def flush(self):
+        self.wfile.flush()
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Handle conversion requests (JSON lines) from stdin or a Unix socket"
+    )
+    parser.add_argument("--workers", type=int, default=1, help="Number of threads or processes")
+    parser.add_argument(
+        "--pool",
+        choices=['thread', 'process'],
+        default='thread',
+        help="Handle requests on threads (default) or processes, with --workers > 1",
+    )
+    parser.add_argument(
+        "--max-pending",
+        type=int,
+        help="Maximum number of requests in flight (default: twice the number of workers)",
+    )
+    parser.add_argument("--socket", help="Listen on this Unix socket instead of stdin")
+    parser.add_argument(
+        "--cache",
+        nargs="?",
+        const="",
+        help="Cache the results of md2tei, tag_script, uni2beta and beta2uni, "
+        "in memory and in this SQLite database if given",
+    )
+    parser.add_argument("--cache-size", type=int, default=4096, help="Results cached in memory (per process)")
+    return parser.parse_args()
+
+def main(args):
+    cache_options = None
+    if args.cache is not None:
+        cache_options = {'maxsize': args.cache_size, 'path': args.cache or None}
+    with Worker(args.workers, args.pool, args.max_pending, cache_options) as worker:
+        if args.socket:
+            try:
+                serve_socket(worker, args.socket)
+            except KeyboardInterrupt:
+                pass
+        else:
+            worker.serve(sys.stdin, sys.stdout)
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -1,2 +1,30 @@
+from importlib import import_module
+
+# tag_script is imported eagerly: once the submodule tag_script is imported,
+# the import system binds it as attribute of the package, which would shadow
+# the function tag_script if that were only bound on first access.
+from . import tag_script as _tag_script
 from .tag_script import *
-from .markdown import *
+
+# Public names of the other submodules. These are only imported on first
+# access, so that e.g. using tag_script does not require importing markdown.
+SUBMODULES = {
+    'markdown': ['TEIPostprocessor', 'TEIPostprocessorError', 'ToTEI', 'md2tei', 'md2tei_many'],
+}
+
+__all__ = _tag_script.__all__ + [name for names in SUBMODULES.values() for name in names]
+
+_NAME_TO_MODULE = {name: module for module, names in SUBMODULES.items() for name in names}
+
+
+def __getattr__(name):
+    if name in _NAME_TO_MODULE:
+        module_name = _NAME_TO_MODULE[name]
+        module = import_module(f'.{module_name}', __name__)
+        globals().update({name: getattr(module, name) for name in SUBMODULES[module_name]})
+        return globals()[name]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
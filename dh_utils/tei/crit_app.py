@@ -1,8 +1,20 @@
+import argparse
+import logging
 import os
+import sys
+from copy import deepcopy
+from functools import lru_cache
 from os import path
 from lxml import etree
 import regex
 
+from .cts_index import FileIndex, split_urn
+from . import manifest
+from .instrument import cli_profile, stage
+from .xml_io import file_hash, mapped, parse, write_tree
+
+logger = logging.getLogger(__name__)
+
 HERE = path.abspath(path.split(__file__)[0])
 
 re_urn = regex.compile(r'^[^\.]+\.[^\.]+\.[^\-]+-([^\.]+)(?=\.xml$)')
@@ -15,12 +27,31 @@ def parse_urn(fname):
     if match:
         return match.group(), match.group(1)
     else:
-        raise Exception(f'Urn {urn} not of correct format')
+        raise Exception(f'Urn {fname} not of correct format')
+
+TEI_NS = 'http://www.tei-c.org/ns/1.0'
 
-def to_string(element):
-    content = etree.tostring(element, encoding='unicode')
-    content = regex.sub(fr'xmlns(?:\:[a-zA-Z]+?)?=".+?"\s*', '', content) # remove all NS
-    return content
+@lru_cache(maxsize=None)
+def _template_root():
+    return etree.fromstring(template.format(content='', id='', refsDecl='', lang=''))
+
+def strip_namespaces(element, copy=True):
+    """
+    Move all elements in element to the TEI namespace, the structural
+    equivalent of serializing it without namespace declarations and parsing
+    the result inside the template. Unless copy is False, this is done on a copy of element.
+    """
+    if copy:
+        element = deepcopy(element)
+    tei_prefix = f'{{{TEI_NS}}}'
+    needs_cleanup = False
+    for el in element.iter(etree.Element):
+        if not el.tag.startswith(tei_prefix):
+            el.tag = tei_prefix + etree.QName(el).localname
+            needs_cleanup = True
+    if needs_cleanup:
+        etree.cleanup_namespaces(element)
+    return element
 
 def recursive_update(dct, passage, value):
     n = passage[0]
@@ -36,73 +67,402 @@ def recursive_update(dct, passage, value):
             dct[n] = recursive_update(dict(), passage[1:], value)
     return dct
 
-def collect_apps(apps, re_passage, NS):
-    print(f"{len(apps)} apps found")
+def collect_apps(apps, re_passage, NS, copy=True):
+    """
+    Nested dict of passages and the apps that belong to them. If copy is False,
+    the app elements themselves are used (and later moved out of their tree by
+    build_critapp), so apps nested in other apps have to be copies (see
+    partition_apps).
+    """
     ca_dict = dict()
-    not_matched = 0
     for app in apps:
         loc = app.attrib['loc']
-        # print(loc)
         match = re_passage.search(loc)
         if match:
             passage = match.groups()
-            app_string = to_string(app)
-            ca_dict = recursive_update(ca_dict,passage,app_string)
-        else:
-            not_matched += 1
-    print(f"{len(apps) - not_matched} of which loc attribute succesfully interpreted")
+            ca_dict = recursive_update(ca_dict, passage, strip_namespaces(app, copy))
     return ca_dict
 
-def format_critapp(ca_dict, levels):
-    ca_string = ''
+def count_apps(ca_dict):
+    return sum(
+        len(value) if type(value) == list else count_apps(value) for value in ca_dict.values()
+    )
+
+def build_critapp(parent, ca_dict, levels):
+    """ Append the passages of ca_dict as (nested) textpart elements to parent """
     tag = levels[0]
-    for key,value in ca_dict.items():
-        tp_type = ' type="textpart"' if tag != 'l' else ''
+    for key, value in ca_dict.items():
+        attrib = {'type': 'textpart', 'n': key} if tag != 'l' else {'n': key}
+        el = etree.SubElement(parent, f'{{{TEI_NS}}}{tag}', attrib)
         if type(value) == list: # len(levels) == 1
-            apps_string = '\n'.join(value)
-            ca_string += f'<{tag}{tp_type} n="{key}">\n<listApp>\n{apps_string}\n</listApp>\n</{tag}>\n'
+            etree.SubElement(el, f'{{{TEI_NS}}}listApp').extend(value)
         elif type(value) == dict:
-            ca_string += f'<{tag}{tp_type} n="{key}">\n{format_critapp(value,levels[1:])}\n</{tag}>\n'
-    return ca_string
+            build_critapp(el, value, levels[1:])
 
-def create(fname, ca_ext, data_dir='.', lang='', app_type=None):
-    urn, extension = parse_urn(fname)
-    tree = etree.parse(path.join(data_dir, fname))
-    root = tree.getroot()
+def build_document(ca_dict, levels, urn, refs_decl, lang):
+    """ Critical apparatus document from the template """
+    root = deepcopy(_template_root())
+    etree.ETXPath(f'//{{{TEI_NS}}}encodingDesc')(root)[0].append(refs_decl)
+    div = etree.ETXPath(f'//{{{TEI_NS}}}body/{{{TEI_NS}}}div')(root)[0]
+    div.set('n', urn)
+    div.set('{http://www.w3.org/XML/1998/namespace}lang', lang)
+    build_critapp(div, ca_dict, levels)
+    etree.indent(root)
+    return root
+
+def partition_apps(root, NS, app_types, copy=False):
+    """
+    Divide all apps with a loc attribute by the type of the listApp they are in,
+    in a single traversal. Returns a dict with a list of apps for every type in
+    app_types, where None stands for all apps. An app that ends up in more than
+    one list, or that is nested in another app (e.g. in a rdg), is copied, so
+    that every list can be moved to a separate tree without taking apps out of
+    each other. If copy is given, all apps are copied.
+    """
+    partition = {app_type: [] for app_type in app_types}
+    for app in root.iter(f'{NS}app'):
+        if 'loc' not in app.attrib:
+            continue
+        types, nested = set(), False
+        for ancestor in app.iterancestors(f'{NS}listApp', f'{NS}app'):
+            if ancestor.tag == f'{NS}app':
+                nested = True
+            else:
+                types.add(ancestor.get('type'))
+        matched = False
+        for app_type, apps in partition.items():
+            if app_type is None or app_type in types:
+                apps.append(deepcopy(app) if matched or copy or nested else app)
+                matched = True
+    return partition
+
+def read_edition(fname, lang=''):
+    """
+    Parse an edition, returns the root, the namespace, the language (if not
+    given), the refsDecl, the levels of the first cRefPattern and the regex
+    that matches the passage in the loc attribute of an app
+    """
+    with stage('crit_app', 'parse', fname):
+        root = parse(fname).getroot()
+    return inspect_edition(root, fname, lang)
+
+def inspect_edition(root, fname, lang=''):
+    """ Same as read_edition, for the already parsed root of edition fname """
+    urn, _ = parse_urn(fname)
     NS = f'{{{root.nsmap[None]}}}'
     if not lang:
         lang = etree.ETXPath(f'//{NS}text/{NS}body/{NS}div/@xml:lang')(root)[0]
-    print(f"Lanugage: {lang}")
 
     # find refsDecl
-    refsDecl = to_string(etree.ETXPath(f'//{NS}refsDecl')(root)[0])
+    refsDecl = strip_namespaces(etree.ETXPath(f'//{NS}refsDecl')(root)[0])
 
     # Catch first cRefPattern
     cRef = etree.ETXPath(f'//{NS}refsDecl/{NS}cRefPattern/@replacementPattern')(root)[0]
     levels = regex.findall(r'tei:([a-zA-Z]+)\[@n=[\'"]\$[0-9]+[\'"]\]',cRef)
-    print(f"cRefPattern: {', '.join(levels)}")
 
     # find apps
     passage = r'\.'.join(r'(\w+)' for _ in range(len(levels)))
     urn_wo_ext = regex.sub('-.+?$','',urn)
-    print(fr'Searching for {urn_wo_ext}-[\w\-]+?:{passage}')
     re_passage = regex.compile(fr'{urn_wo_ext}-[\w\-]+?:{passage}')
-    app_xpath = f'//{NS}app[@loc]'
-    if app_type:
-        app_xpath = f'//{NS}listApp[@type="{app_type}"]' + app_xpath
-    apps = etree.ETXPath(app_xpath)(root)
-    ca_dict = collect_apps(apps,re_passage,NS)
+    return root, NS, lang, refsDecl, levels, re_passage
+
+def create(fname, ca_ext, data_dir='.', lang='', app_type=None):
+    """
+    Create a critical apparatus version of fname in data_dir, with extension
+    ca_ext. If app_type is given, only the apps in listApp[@type=app_type] are
+    used. To create several versions from one parse, pass a mapping of app types
+    to extensions as ca_ext (e.g. {'superior': 'appcrit1', 'inferior':
+    'appcrit2'}), where the app type None stands for all apps.
+
+    Returns a report with the language, the levels of the cRefPattern and, for
+    every file created, the number of apps found and successfully interpreted.
+    """
+    source = path.join(data_dir, fname)
+    with stage('crit_app', 'parse', source):
+        root = parse(source).getroot()
+    return create_from_tree(root, fname, ca_ext, data_dir, lang, app_type, copy=False)
+
+def create_from_tree(root, fname, ca_ext, data_dir='.', lang='', app_type=None, copy=True):
+    """
+    Same as create, for the already parsed root of fname. Unless copy is
+    False, the apps are copied, so that root is left intact.
+    """
+    outputs = ca_ext if isinstance(ca_ext, dict) else {app_type: ca_ext}
+    urn, extension = parse_urn(fname)
+    source = path.join(data_dir, fname)
+    root, NS, lang, refsDecl, levels, re_passage = inspect_edition(root, fname, lang)
+    logger.info(f"{fname}: language {lang}, cRefPattern {', '.join(levels)}")
+    with stage('crit_app', 'match', source) as stage_:
+        partition = partition_apps(root, NS, outputs.keys(), copy)
+        stage_.count = sum(len(apps) for apps in partition.values())
+
+    report = {'lang': lang, 'levels': levels, 'files': {}}
+    for app_type, ca_ext in outputs.items():
+        with stage('crit_app', 'interpret', source) as stage_:
+            ca_dict = collect_apps(partition[app_type], re_passage, NS, copy=False)
+            interpreted = stage_.count = count_apps(ca_dict)
+
+        # Create new file
+        new_urn = regex.sub(f'{extension}$', f'{ca_ext}', urn)
+        new_fname = regex.sub(f'{extension}(?=.xml$)', f'{ca_ext}', fname)
+        with stage('crit_app', 'build', source):
+            ca_root = build_document(ca_dict, levels, new_urn, deepcopy(refsDecl), lang)
+        with stage('crit_app', 'write', source):
+            write_tree(ca_root, path.join(data_dir, new_fname))
+        report['files'][new_fname] = {
+            'app_type': app_type,
+            'apps_found': len(partition[app_type]),
+            'apps_interpreted': interpreted,
+        }
+        logger.info(
+            f"{new_fname}: {len(partition[app_type])} apps found, "
+            f"{interpreted} of which loc attribute succesfully interpreted"
+        )
+    return report
+
+
+# Corpus level builds
+
+MANIFEST_FNAME = '.crit_app_manifest.json'
+
+re_app = regex.compile(rb'<(?:\w+:)?app[\s>/]')
+# the div of a critical apparatus version (see ca_template.xml)
+re_commentary = regex.compile(rb'<(?:\w+:)?div\s[^>]*\btype\s*=\s*["\']commentary["\']')
+
+def is_critapp(root, NS):
+    """ Whether root is a critical apparatus version, created by create """
+    divs = etree.ETXPath(f'//{NS}text/{NS}body/{NS}div')(root)
+    return bool(divs) and divs[0].get('type') == 'commentary'
+
+def find_editions(data_dir, ca_exts):
+    """
+    Editions in data_dir (e.g. data/textgroup/work/textgroup.work.edition-ext.xml)
+    that contain apps, skipping files with one of the extensions in ca_exts and
+    critical apparatus versions (also those created with other extensions)
+    """
+    for subdir, _, files in os.walk(data_dir):
+        for file in sorted(files):
+            try:
+                _, extension = parse_urn(file)
+            except Exception:
+                continue
+            if extension in ca_exts:
+                continue
+            with mapped(path.join(subdir, file)) as data:
+                if re_app.search(data) and not re_commentary.search(data):
+                    yield path.join(subdir, file)
+
+def _build_edition(fname, outputs, lang):
+    """ Create the apparatus of a single edition, returns the report of create """
+    return create(path.basename(fname), outputs, path.dirname(fname), lang)
+
+def build_corpus(data_dir, ca_ext, lang='', app_type=None, jobs=1, force=False):
+    """
+    Create the apparatus versions of all editions with apps in data_dir (see
+    create for the arguments), divided over jobs processes. A manifest in
+    data_dir records the hashes of the source and the created files and the
+    settings, so that editions that did not change since are skipped (unless
+    force is given). Returns a list of results (fname, status, seconds, info),
+    where status is one of 'built', 'skipped' or 'failed' and info is the
+    report of create or the error message.
+    """
+    if not path.isdir(data_dir):
+        raise FileNotFoundError(f'Data directory {data_dir} not found')
+    outputs = ca_ext if isinstance(ca_ext, dict) else {app_type: ca_ext}
+    # JSON has no None keys
+    settings = {'outputs': [[app_type, ext] for app_type, ext in outputs.items()], 'lang': lang}
+    manifest_ = manifest.Manifest(data_dir, MANIFEST_FNAME)
+
+    def up_to_date(fname, entry):
+        return (
+            entry and entry['settings'] == settings
+            and entry['hash'] == file_hash(fname)
+            and all(
+                path.isfile(path.join(data_dir, out)) and file_hash(path.join(data_dir, out)) == hash_
+                for out, hash_ in entry['outputs'].items()
+            )
+        )
+
+    def entry(fname, report):
+        out_fnames = [path.join(path.dirname(fname), out) for out in report['files']]
+        return {
+            'hash': file_hash(fname),
+            'settings': settings,
+            'outputs': {manifest_.key(out): file_hash(out) for out in out_fnames},
+        }
+
+    # files created by earlier runs, also with other extensions
+    created = {out for entry_ in manifest_.entries.values() for out in entry_['outputs']}
+    fnames = [
+        fname for fname in find_editions(data_dir, set(outputs.values()))
+        if manifest_.key(fname) not in created
+    ]
+
+    return manifest.process_files(
+        manifest_, fnames, _build_edition, (outputs, lang), jobs, force, up_to_date, entry, done='built'
+    )
+
+def _report_lines(report):
+    yield f"language {report['lang']}, cRefPattern {', '.join(report['levels'])}"
+    for out, counts in report['files'].items():
+        yield (
+            f"{out}: {counts['apps_found']} apps found, "
+            f"{counts['apps_interpreted']} of which loc attribute succesfully interpreted"
+        )
+
+def print_report(results):
+    manifest.print_summary(results, ['built', 'skipped', 'failed'], _report_lines)
+
+
+
+# Apparatus index
+
+APP_INDEX_FNAME = 'app_index.sqlite'
+
+APP_SCHEMA = """
+CREATE TABLE IF NOT EXISTS apps (
+    id INTEGER PRIMARY KEY,
+    edition TEXT NOT NULL,
+    ref TEXT NOT NULL,
+    ref_key TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    xml TEXT NOT NULL,
+    path TEXT NOT NULL REFERENCES files (path) ON DELETE CASCADE
+);
+CREATE TABLE IF NOT EXISTS app_types (
+    app INTEGER NOT NULL REFERENCES apps (id) ON DELETE CASCADE,
+    type TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS apps_ref ON apps (edition, ref_key, position);
+CREATE INDEX IF NOT EXISTS apps_path ON apps (path);
+CREATE INDEX IF NOT EXISTS app_types_app ON app_types (app, type);
+"""
+
+def ref_key(ref):
+    """ Sortable version of a passage reference, with numbers padded so that 2 < 10 """
+    return '.'.join(n.zfill(10) if n.isdigit() else n for n in ref.split('.'))
+
+def app_xml(app):
+    """
+    An app serialized as in the critical apparatus version (apart from its
+    indentation), where it inherits the TEI namespace from the document:
+    without namespaces or their declarations
+    """
+    app = deepcopy(app)
+    for el in app.iter(etree.Element):
+        el.tag = etree.QName(el).localname
+    etree.cleanup_namespaces(app)
+    return etree.tostring(app, encoding='unicode', with_tail=False)
+
+def index_apps(fname):
+    """
+    The apps of an edition with their passage, as collect_apps would interpret
+    them (none for critical apparatus versions). Returns a list of (edition,
+    ref, ref_key, position, xml, types), with the app serialized as in the
+    critical apparatus version (see app_xml) and types the types of the
+    listApps it is in.
+    """
+    root, NS, _, _, _, re_passage = read_edition(fname)
+    if is_critapp(root, NS):
+        return []
+    edition = etree.ETXPath(f'//{NS}text/{NS}body/{NS}div')(root)[0].get('n')
+    rows = []
+    with stage('crit_app', 'interpret', fname) as stage_:
+        for position, app in enumerate(root.iter(f'{NS}app')):
+            match = re_passage.search(app.get('loc', ''))
+            if not match:
+                continue
+            ref = '.'.join(match.groups())
+            types = {list_app.get('type') for list_app in app.iterancestors(f'{NS}listApp')}
+            xml = app_xml(app)
+            rows.append((edition, ref, ref_key(ref), position, xml, sorted(types - {None})))
+        stage_.count = len(rows)
+    return rows
+
+class AppIndex(FileIndex):
+    """
+    An SQLite index of the apps of editions by passage, so that the apparatus
+    of a passage can be looked up without creating and parsing the critical
+    apparatus version.
+    """
+
+    schema = APP_SCHEMA
+    tool = 'crit_app'
+
+    def __init__(self, fname=APP_INDEX_FNAME):
+        super().__init__(fname)
+
+    def find_files(self, path):
+        return find_editions(path, ())
+
+    def index_file(self, fname):
+        return index_apps(fname)
+
+    def insert(self, fname, rows):
+        for edition, ref, key, position, xml, types in rows:
+            app_id = self.connection.execute(
+                'INSERT INTO apps (edition, ref, ref_key, position, xml, path) VALUES (?, ?, ?, ?, ?, ?)',
+                (edition, ref, key, position, xml, fname)
+            ).lastrowid
+            self.connection.executemany(
+                'INSERT INTO app_types VALUES (?, ?)', ((app_id, type_) for type_ in types)
+            )
 
-    ca_string = format_critapp(ca_dict, levels)
+    def apps(self, urn, ref=None, app_type=None):
+        """
+        The apps of a passage (e.g. urn:cts:latinLit:stoa0023.stoa001.amo-lat2:14.1.5),
+        including those of the passages below it (e.g. ...:14.1), or of a
+        range of passages (e.g. ...:14.1.1-14.1.5). The reference can also be
+        given separately. If app_type is given, only apps in a
+        listApp[@type=app_type] are returned. Returns a dict of passage
+        references and lists of serialized apps, ordered by reference.
+        """
+        edition, passage = split_urn(urn) if ref is None else (urn, ref)
+        start, _, end = passage.partition('-')
+        query = 'SELECT ref, xml FROM apps WHERE edition = ? AND ref_key >= ? AND ref_key < ?'
+        params = [edition, ref_key(start), ref_key(end or start) + '\U0010ffff']
+        if app_type is not None:
+            query += ' AND id IN (SELECT app FROM app_types WHERE type = ?)'
+            params.append(app_type)
+        apps = {}
+        for ref_, xml in self.connection.execute(query + ' ORDER BY ref_key, position', params):
+            apps.setdefault(ref_, []).append(xml)
+        return apps
 
-    # Create new file
-    new_urn = regex.sub(f'{extension}$', f'{ca_ext}', urn)
-    new_fname = regex.sub(f'{extension}(?=.xml$)', f'{ca_ext}', fname)
-    content = template.format(content=ca_string, id=new_urn, refsDecl=refsDecl, lang=lang)
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Create critical apparatus versions of all editions in a CTS data directory"
+    )
+    parser.add_argument("data_dir", help="CTS data directory")
+    parser.add_argument(
+        "outputs",
+        nargs="+",
+        help="Extension of the apparatus versions (e.g. appcrit1), or a "
+             "listApp type with extension (e.g. superior=appcrit1)",
+    )
+    parser.add_argument("--lang", default='', help="Language of the apparatus")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of processes")
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Also build editions that did not change since the last run",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print the time and peak memory per stage (parse, match, etc.) at the end",
+    )
+    return parser.parse_args()
 
-    # Indentation
-    tree = etree.fromstring(content)
-    etree.indent(tree)
+def main(args):
+    outputs = {}
+    for output in args.outputs:
+        app_type, _, ca_ext = output.rpartition('=')
+        outputs[app_type or None] = ca_ext
+    with cli_profile(args.profile):
+        results = build_corpus(args.data_dir, outputs, args.lang, jobs=args.jobs, force=args.force)
+        print_report(results)
+    return int(any(status == 'failed' for _, status, _, _ in results))
 
-    with open(path.join(data_dir, new_fname), 'w') as f:
-        f.write(etree.tostring(tree, encoding="unicode"))
+if __name__ == '__main__':
+    sys.exit(main(parse_args()))
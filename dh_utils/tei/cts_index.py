@@ -0,0 +1,376 @@
+import argparse
+import os
+import re
+import sqlite3
+import sys
+from dataclasses import dataclass
+from pathlib import Path
+
+from lxml import etree
+
+from . import xml_io
+from .instrument import cli_profile, stage
+from .refsdecl_generator import (
+    CTS_VERSION_XPATH,
+    TEI_XPATH,
+    child_textparts,
+    findall,
+    xml_paths,
+)
+
+INDEX_FNAME = "cts_index.sqlite"
+
+FILES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    hash TEXT NOT NULL
+);
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS passages (
+    edition TEXT NOT NULL,
+    ref TEXT NOT NULL,
+    depth INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    sibling INTEGER NOT NULL,
+    xpath TEXT NOT NULL,
+    path TEXT NOT NULL REFERENCES files (path) ON DELETE CASCADE,
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL,
+    PRIMARY KEY (edition, ref)
+);
+CREATE INDEX IF NOT EXISTS passages_order ON passages (edition, depth, position);
+CREATE INDEX IF NOT EXISTS passages_path ON passages (path);
+"""
+
+# Markup in document order: comments, CDATA, processing instructions and the
+# doctype are skipped, the groups capture end tags (1) and (self-closing) start
+# tags (2, 3)
+RE_MARKUP = re.compile(
+    rb"<!--.*?-->|<!\[CDATA\[.*?\]\]>|<\?.*?\?>|<!DOCTYPE[^\[>]*(?:\[.*?\])?\s*>"
+    rb"|</([^\s>]+)\s*>"
+    rb"|<([^\s/>!?]+)(?:[^>\"']|\"[^\"]*\"|'[^']*')*?(/?)>",
+    re.S,
+)
+
+
+@dataclass
+class Passage:
+    edition: str
+    ref: str
+    depth: int
+    position: int
+    sibling: int
+    xpath: str
+    path: str
+    start: int
+    end: int
+
+    def read(self):
+        """Read the XML of the passage from the source file"""
+        with open(self.path, "rb") as f:
+            f.seek(self.start)
+            return f.read(self.end - self.start)
+
+
+def element_offsets(data):
+    """
+    Byte offsets (start, end) of every element in data in document order, i.e.
+    the order of root.iter(etree.Element)
+    """
+    starts, ends, stack = [], [], []
+    for match in RE_MARKUP.finditer(data):
+        group = match.lastindex
+        if group == 3:
+            starts.append(match.start())
+            if match.group(3):
+                ends.append(match.end())
+            else:
+                stack.append(len(ends))
+                ends.append(None)
+        elif group == 1:
+            ends[stack.pop()] = match.end()
+    return list(zip(starts, ends))
+
+
+def xpath_literal(value):
+    """value as an XPath 1.0 string literal, which has no escapes: concat() is used if it has both quotes"""
+    if "'" not in value:
+        return f"'{value}'"
+    if '"' not in value:
+        return f'"{value}"'
+    return "concat(" + ", \"'\", ".join(f"'{part}'" for part in value.split("'")) + ")"
+
+
+def _textpart_rows(version_el, version_xpath):
+    """Yield (element, ref, depth, sibling, xpath) for every textpart in a version"""
+    stack = [(version_el, "", version_xpath, 0)]
+    while stack:
+        el, ref, xpath, depth = stack.pop()
+        children = []
+        for sibling, (xpath_match, child) in enumerate(child_textparts(el), start=1):
+            n = child.get("n")
+            child_ref = f"{ref}.{n}" if ref else n
+            child_xpath = f"{xpath}/{xpath_match.replace('[@n]', f'[@n={xpath_literal(n)}]')}"
+            yield child, child_ref, depth + 1, sibling, child_xpath
+            children.append((child, child_ref, child_xpath, depth + 1))
+        stack.extend(reversed(children))
+
+
+def index_file(path):
+    """Return the passages of all editions (versions) in a TEI file"""
+    with xml_io.mapped(path) as data:
+        with stage("cts_index", "parse", path):
+            root = xml_io.fromstring(data, base_url=str(path))
+
+        with stage("cts_index", "match", path) as stage_:
+            rows = []
+            for version_el in findall(root, f"./{CTS_VERSION_XPATH}"):
+                version_xpath = os.path.join(
+                    TEI_XPATH, CTS_VERSION_XPATH.replace("[@n]", f"[@n={xpath_literal(version_el.attrib['n'])}]")
+                )
+                for row in _textpart_rows(version_el, version_xpath):
+                    rows.append((version_el.attrib["n"], *row))
+            stage_.count = len(rows)
+        if not rows:
+            return []
+        refs = set()
+        for edition, _, ref, *_ in rows:
+            if (edition, ref) in refs:
+                raise ValueError(f"Duplicate passage {edition}:{ref} in {path}")
+            refs.add((edition, ref))
+
+        # map the textparts to their position in document order, and thereby to
+        # the offsets of their markup
+        with stage("cts_index", "locate", path):
+            textparts = {row[1] for row in rows}
+            positions, n_elements = {}, 0
+            for n_elements, el in enumerate(root.iter(etree.Element), start=1):
+                if el in textparts:
+                    positions[el] = n_elements - 1
+            offsets = element_offsets(data)
+        # e.g. elements from entities declared in the doctype
+        if len(offsets) != n_elements or any(
+            not _starts_with(data, b"<" + _qualified_name(el), offsets[positions[el]][0])
+            for el in (rows[0][1], rows[-1][1])
+        ):
+            raise ValueError(f"Could not locate the elements of {path} in the source")
+
+    path = str(path)
+    return [
+        Passage(edition, ref, depth, positions[el], sibling, xpath, path, *offsets[positions[el]])
+        for edition, el, ref, depth, sibling, xpath in rows
+    ]
+
+
+def _starts_with(data, prefix, start):
+    # memory maps have no startswith
+    return data[start:start + len(prefix)] == prefix
+
+
+def _qualified_name(el):
+    name = etree.QName(el).localname
+    return (f"{el.prefix}:{name}" if el.prefix else name).encode()
+
+
+def split_urn(urn):
+    """
+    Split a CTS urn (urn:cts:namespace:work.edition:passage) in the edition and
+    the passage reference (or range)
+    """
+    parts = urn.split(":")
+    if len(parts) == 5:
+        return ":".join(parts[:4]), parts[4]
+    return urn, ""
+
+
+class FileIndex:
+    """
+    Base class of SQLite indexes of files, that keeps track of the hash of every
+    indexed file. Subclasses define the schema of their tables (with a path
+    column referencing files), which files to index and how.
+    """
+
+    schema = ""
+    # name of the tool in the stage events of update
+    tool = "cts_index"
+
+    def __init__(self, fname):
+        self.fname = str(fname)
+        self.connection = sqlite3.connect(self.fname)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(FILES_SCHEMA + self.schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def find_files(self, path):
+        """The files in directory path to index"""
+        return xml_paths(path)
+
+    def index_file(self, fname):
+        """Index a single file, raising an exception if it cannot be indexed"""
+        raise NotImplementedError
+
+    def insert(self, fname, items):
+        """Insert the result of index_file in the tables (in a transaction)"""
+        raise NotImplementedError
+
+    def update(self, path, force=False):
+        """
+        Index all files in path (a file or directory). Files whose hash did not
+        change since they were last indexed are skipped, unless force is given,
+        and files that were removed from a directory are dropped from the index.
+        Returns a list of (fname, status, error), with status one of 'indexed',
+        'skipped', 'removed' or 'failed'.
+        """
+        path_ = Path(path)
+        fnames = [path_] if path_.is_file() else [Path(fname) for fname in self.find_files(path_)]
+        fnames = [str(fname.resolve()) for fname in fnames]
+        known = dict(self.connection.execute("SELECT path, hash FROM files"))
+
+        results = []
+        for fname in fnames:
+            hash_ = xml_io.file_hash(fname)
+            if not force and known.get(fname) == hash_:
+                results.append((fname, "skipped", None))
+                continue
+            try:
+                items = self.index_file(fname)
+            except Exception as e:
+                with self.connection:
+                    self.connection.execute("DELETE FROM files WHERE path = ?", (fname,))
+                results.append((fname, "failed", f"{type(e).__name__}: {e}"))
+                continue
+            try:
+                with stage(self.tool, "write", fname, len(items)), self.connection:
+                    self.connection.execute("DELETE FROM files WHERE path = ?", (fname,))
+                    self.connection.execute("INSERT INTO files VALUES (?, ?)", (fname, hash_))
+                    self.insert(fname, items)
+            except sqlite3.IntegrityError as e:
+                # e.g. passages that are already indexed from another file
+                with self.connection:
+                    self.connection.execute("DELETE FROM files WHERE path = ?", (fname,))
+                results.append((fname, "failed", f"{type(e).__name__}: {e}"))
+                continue
+            results.append((fname, "indexed", None))
+
+        if path_.is_dir():
+            root = str(path_.resolve())
+            removed = [
+                fname
+                for fname in known
+                if fname not in set(fnames) and os.path.commonpath([root, fname]) == root
+            ]
+            with self.connection:
+                self.connection.executemany(
+                    "DELETE FROM files WHERE path = ?", ((fname,) for fname in removed)
+                )
+            results.extend((fname, "removed", None) for fname in removed)
+        return results
+
+
+class CTSIndex(FileIndex):
+    """
+    An SQLite index of the passages of CTS editions, with the byte offsets of
+    the passages in the source files so they can be read without parsing.
+    """
+
+    schema = SCHEMA
+
+    def __init__(self, fname=INDEX_FNAME):
+        super().__init__(fname)
+
+    def index_file(self, fname):
+        return index_file(fname)
+
+    def insert(self, fname, passages):
+        self.connection.executemany(
+            "INSERT INTO passages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                (p.edition, p.ref, p.depth, p.position, p.sibling, p.xpath, p.path, p.start, p.end)
+                for p in passages
+            ),
+        )
+
+    def _get(self, edition, ref):
+        row = self.connection.execute(
+            "SELECT * FROM passages WHERE edition = ? AND ref = ?", (edition, ref)
+        ).fetchone()
+        if row is None:
+            raise KeyError(f"{edition}:{ref}")
+        return Passage(*row)
+
+    def resolve(self, urn, ref=None):
+        """
+        Look up the passages of a CTS urn with a single reference (e.g.
+        urn:cts:latinLit:stoa0023.stoa001.amo-lat2:14.1.5) or a range of
+        references at the same depth (e.g. ...:14.1.1-14.1.5). The reference
+        can also be given separately. Raises KeyError if a reference is not
+        in the index.
+        """
+        edition, passage = split_urn(urn) if ref is None else (urn, ref)
+        start_ref, _, end_ref = passage.partition("-")
+        start = self._get(edition, start_ref)
+        if not end_ref:
+            return [start]
+        end = self._get(edition, end_ref)
+        if start.depth != end.depth:
+            raise ValueError(f"References {start_ref} and {end_ref} differ in depth")
+        rows = self.connection.execute(
+            "SELECT * FROM passages WHERE edition = ? AND depth = ? AND position BETWEEN ? AND ? "
+            "ORDER BY position",
+            (edition, start.depth, start.position, end.position),
+        )
+        return [Passage(*row) for row in rows]
+
+    def read(self, urn, ref=None):
+        """The XML of the passages of resolve(urn, ref)"""
+        return [passage.read() for passage in self.resolve(urn, ref)]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Index the passages of CTS editions, or look up passages in the index"
+    )
+    parser.add_argument("index", help="SQLite index file")
+    parser.add_argument("path", nargs="?", help="TEI file or directory to (re-)index")
+    parser.add_argument("--force", action="store_true", help="Also re-index unchanged files")
+    parser.add_argument(
+        "--get", metavar="URN", action="append", default=[], help="Print the passage(s) of a urn"
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print the time and peak memory per stage (parse, match, etc.) at the end",
+    )
+    return parser.parse_args()
+
+
+def main(args):
+    failed = False
+    with cli_profile(args.profile), CTSIndex(args.index) as index:
+        if args.path:
+            for fname, status, error in index.update(args.path, args.force):
+                if status != "skipped":
+                    print(f"{status:<8} {fname}" + (f": {error}" if error else ""), file=sys.stderr)
+                failed = failed or status == "failed"
+        for urn in args.get:
+            try:
+                for xml in index.read(urn):
+                    sys.stdout.buffer.write(xml + b"\n")
+            except (KeyError, ValueError) as e:
+                print(f"{urn}: {e}", file=sys.stderr)
+                failed = True
+    return int(failed)
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args()))
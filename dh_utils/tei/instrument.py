@@ -0,0 +1,218 @@
+"""
+Instrumentation of the TEI tools. The tools time the stages of processing a
+file (e.g. parse, match, serialize and write) and emit a StageEvent for every
+stage to the registered observers, and as a debug message to the logger
+dh_utils.tei. Profile is an observer that aggregates the events per stage.
+"""
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from itertools import repeat
+from typing import Optional
+
+try:
+    import resource
+except ImportError:  # e.g. on Windows
+    resource = None
+
+logger = logging.getLogger("dh_utils.tei")
+
+# observers and whether they want memory samples
+_observers = {}
+
+
+@dataclass
+class StageEvent:
+    tool: str
+    stage: str
+    path: Optional[str]
+    seconds: float
+    # number of items processed in the stage (e.g. apps or textparts)
+    count: Optional[int] = None
+    # peak memory (RSS) of the process so far, in MiB, if sampled
+    peak_rss: Optional[float] = None
+
+
+def add_observer(observer, memory=False):
+    """
+    Call observer with a StageEvent for every stage. With memory, the peak
+    memory of the process is sampled at the end of every stage.
+    """
+    _observers[observer] = memory
+
+
+def remove_observer(observer):
+    _observers.pop(observer, None)
+
+
+@contextmanager
+def observe(observer, memory=False):
+    add_observer(observer, memory)
+    try:
+        yield observer
+    finally:
+        remove_observer(observer)
+
+
+def enabled():
+    return bool(_observers) or logger.isEnabledFor(logging.DEBUG)
+
+
+def peak_rss():
+    """Peak memory (RSS) of the process in MiB, None if not available"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return rss / 2 ** 20 if sys.platform == "darwin" else rss / 2 ** 10
+
+
+def _notify(event):
+    for observer in list(_observers):
+        observer(event)
+
+
+def emit(event):
+    _notify(event)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "%s %s %.6fs%s %s",
+            event.tool,
+            event.stage,
+            event.seconds,
+            "" if event.count is None else f" ({event.count})",
+            event.path or "",
+        )
+
+
+class _Stage:
+    __slots__ = ("count",)
+
+    def __init__(self, count):
+        self.count = count
+
+
+@contextmanager
+def stage(tool, name, path=None, count=None):
+    """
+    Time the code in the with block as stage name of tool, for path. The
+    number of items processed can be given, or set as the count attribute
+    of the yielded object. No event is emitted if the block raises.
+    """
+    stage_ = _Stage(count)
+    if not enabled():
+        yield stage_
+        return
+    start = time.perf_counter()
+    yield stage_
+    seconds = time.perf_counter() - start
+    memory = any(_observers.values())
+    emit(
+        StageEvent(
+            tool,
+            name,
+            None if path is None else str(path),
+            seconds,
+            stage_.count,
+            peak_rss() if memory else None,
+        )
+    )
+
+
+def _call_observed(func, args, memory):
+    events = []
+    with observe(events.append, memory):
+        result = func(*args)
+    return result, events
+
+
+def pool_map(executor, func, *iterables, chunksize=1):
+    """
+    Like executor.map for a process pool, but the events emitted in the worker
+    processes are passed to the observers of this process as well
+    """
+    if not _observers:
+        yield from executor.map(func, *iterables, chunksize=chunksize)
+        return
+    memory = any(_observers.values())
+    results = executor.map(
+        _call_observed, repeat(func), zip(*iterables), repeat(memory), chunksize=chunksize
+    )
+    for result, events in results:
+        for event in events:
+            _notify(event)
+        yield result
+
+
+class Profile:
+    """
+    Observer that aggregates the events per tool and stage, e.g.
+
+        with Profile() as profile:
+            build_corpus(...)
+        profile.report()
+
+    Use memory=True to also record the peak memory.
+    """
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.lock = threading.Lock()
+        # (tool, stage) -> [calls, seconds, count, peak_rss]
+        self.stages = {}
+        self.paths = set()
+
+    def __call__(self, event):
+        with self.lock:
+            totals = self.stages.setdefault((event.tool, event.stage), [0, 0.0, None, None])
+            totals[0] += 1
+            totals[1] += event.seconds
+            if event.count is not None:
+                totals[2] = (totals[2] or 0) + event.count
+            if event.peak_rss is not None:
+                totals[3] = max(totals[3] or 0, event.peak_rss)
+            if event.path is not None:
+                self.paths.add(event.path)
+
+    def __enter__(self):
+        add_observer(self, self.memory)
+        return self
+
+    def __exit__(self, *exc):
+        remove_observer(self)
+
+    def report(self, file=sys.stderr):
+        """Print the time per stage, the share of the total time and the items processed"""
+        total = sum(totals[1] for totals in self.stages.values())
+        print(
+            f"{'stage':<24} {'calls':>7} {'seconds':>9} {'share':>6} {'per call':>10} "
+            f"{'items':>9} {'peak MiB':>9}",
+            file=file,
+        )
+        for (tool, stage_), (calls, seconds, count, rss) in sorted(
+            self.stages.items(), key=lambda item: -item[1][1]
+        ):
+            print(
+                f"{tool + ' ' + stage_:<24} {calls:>7} {seconds:9.3f} {seconds / (total or 1):6.1%} "
+                f"{seconds / calls * 1000:8.2f}ms {'' if count is None else count:>9} "
+                f"{'' if rss is None else f'{rss:.1f}':>9}",
+                file=file,
+            )
+        print(f"{len(self.paths)} files, {total:.3f}s in stages", file=file)
+
+
+@contextmanager
+def cli_profile(enabled, file=sys.stderr):
+    """
+    Profile the with block (including peak memory) and print the report at the
+    end, if enabled, for the --profile option of the command line tools
+    """
+    if not enabled:
+        yield None
+        return
+    with Profile(memory=True) as profile:
+        yield profile
+    profile.report(file)
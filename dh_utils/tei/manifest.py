@@ -0,0 +1,99 @@
+"""
+Incremental processing of the files of a corpus, shared by the corpus tools
+(tag_script.tag_corpus and crit_app.build_corpus): a manifest in the corpus
+directory records an entry per processed file (e.g. its hash and the
+settings), so that files that did not change since the last run are skipped,
+and the other files are divided over a pool of processes.
+"""
+import json
+import time
+from os import path
+
+from .instrument import pool_map
+from .xml_io import atomic_open
+
+class Manifest:
+    """ The entries of the files in corpus_dir, by path relative to corpus_dir """
+
+    def __init__(self, corpus_dir, fname):
+        self.corpus_dir = corpus_dir
+        self.fname = path.join(corpus_dir, fname)
+        try:
+            with open(self.fname) as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+
+    def key(self, fname):
+        return path.relpath(fname, self.corpus_dir)
+
+    def get(self, fname):
+        return self.entries.get(self.key(fname))
+
+    def save(self):
+        with atomic_open(self.fname, 'w') as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
+
+def _process_file(func, fname, args):
+    """ Call func(fname, *args), returns (fname, result, seconds, error) """
+    start = time.perf_counter()
+    try:
+        result = func(fname, *args)
+    except Exception as e:
+        return fname, None, time.perf_counter() - start, f'{type(e).__name__}: {e}'
+    return fname, result, time.perf_counter() - start, None
+
+def process_files(manifest, fnames, func, args=(), jobs=1, force=False, up_to_date=None, entry=None,
+                  done='processed'):
+    """
+    Call func(fname, *args) (a module-level function, with jobs > 1) for the
+    files fnames, divided over jobs processes. Files for which
+    up_to_date(fname, manifest entry) holds are skipped, unless force is
+    given. The manifest entry of a processed file becomes entry(fname, result
+    of func), and that of a failed file is removed, and the manifest is saved.
+    Returns a list of results (fname, status, seconds, info), where status is
+    done, 'skipped' or 'failed' and info is the result of func or the error
+    message.
+    """
+    results, todo = [], []
+    for fname in fnames:
+        if not force and up_to_date(fname, manifest.get(fname)):
+            results.append((fname, 'skipped', 0.0, None))
+        else:
+            todo.append(fname)
+
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(jobs) as executor:
+            processed = list(pool_map(executor, _process_file, [func] * len(todo), todo, [args] * len(todo)))
+    else:
+        processed = [_process_file(func, fname, args) for fname in todo]
+
+    for fname, result, seconds, error in processed:
+        if error:
+            manifest.entries.pop(manifest.key(fname), None)
+            results.append((fname, 'failed', seconds, error))
+        else:
+            manifest.entries[manifest.key(fname)] = entry(fname, result)
+            results.append((fname, done, seconds, result))
+
+    manifest.save()
+    return sorted(results, key=lambda result: result[0])
+
+def print_summary(results, statuses, details=None):
+    """
+    Print the results of process_files with the time per file, the lines of
+    details(info) below the processed files and the number of files with each
+    of statuses
+    """
+    for fname, status, seconds, info in results:
+        print(f'{status:<8} {seconds:8.3f}s  {fname}')
+        if status == 'failed':
+            print(f'         {info}')
+        elif details is not None and status != 'skipped':
+            for line in details(info):
+                print(f'         {line}')
+    counts = {status: sum(1 for r in results if r[1] == status) for status in statuses}
+    total = sum(r[2] for r in results)
+    print(', '.join(f'{n} {status}' for status, n in counts.items()) + f' ({total:.3f}s)')
@@ -1,23 +1,67 @@
-from markdown.postprocessors import Postprocessor
+from markdown.postprocessors import Postprocessor, RawHtmlPostprocessor, AndSubstitutePostprocessor
+from markdown.treeprocessors import Treeprocessor
 from markdown.extensions import Extension
-from markdown import markdown
+from markdown.serializers import HTML_EMPTY
+from markdown import markdown, Markdown
 
+from collections import deque
+from itertools import islice
 from lxml import etree
 import re
+import threading
 from namedentities import unicode_entities
 
-__all__ = ['TEIPostprocessor', 'TEIPostprocessorError', 'ToTEI', 'md2tei']
+__all__ = ['TEIPostprocessor', 'TEITreeprocessor', 'TEIPostprocessorError', 'ToTEI', 'md2tei', 'md2tei_many']
+
+ROOT_TAG = 'root'
+
+# HTML tags and their TEI replacement, with attributes (where '@attr' takes the
+# value of the HTML attribute attr)
+TAG_REPLACEMENTS = {
+    'em': ('hi', {'rend': 'italic'}),
+    'i': ('hi', {'rend': 'italic'}),
+    'strong': ('hi', {'rend': 'bold'}),
+    'b': ('hi', {'rend': 'bold'}),
+    'sup': ('hi', {'rend': 'superscript'}),
+    'sub': ('hi', {'rend': 'subscript'}),
+    'small': ('hi', {'rend': 'smallcaps'}),
+    **{f'h{i}': ('head', {}) for i in range(1, 7)},
+    'br': ('lb', {}),
+    'ol': ('list', {'rend': 'numbered'}),
+    'ul': ('list', {'rend': 'bulleted'}),
+    'li': ('item', {}),
+    'blockquote': ('quote', {}),
+    'a': ('ref', {'target': '@href'}),
+    'img': ('graphic', {'n': '@alt', 'url': '@src'}),
+}
 
 
 class TEIPostprocessorError(Exception):
     pass
 
 
+def _serialize(tree, indent=False, with_root=False, indent_unit='  '):
+    if indent:
+        etree.indent(tree, space=indent_unit)
+
+    new_text = etree.tostring(tree, encoding='unicode')
+
+    if not with_root:
+        # Remove wrapped root element
+        new_text = re.sub(rf'^\s*<{ROOT_TAG}>|</{ROOT_TAG}>\s*$', '', new_text)
+        if indent:
+            new_text = new_text.replace('\n' + indent_unit, '\n')
+
+    return new_text
+
+
 class TEIPostprocessor(Postprocessor):
 
-    def __init__(self, md, indent=False, with_root=False):
+    def __init__(self, md, indent=False, with_root=False, treeprocessor=None):
         self.indent = indent
         self.with_root = with_root
+        # A TEITreeprocessor that may already have converted the document
+        self.treeprocessor = treeprocessor
         Postprocessor.__init__(self, md)
 
     def _replace_tag(self, old_tag, new_tag, clear_attrib=False, **attribs):
@@ -36,7 +80,11 @@ class TEIPostprocessor(Postprocessor):
             el.attrib.update(new_attrib)
 
     def run(self, text, indent_unit='  '):
-        root_tag = 'root'
+        if self.treeprocessor is not None and self.treeprocessor.output is not None:
+            output, self.treeprocessor.output = self.treeprocessor.output, None
+            return output
+
+        root_tag = ROOT_TAG
 
         # A dirty namespace hack
         text = unicode_entities(text)
@@ -99,35 +147,145 @@ class TEIPostprocessor(Postprocessor):
             container.insert(container.index(table) + 1, new_table)
             del container[container.index(table)]
 
-        self._replace_tag('em', 'hi', rend='italic')
-        self._replace_tag('i', 'hi', rend='italic')
-        self._replace_tag('strong', 'hi', rend='bold')
-        self._replace_tag('b', 'hi', rend='bold')
-        self._replace_tag('sup', 'hi', rend='superscript')
-        self._replace_tag('sub', 'hi', rend='subscript')
-        self._replace_tag('small', 'hi', rend='smallcaps')
-        for i in range(1, 7):
-            self._replace_tag(f'h{i}', 'head')
-        self._replace_tag('br', 'lb')
-        self._replace_tag('ol', 'list', rend='numbered')
-        self._replace_tag('ul', 'list', rend='bulleted')
-        self._replace_tag('li', 'item')
-        self._replace_tag('blockquote', 'quote')
-        self._replace_tag('a', 'ref', target='@href')
-        self._replace_tag('img', 'graphic', n='@alt', url='@src')
-
-        if self.indent:
-            etree.indent(self.tree, space=indent_unit)
-
-        new_text = etree.tostring(self.tree, encoding='unicode')
-
-        if not self.with_root:
-            # Remove wrapped root element
-            new_text = re.sub(rf'^\s*<{root_tag}>|</{root_tag}>\s*$', '', new_text)
-            if self.indent:
-                new_text = new_text.replace('\n' + indent_unit, '\n')
-
-        return new_text
+        for old_tag, (new_tag, attribs) in TAG_REPLACEMENTS.items():
+            self._replace_tag(old_tag, new_tag, **attribs)
+
+        return _serialize(self.tree, self.indent, self.with_root, indent_unit)
+
+
+class _Fallback(Exception):
+    """The document cannot be converted by TEITreeprocessor with identical output"""
+
+
+# Entity references, that would be resolved by the postprocessor
+RE_ENTITY = re.compile(r'&(?:#[0-9]+|#x[0-9a-f]+|[0-9a-z]+);', re.I)
+
+XML_NS = '{http://www.w3.org/XML/1998/namespace}'
+
+
+def _check_text(text):
+    if not text:
+        return None
+    if (
+        '\x02' in text or '\x03' in text or '\r' in text or XML_NS in text
+        or ('&' in text and RE_ENTITY.search(text))
+    ):
+        raise _Fallback
+    return text
+
+
+def _check_attrib(el):
+    """The attributes of el in the (sorted) order of the markdown serializer"""
+    attrib = {}
+    for key, value in sorted(el.items()):
+        if key.startswith(XML_NS):
+            pass
+        elif key.startswith('xml:'):
+            key = XML_NS + key[4:]
+        elif ':' in key or '{' in key:
+            raise _Fallback
+        if any(c in value for c in '"\n\t\r\x02\x03') or ('&' in value and RE_ENTITY.search(value)):
+            raise _Fallback
+        attrib[key] = value
+    return attrib
+
+
+class TEITreeprocessor(Treeprocessor):
+    """
+    Converts the element tree of markdown to TEI directly in a single traversal,
+    with the same output as TEIPostprocessor but without serializing the HTML
+    and parsing it again. Documents that this cannot do identically (e.g. ones
+    with raw HTML or entity references) are left to the TEIPostprocessor.
+    """
+
+    def __init__(self, md, indent=False, with_root=False):
+        self.indent = indent
+        self.with_root = with_root
+        self.output = None
+        Treeprocessor.__init__(self, md)
+
+    def _can_convert(self):
+        return (
+            self.md.htmlStash.html_counter == 0
+            and self.md.output_format == 'xhtml'
+            and all(
+                isinstance(pp, (RawHtmlPostprocessor, AndSubstitutePostprocessor, TEIPostprocessor))
+                for pp in self.md.postprocessors
+            )
+        )
+
+    def _convert(self, el, parent):
+        tag = el.tag
+        if not isinstance(tag, str) or tag in ('head', 'script', 'style') or ':' in tag or '{' in tag:
+            raise _Fallback
+        attrib = _check_attrib(el)
+
+        if tag == 'table':
+            new_el = self._convert_table(el, parent)
+        else:
+            new_tag, attribs = TAG_REPLACEMENTS.get(tag, (tag, {}))
+            new_attrib = {}
+            for key, value in attribs.items():
+                new_attrib[key] = attrib.pop(value[1:], '') if value.startswith('@') else value
+            attrib.update(new_attrib)
+            new_el = etree.SubElement(parent, new_tag, attrib)
+            if tag.lower() not in HTML_EMPTY:
+                new_el.text = _check_text(el.text)
+                for child in el:
+                    self._convert(child, new_el)
+        new_el.tail = _check_text(el.tail)
+
+    def _convert_cell(self, cell, row):
+        new_cell = etree.SubElement(row, 'cell', _check_attrib(cell))
+        new_cell.text = _check_text(cell.text)
+        for child in cell:
+            self._convert(child, new_cell)
+        new_cell.tail = _check_text(cell.tail)
+
+    def _convert_table(self, table, parent):
+        new_table = etree.SubElement(parent, 'table')
+
+        if any(child.tag == 'thead' for child in table):
+            row = etree.SubElement(new_table, 'row')
+            row.attrib['role'] = 'label'
+            for thead in table:
+                if thead.tag == 'thead':
+                    for cell in (cell for tr in thead if tr.tag == 'tr' for cell in tr if cell.tag == 'th'):
+                        self._convert_cell(cell, row)
+
+        for child in table:
+            if child.tag == 'thead':
+                continue
+            for table_row in child:
+                if table_row.tag == 'tr':
+                    row = etree.SubElement(new_table, 'row')
+                    for cell in table_row:
+                        if cell.tag == 'td':
+                            self._convert_cell(cell, row)
+
+        return new_table
+
+    def run(self, root):
+        self.output = None
+        if not self._can_convert():
+            return
+
+        tree = etree.Element(ROOT_TAG)
+        try:
+            for child in root:
+                self._convert(child, tree)
+            # like the markdown output, which is stripped before the postprocessors
+            if len(tree):
+                tree.text = _check_text((root.text or '').lstrip())
+                tree[-1].tail = _check_text((tree[-1].tail or '').rstrip())
+            else:
+                tree.text = _check_text((root.text or '').strip())
+        except (_Fallback, ValueError):
+            return
+
+        self.output = _serialize(tree, self.indent, self.with_root)
+        # nothing left to serialize for markdown
+        root.clear()
 
 
 class ToTEI(Extension):
@@ -135,14 +293,78 @@ class ToTEI(Extension):
     def __init__(self, **kwargs):
         self.config = {
             'indent': [False, ''],
-            'with_root': [False, '']
+            'with_root': [False, ''],
+            'engine': ['tree', "'tree' (TEITreeprocessor, falling back to TEIPostprocessor) or 'postprocessor'"],
         }
         Extension.__init__(self, **kwargs)
 
     def extendMarkdown(self, md):
         configs = self.getConfigs()
-        md.postprocessors.register(TEIPostprocessor(md, configs['indent'], configs['with_root']), 'to_tei', 0)
+        treeprocessor = None
+        if configs['engine'] == 'tree':
+            treeprocessor = TEITreeprocessor(md, configs['indent'], configs['with_root'])
+            # after all other treeprocessors, including unescape (0)
+            md.treeprocessors.register(treeprocessor, 'to_tei', -1)
+        md.postprocessors.register(
+            TEIPostprocessor(md, configs['indent'], configs['with_root'], treeprocessor), 'to_tei', 0
+        )
 
 
 def md2tei(text):
     return markdown(text, extensions=[ToTEI()])
+
+
+_local = threading.local()
+
+
+def _markdown():
+    """The Markdown instance with the ToTEI extension of the current thread"""
+    md = getattr(_local, 'md', None)
+    if md is None:
+        md = _local.md = Markdown(extensions=[ToTEI()])
+    return md
+
+
+def _convert(text):
+    try:
+        return _markdown().reset().convert(text)
+    except Exception as e:
+        return e
+
+
+def _convert_chunk(texts):
+    return [_convert(text) for text in texts]
+
+
+def _pool_results(texts, workers, chunksize):
+    from concurrent.futures import ProcessPoolExecutor
+
+    texts = iter(texts)
+    # Keep a bounded number of chunks in flight, and yield them in order
+    with ProcessPoolExecutor(workers) as executor:
+        pending = deque()
+        while True:
+            while len(pending) < 2 * workers:
+                chunk = list(islice(texts, chunksize))
+                if not chunk:
+                    break
+                pending.append(executor.submit(_convert_chunk, chunk))
+            if not pending:
+                return
+            yield from pending.popleft().result()
+
+
+def md2tei_many(texts, workers=1, chunksize=256, return_exceptions=True):
+    """
+    Convert an iterable of markdown texts to TEI like md2tei, yielding the
+    results in order. One Markdown instance is reused for all texts (per
+    thread or process), and with workers > 1 the texts are divided in chunks
+    over a pool of processes. If a text cannot be converted, the exception
+    (e.g. a TEIPostprocessorError) is yielded in place of its result, or raised
+    if return_exceptions is False.
+    """
+    results = _pool_results(texts, workers, chunksize) if workers > 1 else map(_convert, texts)
+    for result in results:
+        if isinstance(result, Exception) and not return_exceptions:
+            raise result
+        yield result
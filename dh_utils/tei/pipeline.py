@@ -0,0 +1,240 @@
+"""
+Process the TEI files of a corpus with several tools in a single parse: the
+stages (e.g. generating the refsDecl, tagging scripts and creating the
+critical apparatus versions) take the parsed tree of a file in a configured
+order, and the file is written once at the end (if a stage changed it).
+"""
+import argparse
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from os import path
+from typing import ClassVar, Dict, List, Optional, Union
+
+from lxml import etree
+from lxml.etree import ParseError
+
+from . import crit_app, refsdecl_generator
+from . import xml_io
+from .instrument import cli_profile, pool_map, stage
+from .tag_script import tag_script_tree
+
+
+@dataclass
+class RefsDecl:
+    """Replace the refsDecl by a generated one (refsdecl_generator --update)"""
+
+    name: ClassVar[str] = "refsdecl"
+    modifies: ClassVar[bool] = True
+
+    def __call__(self, tree, fname, consume=False):
+        if not refsdecl_generator.is_tei_xml(tree):
+            return None
+        element = refsdecl_generator.generate_refs_decl(tree, path=fname)
+        # the generated elements have no namespace, move them to the default
+        # namespace of the document as they would be when the file is parsed again
+        namespace = tree.getroot().nsmap.get(None)
+        if namespace:
+            for el in element.iter(etree.Element):
+                el.tag = f"{{{namespace}}}{el.tag}"
+        refsdecl_generator.set_refsdecl(tree, element)
+        return {"cRefPatterns": len(element)}
+
+
+@dataclass
+class TagScript:
+    """Tag scripts in the body (tag_script_from_file)"""
+
+    script: Union[None, str, List[str], Dict[str, str]] = None
+    language_code: str = ""
+
+    name: ClassVar[str] = "tag_script"
+    modifies: ClassVar[bool] = True
+
+    def __call__(self, tree, fname, consume=False):
+        tagged = tag_script_tree(tree, self.script, self.language_code)
+        # unchanged, so the file is not written for this stage
+        return {"tagged": tagged} if tagged else None
+
+
+@dataclass
+class CritApp:
+    """
+    Create the critical apparatus versions of editions with apps next to them
+    (crit_app.create), ca_ext is an extension or a mapping of app types to
+    extensions
+    """
+
+    ca_ext: Union[str, Dict[Optional[str], str]]
+    lang: str = ""
+    app_type: Optional[str] = None
+
+    name: ClassVar[str] = "crit_app"
+    modifies: ClassVar[bool] = False
+
+    @property
+    def outputs(self):
+        return self.ca_ext if isinstance(self.ca_ext, dict) else {self.app_type: self.ca_ext}
+
+    def __call__(self, tree, fname, consume=False):
+        try:
+            crit_app.parse_urn(fname)
+        except Exception:
+            return None
+        root = tree.getroot()
+        if next(root.iter("{*}app"), None) is None:
+            return None
+        # e.g. an apparatus version created by an earlier run with other extensions
+        if crit_app.is_critapp(root, f"{{{root.nsmap[None]}}}" if None in root.nsmap else ""):
+            return None
+        return crit_app.create_from_tree(
+            root, path.basename(fname), self.outputs, path.dirname(fname), self.lang, copy=not consume
+        )
+
+
+STAGES = {stage_.name: stage_ for stage_ in [RefsDecl, TagScript, CritApp]}
+
+
+@dataclass
+class PipelineResult:
+    path: str
+    # one of 'processed', 'skipped' or 'failed'
+    status: str
+    seconds: float
+    # the report of every stage that applied to the file (e.g. the report of crit_app.create)
+    reports: Dict[str, dict] = field(default_factory=dict)
+    error: Optional[str] = None
+
+
+def run_file(fname, stages):
+    """Parse fname once, apply the stages in order and write it if it changed"""
+    start = time.perf_counter()
+    try:
+        if not refsdecl_generator.has_tei_root(fname):
+            return PipelineResult(fname, "skipped", time.perf_counter() - start)
+        with stage("pipeline", "parse", fname):
+            tree = xml_io.parse(fname)
+    except (OSError, ParseError) as e:
+        return PipelineResult(fname, "failed", time.perf_counter() - start, error=f"Could not parse: {e}")
+
+    result = PipelineResult(fname, "processed", 0.0)
+    modified = False
+    try:
+        for i, stage_ in enumerate(stages):
+            if modified and not any(later.modifies for later in stages[i:]):
+                # the source is final, so the last stage can take elements out of the tree
+                with stage("pipeline", "write", fname):
+                    xml_io.write_tree(tree, fname)
+                modified = False
+            report = stage_(tree, fname, consume=i == len(stages) - 1)
+            if report is not None:
+                result.reports[stage_.name] = report
+                modified = modified or stage_.modifies
+        if modified:
+            with stage("pipeline", "write", fname):
+                xml_io.write_tree(tree, fname)
+    except Exception as e:
+        result.status, result.error = "failed", f"{type(e).__name__}: {e}"
+    result.seconds = time.perf_counter() - start
+    return result
+
+
+def find_files(corpus_dir, stages):
+    """The XML files in corpus_dir, except the files created by a CritApp stage"""
+    outputs = {ext for stage_ in stages if isinstance(stage_, CritApp) for ext in stage_.outputs.values()}
+    for fname in refsdecl_generator.xml_paths(corpus_dir):
+        try:
+            _, extension = crit_app.parse_urn(fname)
+        except Exception:
+            extension = None
+        if extension not in outputs:
+            yield fname
+
+
+def run(corpus_dir, stages, jobs=1):
+    """
+    Apply the stages (e.g. [RefsDecl(), TagScript(['Hebr', 'Cyrl']),
+    CritApp({'superior': 'appcrit1'})]) to every TEI file in corpus_dir (a
+    directory or a single file), divided over jobs processes. Returns a list
+    of PipelineResults, in order.
+    """
+    if path.isfile(corpus_dir):
+        fnames = [corpus_dir]
+    else:
+        fnames = list(find_files(corpus_dir, stages))
+    if jobs > 1 and len(fnames) > 1:
+        with ProcessPoolExecutor(jobs) as executor:
+            return list(pool_map(executor, run_file, fnames, [stages] * len(fnames)))
+    return [run_file(fname, stages) for fname in fnames]
+
+
+def print_report(results, file=sys.stdout):
+    for result in results:
+        print(f"{result.status:<9} {result.seconds:8.3f}s  {result.path}", file=file)
+        if result.error:
+            print(f"          {result.error}", file=file)
+    counts = {
+        status: sum(1 for result in results if result.status == status)
+        for status in ["processed", "skipped", "failed"]
+    }
+    total = sum(result.seconds for result in results)
+    print(", ".join(f"{n} {status}" for status, n in counts.items()) + f" ({total:.3f}s)", file=file)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Generate refsDecls, tag scripts and create critical apparatus "
+        "versions of all TEI files of a corpus, parsing every file once"
+    )
+    parser.add_argument("corpus_dir", help="Root directory of the corpus (or a single file)")
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=STAGES,
+        required=True,
+        help="Stages to apply, in this order",
+    )
+    parser.add_argument(
+        "--scripts",
+        nargs="*",
+        default=[],
+        help="tag_script: scripts to tag, optionally with a language code, "
+        "e.g. Cyrl=ov-Cyrs (default: all scripts)",
+    )
+    parser.add_argument(
+        "--outputs",
+        nargs="+",
+        default=["appcrit"],
+        help="crit_app: extension of the apparatus versions (e.g. appcrit1), or a "
+        "listApp type with extension (e.g. superior=appcrit1)",
+    )
+    parser.add_argument("--lang", default="", help="crit_app: language of the apparatus")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of processes")
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print the time and peak memory per stage (parse, match, etc.) at the end",
+    )
+    return parser.parse_args()
+
+
+def main(args):
+    outputs = {}
+    for output in args.outputs:
+        app_type, _, ca_ext = output.rpartition("=")
+        outputs[app_type or None] = ca_ext
+    options = {
+        "refsdecl": RefsDecl(),
+        "tag_script": TagScript(dict(script.partition("=")[::2] for script in args.scripts) or None),
+        "crit_app": CritApp(outputs, args.lang),
+    }
+    stages = [options[name] for name in args.stages]
+    with cli_profile(args.profile):
+        results = run(args.corpus_dir, stages, args.jobs)
+        print_report(results)
+    return int(any(result.status == "failed" for result in results))
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args()))
@@ -1,5 +1,7 @@
 import logging
 import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import contextmanager
 from copy import copy
 from dataclasses import dataclass
@@ -10,13 +12,24 @@ import argparse
 from lxml import etree
 from anytree import Node, LevelOrderGroupIter, RenderTree
 from lxml.etree import Element, dump, ParseError
-from typing import List
+from typing import List, Optional
+
+from . import xml_io
+from .instrument import cli_profile, pool_map, stage
+
+logger = logging.getLogger(__name__)
 
 TEI_XPATH = "/tei:TEI/"
 CTS_VERSION_XPATH = "tei:text/tei:body/tei:div[@type][@n]"
 CTS_TEXTPART_XPATHS = ["tei:div[@type][@n]", "tei:l[@n]", "tei:ab/tei:l[@n]"]
 NSMAP = {"tei": "http://www.tei-c.org/ns/1.0"}
 
+TEI_TEXT = f"{{{NSMAP['tei']}}}text"
+TEI_BODY = f"{{{NSMAP['tei']}}}body"
+TEI_DIV = f"{{{NSMAP['tei']}}}div"
+TEI_L = f"{{{NSMAP['tei']}}}l"
+TEI_AB = f"{{{NSMAP['tei']}}}ab"
+
 
 class RefNode(Node):
     element: Element
@@ -36,6 +49,14 @@ class TextpartPath:
     type: str
 
 
+@dataclass
+class FileResult:
+    path: str
+    status: str  # "generated", "updated", "skipped" or "failed"
+    refs_decl: Optional[bytes] = None
+    error: Optional[str] = None
+
+
 def is_textpart(node):
     return isinstance(node, TextpartNode)
 
@@ -111,15 +132,189 @@ def textpart_paths(tree):
         yield TextpartPath(segments=segments, type=type_)
 
 
+def child_textparts(el):
+    """Same as find_textparts, but matching the tags of the children directly"""
+    divs, lines, ab_lines = [], [], []
+    for child in el:
+        tag = child.tag
+        if tag == TEI_DIV:
+            if child.get("type") is not None and child.get("n") is not None:
+                divs.append((CTS_TEXTPART_XPATHS[0], child))
+        elif tag == TEI_L:
+            if child.get("n") is not None:
+                lines.append((CTS_TEXTPART_XPATHS[1], child))
+        elif tag == TEI_AB:
+            ab_lines.extend(
+                (CTS_TEXTPART_XPATHS[2], l) for l in child if l.tag == TEI_L and l.get("n") is not None
+            )
+    return divs + lines + ab_lines
+
+
+def structure_levels(el):
+    """
+    Compact alternative to textpart_levels(build_ref_tree(el)) that only keeps the
+    (xpath_match, subtype) of the first textpart at every depth, without building
+    a node per textpart. The first textpart at a depth in level order is also
+    the first one at that depth in document (depth-first) order, so a single
+    depth-first walk with a stack of child iterators suffices.
+    """
+    levels = []
+    stack = [iter(findall(el, f"./{CTS_VERSION_XPATH}"))]
+    while stack:
+        child = next(stack[-1], None)
+        if child is None:
+            stack.pop()
+            continue
+        textparts = child_textparts(child)
+        if textparts:
+            if len(stack) > len(levels):
+                xpath_match, element = textparts[0]
+                levels.append((xpath_match, element.attrib.get("subtype") or "line"))
+            stack.append(element for _, element in textparts)
+    return levels
+
+
+def structure_paths(el):
+    """Same as textpart_paths(build_ref_tree(el)), using structure_levels"""
+    return paths_from_levels(structure_levels(el))
+
+
+def paths_from_levels(levels):
+    for depth in range(1, len(levels) + 1):
+        yield TextpartPath(
+            segments=[
+                xpath_match.replace("[@n]", f"[@n='${i}']")
+                for i, (xpath_match, _) in enumerate(levels[:depth], start=1)
+            ],
+            type=levels[depth - 1][1],
+        )
+
+
+def _merge_levels(levels, sub_levels):
+    """Extend levels with the levels of a later subtree that reach deeper"""
+    levels.extend(sub_levels[len(levels):])
+
+
+class _StreamEntry:
+    __slots__ = ("kind", "parent", "textpart", "buckets")
+
+    def __init__(self, kind, parent=None, textpart=None):
+        self.kind = kind
+        self.parent = parent  # the version or textpart whose bucket this textpart ends up in
+        self.textpart = textpart  # (bucket, xpath_match, subtype)
+        self.buckets = None  # levels of the children in the three find_textparts buckets
+
+    def levels(self):
+        if self.buckets is None:
+            return []
+        divs, lines, ab_lines = self.buckets
+        levels = list(divs)
+        _merge_levels(levels, lines)
+        _merge_levels(levels, ab_lines)
+        return levels
+
+
+# elements that are not part of the reference structure, at the top of such a
+# subtree and inside it
+_IGNORED_TOP = _StreamEntry(None)
+_IGNORED = _StreamEntry(None)
+
+
+def stream_structure_levels(path, verify=False):
+    """
+    Same as structure_levels(root), but using iterparse so that only the tags
+    and attributes of the open elements are kept in memory. Unless verify is
+    given, reading stops when the first div textpart of the first version has
+    ended, assuming that it shows the complete textpart pattern. Divs take
+    precedence over l and ab/l textparts (see find_textparts), so when an l or
+    ab/l textpart comes first, the whole file is scanned. Returns None if the
+    root element is not in the TEI namespace.
+    """
+    # the levels of every textpart's children are collected per bucket (the
+    # order of find_textparts), so the first textpart at every depth is found
+    # without keeping the children themselves
+    work, stack, first_version, tei_descendant = [], [], None, False
+    context = etree.iterparse(str(path), events=("start", "end"), huge_tree=True)
+    for event, element in context:
+        if event == "start":
+            if not stack:
+                if etree.QName(element).namespace != NSMAP["tei"]:
+                    return None
+                stack.append(_StreamEntry("root"))
+                continue
+            parent, tag, attrib = stack[-1], element.tag, element.attrib
+            if not tei_descendant:
+                tei_descendant = etree.QName(element).namespace == NSMAP["tei"]
+            kind = textpart = owner = None
+            if parent.kind == "root" and tag == TEI_TEXT:
+                kind = "text"
+            elif parent.kind == "text" and tag == TEI_BODY:
+                kind = "body"
+            elif parent.kind == "body" and tag == TEI_DIV and "type" in attrib and "n" in attrib:
+                kind = "version"
+            elif parent.kind in ("version", "textpart"):
+                if tag == TEI_DIV and "type" in attrib and "n" in attrib:
+                    kind, owner, textpart = "textpart", parent, 0
+                elif tag == TEI_L and "n" in attrib:
+                    kind, owner, textpart = "textpart", parent, 1
+                elif tag == TEI_AB:
+                    kind, owner = "ab", parent
+            elif parent.kind == "ab" and tag == TEI_L and "n" in attrib:
+                kind, owner, textpart = "textpart", parent.parent, 2
+            if kind is None:
+                stack.append(_IGNORED if parent.kind is None else _IGNORED_TOP)
+                continue
+            if textpart is not None:
+                textpart = (
+                    textpart,
+                    CTS_TEXTPART_XPATHS[textpart],
+                    attrib.get("subtype") or "line",
+                )
+            stack.append(_StreamEntry(kind, owner, textpart))
+            if kind == "version" and first_version is None:
+                first_version = stack[-1]
+            continue
+
+        entry = stack.pop()
+        if entry is _IGNORED:
+            # cleared together with the top of the subtree
+            continue
+        if entry.kind == "textpart":
+            bucket, xpath_match, subtype = entry.textpart
+            owner = entry.parent
+            if owner.buckets is None:
+                owner.buckets = ([], [], [])
+            levels = owner.buckets[bucket]
+            if not levels:
+                levels.append((xpath_match, subtype))
+            if entry.buckets is not None:
+                # the levels of this textpart start one level deeper
+                levels.extend(entry.levels()[len(levels) - 1:])
+            if not verify and owner is first_version and bucket == 0:
+                _merge_levels(work, first_version.levels())
+                break
+        elif entry.kind == "version":
+            _merge_levels(work, entry.levels())
+        # free the parsed content
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+    return work if tei_descendant else None
+
+
 def debug_tree(tree):
     for pre, fill, node in RenderTree(tree):
         print("%s%s" % (pre, node.name))
 
 
 def build_refs_decl(tree, path_root):
+    return refs_decl_from_paths(textpart_paths(tree), path_root)
+
+
+def refs_decl_from_paths(paths, path_root):
     element = etree.Element("refsDecl", {"n": "CTS"})
 
-    for path in reversed([path for path in textpart_paths(tree)]):
+    for path in reversed(list(paths)):
         attrib = {
             "n": path.type,
             "matchPattern": r"\.".join([r"(\w+)"] * len(path.segments)),
@@ -130,7 +325,8 @@ def build_refs_decl(tree, path_root):
     return element
 
 
-def update_refsdecl(tree, refs_decl, path):
+def set_refsdecl(tree, refs_decl):
+    """Replace the refsDecl of tree by refs_decl, without writing it"""
     encoding_desc = tree.find("//tei:encodingDesc", NSMAP)
     if encoding_desc is None:
         raise Exception("Missing enveloping element 'encodingDesc'")
@@ -141,25 +337,27 @@ def update_refsdecl(tree, refs_decl, path):
 
     encoding_desc.append(refs_decl)
 
-    with open(path, "wb") as writer:
-        tree.write(writer, encoding="utf-8")
+
+def update_refsdecl(tree, refs_decl, path):
+    set_refsdecl(tree, refs_decl)
+    xml_io.write_tree(tree, path)
 
 
 @contextmanager
 def read_xml(path):
-    with open(path, "rb") as reader:
-        try:
-            root_node = etree.fromstring(reader.read())
-            yield etree.ElementTree(root_node)
-        except ParseError as e:
-            logging.exception(Exception(f"Could not parse: {path}", e))
-            yield etree.ElementTree()
+    try:
+        tree = xml_io.parse(path)
+    except ParseError as e:
+        logger.exception(Exception(f"Could not parse: {path}", e))
+        tree = etree.ElementTree()
+    yield tree
 
 
 def xml_paths(path):
     for subdir, dirs, files in os.walk(path):
+        dirs.sort()
         yield from (
-            os.path.join(subdir, file) for file in files if file.endswith(".xml")
+            os.path.join(subdir, file) for file in sorted(files) if file.endswith(".xml")
         )
 
 
@@ -167,36 +365,143 @@ def is_tei_xml(tree):
     return tree.getroot() is not None and tree.find("//tei:*", NSMAP) is not None
 
 
-def generate_for_file(path, update):
-    with read_xml(path) as tree:
-        # filter out all non-tei files
-        if not is_tei_xml(tree):
-            return
-
-        element = build_refs_decl(
-            tree=build_ref_tree(el=tree.getroot()),
-            path_root=os.path.join(TEI_XPATH, CTS_VERSION_XPATH),
-        )
-
+def has_tei_root(path):
+    """Check whether the root element is in the TEI namespace, without parsing the whole file"""
+    for _, element in etree.iterparse(str(path), events=("start",)):
+        return etree.QName(element).namespace == NSMAP["tei"]
+    return False
+
+
+def generate_refs_decl(tree, compact=True, path=None):
+    """
+    Generate the refsDecl of a parsed TEI document (see process_file for
+    compact), path is only used in the stage events
+    """
+    path_root = os.path.join(TEI_XPATH, CTS_VERSION_XPATH)
+    if compact:
+        with stage("refsdecl", "match", path) as stage_:
+            paths = list(structure_paths(tree.getroot()))
+            stage_.count = len(paths)
+        with stage("refsdecl", "build", path):
+            return refs_decl_from_paths(paths, path_root)
+    with stage("refsdecl", "match", path):
+        ref_tree = build_ref_tree(el=tree.getroot())
+    with stage("refsdecl", "build", path):
+        return build_refs_decl(tree=ref_tree, path_root=path_root)
+
+
+def process_file(path, update, compact=True, stream=False, verify=False):
+    """
+    Generate (and optionally update) the refsDecl of a single file, with the
+    refsDecl serialized. With compact, the refsDecl is derived using
+    structure_paths instead of building the full reference tree. With stream
+    (ignored when updating), the file is not parsed into a tree at all, but
+    scanned using stream_structure_levels (see there for verify).
+    """
+    path_root = os.path.join(TEI_XPATH, CTS_VERSION_XPATH)
+    if stream and not update:
+        try:
+            with stage("refsdecl", "scan", path):
+                levels = stream_structure_levels(path, verify)
+        except (OSError, ParseError) as e:
+            return FileResult(str(path), "failed", error=f"Could not parse: {e}")
+        if levels is None:
+            return FileResult(str(path), "skipped")
+        with stage("refsdecl", "build", path):
+            element = refs_decl_from_paths(paths_from_levels(levels), path_root)
+        with stage("refsdecl", "serialize", path):
+            refs_decl = etree.tostring(element)
+        return FileResult(str(path), "generated", refs_decl=refs_decl)
+
+    try:
+        with stage("refsdecl", "parse", path):
+            # filter out all non-tei files before parsing them completely
+            if not has_tei_root(path):
+                return FileResult(str(path), "skipped")
+            tree = xml_io.parse(path)
+    except (OSError, ParseError) as e:
+        return FileResult(str(path), "failed", error=f"Could not parse: {e}")
+
+    if not is_tei_xml(tree):
+        return FileResult(str(path), "skipped")
+
+    try:
+        element = generate_refs_decl(tree, compact, path)
         if update:
-            update_refsdecl(tree, element, path)
-            print(f"Succesfully updated {path}")
+            with stage("refsdecl", "write", path):
+                update_refsdecl(tree, element, path)
+    except Exception as e:
+        return FileResult(str(path), "failed", error=str(e))
 
-        return element
+    with stage("refsdecl", "serialize", path):
+        refs_decl = etree.tostring(element)
+    return FileResult(str(path), "updated" if update else "generated", refs_decl=refs_decl)
 
 
-def generate_for_path(path, update):
+def generate_for_file(path, update):
+    result = process_file(path, update)
+    if result.status == "failed":
+        logger.error(f"{result.path}: {result.error}")
+    if result.refs_decl is not None:
+        return etree.fromstring(result.refs_decl)
+
+
+def process_path(path, update, jobs=1, stream=False, verify=False):
+    """
+    Yield a FileResult for every xml file in path (in order), divided over jobs
+    processes (see process_file for stream and verify)
+    """
     path_ = Path(path)
-    for path_ in ([path_] if path_.is_file() else xml_paths(path_)):
-        element = generate_for_file(path_, update)
-        if element is not None:
-            yield element
+    paths = [path_] if path_.is_file() else list(xml_paths(path_))
+
+    if jobs > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(jobs) as executor:
+            yield from pool_map(
+                executor,
+                process_file,
+                paths,
+                [update] * len(paths),
+                [True] * len(paths),
+                [stream] * len(paths),
+                [verify] * len(paths),
+                chunksize=max(1, len(paths) // (4 * jobs)),
+            )
+    else:
+        yield from (process_file(path_, update, stream=stream, verify=verify) for path_ in paths)
+
+
+def generate_for_path(path, update, jobs=1, stream=False, verify=False):
+    for result in process_path(path, update, jobs, stream, verify):
+        if result.refs_decl is not None:
+            yield etree.fromstring(result.refs_decl)
+
+
+def print_summary(results, file=sys.stderr):
+    for result in results:
+        if result.status == "failed":
+            print(f"failed    {result.path}: {result.error}", file=file)
+    counts = {
+        status: sum(1 for result in results if result.status == status)
+        for status in ["generated", "updated", "skipped", "failed"]
+    }
+    print(", ".join(f"{n} {status}" for status, n in counts.items() if n), file=file)
 
 
 def generate(args):
-    for refsdecl in generate_for_path(path=args.path, update=args.update):
-        if not args.update:
-            dump(refsdecl)
+    logging.basicConfig(format="%(message)s", level=logging.INFO)
+    results = []
+    with cli_profile(args.profile):
+        for result in process_path(
+            path=args.path, update=args.update, jobs=args.jobs, stream=args.stream, verify=args.verify
+        ):
+            results.append(result)
+            if result.status == "updated":
+                logger.info(f"Succesfully updated {result.path}")
+            elif result.refs_decl is not None:
+                dump(etree.fromstring(result.refs_decl))
+
+        print_summary(results)
+    return int(any(result.status == "failed" for result in results))
 
 
 def parse_args():
@@ -209,8 +514,29 @@ def parse_args():
         action="store_true",
         help="Updates the file with the newly generated refsDecl",
     )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of processes to divide the files over",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Scan the structure of the files with little memory (not with --update)",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="With --stream, scan the whole file instead of only the first div textpart",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print the time and peak memory per stage (parse, match, etc.) at the end",
+    )
     return parser.parse_args()
 
 
 if __name__ == "__main__":
-    generate(args=parse_args())
+    sys.exit(generate(args=parse_args()))
@@ -1,9 +1,18 @@
-import regex
+import os
+import sys
+import re
 from lxml import etree
 from os import path
-from xml.sax.saxutils import unescape, escape
+from bisect import bisect_right
+from collections import Counter
+from functools import lru_cache
 
-__all__ = ['LanguageNotSupported', 'tag_script', 'tag_script_from_file']
+from . import manifest
+from .instrument import cli_profile, stage
+from .xml_io import atomic_open, file_hash, mapped, parse, write_tree
+
+__all__ = ['LanguageNotSupported', 'tag_script', 'tag_script_from_file', 'tag_script_stream',
+           'detect_scripts', 'AVAILABLE_SCRIPTS', 'DEFAULT_LCS']
 
 class LanguageNotSupported(Exception):
     pass
@@ -36,8 +45,6 @@ RE_STR = {
 # Language specific additions
 RE_STR['Latn'] = '(?<!&#?[a-zA-Z0-9]*)' + RE_STR['Latn'] # Avoid escaped xml chars
 
-RE = {script: regex.compile(RE_STR[script]) for script in RANGE.keys()}
-
 DEFAULT_LCS = {
     'Arab': 'ar-Arab',
     'Copt': 'cop-Copt',
@@ -48,57 +55,512 @@ DEFAULT_LCS = {
 
 AVAILABLE_SCRIPTS = list(DEFAULT_LCS.keys())
 
-def tag_script(string, script, language_code = '', escape_xml = True):
+# Like escape and unescape of xml.sax.saxutils, which imports urllib
+def escape(data):
+    return data.replace('&', '&amp;').replace('>', '&gt;').replace('<', '&lt;')
+
+def unescape(data):
+    return data.replace('&lt;', '<').replace('&gt;', '>').replace('&amp;', '&')
+
+def _class_ranges(char_class):
+    """ Codepoint ranges (first, last) of a regex character class like 'a-z0-9' """
+    ranges, i = [], 0
+    while i < len(char_class):
+        if char_class[i + 1:i + 2] == '-' and i + 2 < len(char_class):
+            ranges.append((ord(char_class[i]), ord(char_class[i + 2])))
+            i += 3
+        else:
+            ranges.append((ord(char_class[i]), ord(char_class[i])))
+            i += 1
+    return ranges
+
+# Sorted, non-overlapping codepoint ranges (first, last, script) of the letters
+# of each script. Combining characters and punctuation are left out, since
+# several scripts share them.
+SCRIPT_RANGES = sorted(
+    (first, last, script) for script in RANGE for first, last in _class_ranges(RANGE[script])
+)
+_RANGE_STARTS = [first for first, _, _ in SCRIPT_RANGES]
+
+def script_of(char):
+    """ Script of a character, or None if it doesn't belong to (the letters of) any script """
+    i = bisect_right(_RANGE_STARTS, ord(char)) - 1
+    if i >= 0 and ord(char) <= SCRIPT_RANGES[i][1]:
+        return SCRIPT_RANGES[i][2]
+    return None
+
+@lru_cache(maxsize=None)
+def _script_table():
+    """
+    Dense lookup table for str.translate that maps every character in the BMP
+    to the index of its script in AVAILABLE_SCRIPTS (as a character), or to
+    '\x00' if it has no script. Characters outside the BMP are left as is.
+    """
+    table = ['\x00'] * 0x10000
+    for first, last, script in SCRIPT_RANGES:
+        table[first:last + 1] = [chr(AVAILABLE_SCRIPTS.index(script) + 1)] * (last - first + 1)
+    return table
+
+@lru_cache(maxsize=None)
+def _re_script_span():
+    """
+    Pattern for the output of text.translate(_script_table()), matching a run of
+    characters of one script, possibly with characters of no script in between
+    """
+    codes = [chr(i) for i in range(1, len(AVAILABLE_SCRIPTS) + 1)]
+    # Plain re is considerably faster than regex for this pattern
+    return re.compile('|'.join(
+        f'{code}(?:[^{"".join(c for c in codes if c != code)}]*{code})?' for code in codes
+    ))
+
+def _script_counts(translated):
+    counts = Counter()
+    for i, script in enumerate(AVAILABLE_SCRIPTS, start=1):
+        n = translated.count(chr(i))
+        if n:
+            counts[script] = n
+    return counts
+
+def detect_scripts(text):
+    """
+    Scripts in text, in a single scan. Returns a list of spans (script, start,
+    end), where a span is a maximal run of letters of the same script together
+    with the characters of no script in between, and a Counter with the number
+    of letters of each script.
+    """
+    translated = text.translate(_script_table())
+    spans = [
+        (AVAILABLE_SCRIPTS[ord(match.group()[0]) - 1], match.start(), match.end())
+        for match in _re_script_span().finditer(translated)
+    ]
+    return spans, _script_counts(translated)
+
+def language_codes(script = None, language_code = ''):
+    """
+    Mapping of scripts to language codes, from a single script (optionally with
+    language_code), a list of scripts or a mapping of scripts to language codes.
+    If script is None, all available scripts are used. Empty language codes are
+    replaced by the defaults in DEFAULT_LCS.
+    """
+    if script is None:
+        codes = dict.fromkeys(AVAILABLE_SCRIPTS, '')
+    elif isinstance(script, str):
+        codes = {script: language_code}
+    elif isinstance(script, dict):
+        codes = dict(script)
+    else:
+        codes = dict.fromkeys(script, '')
+    for script_ in codes:
+        if script_ not in AVAILABLE_SCRIPTS:
+            raise LanguageNotSupported(
+                f'Language "{script_}" not (yet) supported, please use one of: '
+                + ', '.join(AVAILABLE_SCRIPTS)
+            )
+        codes[script_] = codes[script_] or DEFAULT_LCS[script_]
+    return codes
+
+@lru_cache(maxsize=None)
+def combined_re(scripts, trailing_markers=None):
+    """
+    Single pattern matching runs of any of the given scripts, the script of a
+    match is given by match.lastgroup. A run starts with a character of
+    RANGE[script], so runs of different scripts never start at the same
+    position. Combining characters and punctuation that are shared between
+    scripts (e.g. U+0301 in Copt and Cyrl) belong to the run they follow, while
+    direction markers belong to the run they precede. Only when a single script
+    is tagged, runs keep trailing direction markers (the original RE_STR), which
+    can be forced using trailing_markers.
+    """
+    if trailing_markers is None:
+        trailing_markers = len(scripts) == 1
+    import regex
+
+    end = '' if trailing_markers else fr'(?<![{DIRECTION_MARKERS}])'
+    return regex.compile('|'.join(f'(?P<{script}>{RE_STR[script]}{end})' for script in scripts))
+
+def _present_codes(codes, text):
+    """ Restrict codes to the scripts that occur in text, returns these and their pattern """
+    counts = _script_counts(text.translate(_script_table()))
+    present = {script: code for script, code in codes.items() if counts[script]}
+    return present, combined_re(tuple(present), len(codes) == 1) if present else None
+
+def tag_script(string, script = None, language_code = '', escape_xml = True):
+    """
+    Tag one or more scripts in string. script is a single script, a list of
+    scripts or a mapping of scripts to language codes. If script is None, all
+    scripts that occur in string are tagged.
+    """
     if escape_xml:
         string = escape(string)
-    if script not in AVAILABLE_SCRIPTS:
-        raise LanguageNotSupported(
-            f'Language "{script}" not (yet) supported, please use one of: '
-            + ', '.join(AVAILABLE_SCRIPTS)
-        )
-    if not language_code:
-        language_code = DEFAULT_LCS[script]
-    return RE[script].sub(
-        f'<foreign xml:lang="{language_code}">\g<0></foreign>', string
+    codes, pattern = _present_codes(language_codes(script, language_code), string)
+    if not codes:
+        return string
+    return pattern.sub(
+        lambda match: f'<foreign xml:lang="{codes[match.lastgroup]}">{match.group()}</foreign>',
+        string
     )
 
 XML_NS = '{http://www.w3.org/XML/1998/namespace}'
 
-def tag_script_from_file(fname, script, language_code = ''):
-    if not language_code:
-        language_code = DEFAULT_LCS[script]
-    tree = etree.parse(fname)
+def _tag_text(text, pattern, codes, lang, tag='foreign'):
+    """
+    Tag the matches of pattern in text that are not already in language lang.
+    Returns the text before the first match and a list of <foreign> elements,
+    whose tails contain the text in between.
+    """
+    escaped = escape(text) # Patterns expect escaped XML, see RE_STR['Latn']
+    head, elements, last = text, [], 0
+    for match in pattern.finditer(escaped):
+        code = codes[match.lastgroup]
+        if lang == code:
+            continue
+        in_between = unescape(escaped[last:match.start()]) or None
+        if elements:
+            elements[-1].tail = in_between
+        else:
+            head = in_between
+        element = etree.Element(tag, {f'{XML_NS}lang': code})
+        element.text = unescape(match.group())
+        elements.append(element)
+        last = match.end()
+    if elements:
+        elements[-1].tail = unescape(escaped[last:]) or None
+    return head, elements
+
+def _tag_tree(el, pattern, codes, lang, tag='foreign'):
+    """
+    Tag all text in el recursively, lang is the language inherited from its
+    ancestors. Returns the number of runs tagged.
+    """
+    lang = el.get(f'{XML_NS}lang', lang)
+    children = list(el)
+    tagged = 0
+    if el.text:
+        el.text, elements = _tag_text(el.text, pattern, codes, lang, tag)
+        for i, element in enumerate(elements):
+            el.insert(i, element)
+        tagged += len(elements)
+    for child in children:
+        if isinstance(child.tag, str):
+            tagged += _tag_tree(child, pattern, codes, lang, tag)
+        if child.tail:
+            child.tail, elements = _tag_text(child.tail, pattern, codes, lang, tag)
+            for element in reversed(elements):
+                child.addnext(element)
+            tagged += len(elements)
+    return tagged
+
+def tag_script_tree(tree, script = None, language_code = ''):
+    """
+    Tag one or more scripts in the body of a parsed TEI XML document, in place
+    (see tag_script_from_file). Returns the number of runs tagged.
+    """
+    codes = language_codes(script, language_code)
     root = tree.getroot()
     NS = f'{{{root.nsmap[None]}}}' if None in root.nsmap.keys() else ''
-    for string in etree.ETXPath(f'//{NS}body//text()')(root):
-        parent = string.getparent()
-        new_content = escape(str(string))
-        # Check first if first ancestor with xml:lang doesn't already declares
-        # the language code to be inserted
-        if string.is_text:
-            lang_parent = parent.xpath(f'ancestor-or-self::*[@xml:lang][1]')
-        elif string.is_tail:
-            lang_parent = parent.xpath(f'ancestor::*[@xml:lang][1]')
-
-        if (not lang_parent) or (lang_parent[0].attrib[f'{XML_NS}lang'] != language_code):
-            new_content = tag_script(new_content, script, language_code, escape_xml = False)
-
-        # Create XML tree from tagged content and append to existing tree
-        try:
-            new_xml_root = etree.fromstring(f'<root>{new_content}</root>')
-        except etree.XMLSyntaxError:
-            raise Exception(new_content)
-
-        if string.is_text:
-            parent.text = new_xml_root.text
-            for i,el in enumerate(new_xml_root.getchildren()):
-                parent.insert(i, el)
-        elif string.is_tail:
-            parent.tail = new_xml_root.text
-            grandparent = parent.getparent()
-            i_parent = grandparent.index(parent)
-            for i,el in enumerate(new_xml_root.getchildren()):
-                grandparent.insert(i_parent + 1 + i, el)
-
-    with open(fname, 'w', encoding = 'utf-8') as f:
-        f.write(etree.tostring(tree, encoding = 'unicode'))
+    tagged = 0
+    with stage('tag_script', 'match', tree.docinfo.URL) as stage_:
+        bodies = etree.ETXPath(f'//{NS}body[not(ancestor::{NS}body)]')(root)
+        codes, pattern = _present_codes(codes, ''.join(''.join(body.itertext()) for body in bodies))
+        for body in bodies if codes else []:
+            lang = body.xpath('ancestor::*[@xml:lang][1]/@xml:lang')
+            tagged += _tag_tree(body, pattern, codes, lang[0] if lang else None, f'{NS}foreign')
+        stage_.count = tagged
+    return tagged
+
+def tag_script_from_file(fname, script = None, language_code = ''):
+    """
+    Tag one or more scripts in the body of a TEI XML file, in a single pass
+    (NB: file will be overwritten!). See tag_script for the script argument,
+    scripts that do not occur in the body are skipped.
+    """
+    with stage('tag_script', 'parse', fname):
+        tree = parse(fname)
+    tag_script_tree(tree, script, language_code)
+
+    with stage('tag_script', 'write', fname):
+        write_tree(tree, fname, xml_declaration = False)
+
+# Elements that are opened and closed separately while streaming, all other
+# elements (e.g. <teiHeader>, or <p> and <l> in the body) are handled as a whole
+CONTAINERS = ['TEI', 'teiCorpus', 'text', 'group', 'body']
+BODY_CONTAINERS = ['div']
+
+def _local_name(el):
+    return etree.QName(el).localname if isinstance(el.tag, str) else None
+
+def _xmlfile_attrib(el):
+    # etree.xmlfile doesn't know the xml prefix and would declare a new one
+    return {key.replace(XML_NS, 'xml:'): value for key, value in el.attrib.items()}
+
+def _new_namespaces(el, parent_nsmap):
+    """ Namespaces of el that are not yet declared in parent_nsmap """
+    return {k: v for k, v in el.nsmap.items() if v not in parent_nsmap.values()}
+
+def _write_node(xf, node, parent_nsmap):
+    """
+    Write node and its tail to xf. Unlike xf.write(node), namespaces that are
+    already declared by the enclosing elements are not declared again.
+    """
+    if isinstance(node.tag, str):
+        nsmap = _new_namespaces(node, parent_nsmap)
+        with xf.element(node.tag, _xmlfile_attrib(node), nsmap=nsmap):
+            if node.text:
+                xf.write(node.text)
+            for child in node:
+                _write_node(xf, child, node.nsmap)
+    else:
+        tail, node.tail = node.tail, None
+        xf.write(node)
+        node.tail = tail
+    if node.tail:
+        xf.write(node.tail)
+
+class _StreamTagger:
+    """ Writes a TEI file while it is parsed, tagging the body one child at a time """
+
+    def __init__(self, xf, pattern, codes, tag):
+        self.xf = xf
+        self.pattern = pattern
+        self.codes = codes
+        self.tag = tag
+        # Opened containers, as lists [element, context manager, lang, in_body, text_written]
+        self.containers = []
+        # Last child of the innermost container that is waiting for its tail,
+        # as a tuple (node, written)
+        self.pending = None
+        self.depth = 0
+        # Comments and processing instructions after the root element, these
+        # cannot be written by etree.xmlfile
+        self.trailing = []
+        self.root_closed = False
+
+    def nsmap(self):
+        return self.containers[-1][0].nsmap if self.containers else {}
+
+    def write_tagged(self, text, lang):
+        head, elements = _tag_text(text, self.pattern, self.codes, lang, self.tag)
+        if head:
+            self.xf.write(head)
+        for element in elements:
+            _write_node(self.xf, element, self.nsmap())
+
+    def write_text(self):
+        """ Write the text of the innermost container, before its first child """
+        container = self.containers[-1] if self.containers else None
+        if container and not container[4]:
+            el, _, lang, in_body, _ = container
+            if el.text and in_body:
+                self.write_tagged(el.text, lang)
+            elif el.text:
+                self.xf.write(el.text)
+            container[4] = True
+
+    def flush(self):
+        """ Write the pending child of the innermost container, now that its tail is known """
+        if self.pending is None:
+            return
+        (node, written), self.pending = self.pending, None
+        lang, in_body = self.containers[-1][2:4] if self.containers else (None, False)
+        tail, node.tail = node.tail, None
+        if not written:
+            if in_body and isinstance(node.tag, str):
+                _tag_tree(node, self.pattern, self.codes, lang, self.tag)
+            _write_node(self.xf, node, self.nsmap())
+        if tail and in_body:
+            self.write_tagged(tail, lang)
+        elif tail:
+            self.xf.write(tail)
+
+        # Free the memory of the written node. Removing a large subtree (e.g.
+        # <back>) as a whole takes quadratic time in lxml, clearing it first not
+        parent = node.getparent()
+        if parent is not None:
+            if isinstance(node.tag, str):
+                node.clear()
+            parent.remove(node)
+
+    def start(self, el):
+        if self.depth == len(self.containers):
+            self.write_text()
+            self.flush()
+            name = _local_name(el)
+            in_body = bool(self.containers) and self.containers[-1][3]
+            if name in (BODY_CONTAINERS if in_body else CONTAINERS):
+                parent_lang = self.containers[-1][2] if self.containers else None
+                nsmap = _new_namespaces(el, self.nsmap())
+                manager = self.xf.element(el.tag, _xmlfile_attrib(el), nsmap=nsmap)
+                manager.__enter__()
+                lang = el.get(f'{XML_NS}lang', parent_lang)
+                self.containers.append([el, manager, lang, in_body or name == 'body', False])
+        self.depth += 1
+
+    def end(self, el):
+        self.depth -= 1
+        if self.containers and el is self.containers[-1][0]:
+            self.write_text()
+            self.flush()
+            self.containers.pop()[1].__exit__(None, None, None)
+            # The tail of a container is written by its parent
+            self.pending = (el, True)
+            self.root_closed = not self.containers
+        elif self.depth == len(self.containers):
+            self.pending = (el, False)
+
+    def leaf(self, node):
+        """ Comments and processing instructions """
+        if self.root_closed:
+            self.trailing.append(node)
+        elif self.depth == len(self.containers):
+            self.write_text()
+            self.flush()
+            self.pending = (node, False)
+
+def tag_script_stream(fname, script = None, language_code = '', output = ''):
+    """
+    Like tag_script_from_file, but written while the file is parsed, one child
+    of <body> at a time, so that memory usage does not depend on the file size.
+    The result is written to output (default: fname) through a temporary file
+    that is renamed when done, so fname is never left half-written.
+    """
+    codes = language_codes(script, language_code)
+    pattern = combined_re(tuple(codes))
+    output = output or fname
+    with stage('tag_script', 'stream', fname):
+        _tag_stream(fname, codes, pattern, output)
+
+# The nodes before the root element: the XML declaration (1), comments and
+# processing instructions (2) and the doctype (3)
+RE_PROLOG = re.compile(
+    rb'\s*(?:(<\?xml\s.*?\?>)|(<\?.*?\?>|<!--.*?-->)'
+    rb'|(<!DOCTYPE\s(?:[^\[>"\']|"[^"]*"|\'[^\']*\')*(?:\[.*?\]\s*)?>))',
+    re.S
+)
+
+def _find_doctype(fname):
+    """
+    The doctype of fname as in the source (with its internal subset) and the
+    number of comments and processing instructions before it, or (None, 0)
+    """
+    position, pos = 0, 0
+    with mapped(fname) as data:
+        if data[:3] == b'\xef\xbb\xbf':
+            pos = 3
+        while True:
+            match = RE_PROLOG.match(data, pos)
+            if match is None:
+                return None, 0
+            if match.lastindex == 3:
+                return match.group(3), position
+            position += match.lastindex == 2
+            pos = match.end()
+
+def _tag_stream(fname, codes, pattern, output):
+    # the doctype is written in its place among the comments and processing
+    # instructions before the root element
+    doctype, doctype_position = _find_doctype(fname)
+    with atomic_open(output) as f:
+        with etree.xmlfile(f, encoding='utf-8') as xf:
+            xf.write_declaration()
+            tagger = _StreamTagger(xf, pattern, codes, 'foreign')
+            events = ('start', 'end', 'comment', 'pi')
+            prolog = 0
+            for event, el in etree.iterparse(fname, events=events, huge_tree=True):
+                if prolog is not None and (event == 'start' or prolog == doctype_position):
+                    docinfo = el.getroottree().docinfo
+                    if docinfo.doctype:
+                        tagger.flush()
+                        xf.write_doctype(doctype.decode(docinfo.encoding or 'utf-8') if doctype else docinfo.doctype)
+                    prolog = None
+                if event == 'start':
+                    if tagger.depth == 0:
+                        NS = f'{{{el.nsmap[None]}}}' if None in el.nsmap.keys() else ''
+                        tagger.tag = f'{NS}foreign'
+                    tagger.start(el)
+                elif event == 'end':
+                    tagger.end(el)
+                else:
+                    if prolog is not None:
+                        prolog += 1
+                    tagger.leaf(el)
+            tagger.flush()
+        for node in tagger.trailing:
+            f.write(b'\n' + etree.tostring(node, encoding='utf-8'))
+
+
+# Corpus level tagging
+
+MANIFEST_FNAME = '.tag_script_manifest.json'
+
+def _tag_file(fname, codes, stream):
+    if stream:
+        tag_script_stream(fname, codes)
+    else:
+        tag_script_from_file(fname, codes)
+
+def tag_corpus(corpus_dir, script, language_code = '', jobs = 1, stream = False, force = False):
+    """
+    Tag all XML files in corpus_dir (see tag_script for the script argument),
+    divided over jobs processes. A manifest in corpus_dir records the hash of
+    each tagged file and the language codes it was tagged with, so that files
+    that did not change since are skipped (unless force is given). Returns a
+    list of results (fname, status, seconds, error), where status is one of
+    'tagged', 'skipped' or 'failed'.
+    """
+    codes = language_codes(script, language_code)
+    fnames = [
+        path.join(subdir, file)
+        for subdir, _, files in os.walk(corpus_dir) for file in sorted(files) if file.endswith('.xml')
+    ]
+
+    def up_to_date(fname, entry):
+        return entry and entry['codes'] == codes and entry['hash'] == file_hash(fname)
+
+    return manifest.process_files(
+        manifest.Manifest(corpus_dir, MANIFEST_FNAME), fnames, _tag_file, (codes, stream), jobs, force,
+        up_to_date, lambda fname, _: {'hash': file_hash(fname), 'codes': codes}, done='tagged'
+    )
+
+def print_summary(results):
+    manifest.print_summary(results, ['tagged', 'skipped', 'failed'])
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Tag scripts in all TEI files of a corpus"
+    )
+    parser.add_argument("corpus_dir", help="Root directory of the corpus")
+    parser.add_argument(
+        "scripts",
+        nargs="*",
+        help=f"Scripts to tag ({', '.join(AVAILABLE_SCRIPTS)}), optionally with "
+             "a language code, e.g. Cyrl=ov-Cyrs (default: all scripts)",
+    )
+    parser.add_argument("--jobs", type=int, default=1, help="Number of processes")
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Use tag_script_stream, for very large files",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Also tag files that did not change since the last run",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print the time and peak memory per stage (parse, match, etc.) at the end",
+    )
+    return parser.parse_args()
+
+def main(args):
+    codes = dict(script.partition('=')[::2] for script in args.scripts) or None
+    with cli_profile(args.profile):
+        results = tag_corpus(args.corpus_dir, codes, jobs=args.jobs, stream=args.stream, force=args.force)
+        print_summary(results)
+    return int(any(status == 'failed' for _, status, _, _ in results))
+
+if __name__ == '__main__':
+    sys.exit(main(parse_args()))
@@ -0,0 +1,122 @@
+"""
+XML input and output shared by the TEI modules: parsers that are reused per
+thread, parsing straight from a file or a memory map, and atomic writes that
+serialize the tree straight to the file.
+"""
+import hashlib
+import mmap
+import os
+import shutil
+import threading
+import uuid
+from contextlib import contextmanager
+
+from lxml import etree
+
+# Without huge_tree, libxml2 refuses deeply nested documents and very long
+# text nodes, which large TEI files can have. Entities are handled as by the
+# default parser.
+PARSER_OPTIONS = {"huge_tree": True}
+
+_local = threading.local()
+
+
+def get_parser(**options):
+    """
+    An XMLParser with PARSER_OPTIONS updated with options, which is created once
+    per thread (a parser can be reused, but not by several threads at once)
+    """
+    options = {**PARSER_OPTIONS, **options}
+    key = tuple(sorted(options.items()))
+    parsers = getattr(_local, "parsers", None)
+    if parsers is None:
+        parsers = _local.parsers = {}
+    parser = parsers.get(key)
+    if parser is None:
+        parser = parsers[key] = etree.XMLParser(**options)
+    return parser
+
+
+def parse(source, **options):
+    """Parse a file (name, path or file object) into an ElementTree, see get_parser for options"""
+    if isinstance(source, os.PathLike):
+        source = os.fspath(source)
+    return etree.parse(source, get_parser(**options))
+
+
+def fromstring(data, base_url=None, **options):
+    """Parse bytes (or a memory map) into an element, see get_parser for options"""
+    return etree.fromstring(data, get_parser(**options), base_url=base_url)
+
+
+@contextmanager
+def mapped(fname):
+    """
+    The contents of file fname as a read-only memory map, which can be parsed
+    with fromstring or searched with (bytes) regular expressions without
+    reading the file into memory
+    """
+    with open(fname, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # empty files cannot be mapped
+            yield b""
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
+
+
+def _create_temp(fname):
+    """
+    Create a new temporary file next to fname, returns (fd, name). Unlike
+    mkstemp (0o600), it is created with the permissions open would give a new
+    file, i.e. 0o666 without the umask.
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+    while True:
+        tmp_fname = f"{fname}.{uuid.uuid4().hex[:12]}.tmp"
+        try:
+            return os.open(tmp_fname, flags, 0o666), tmp_fname
+        except FileExistsError:
+            continue
+
+
+@contextmanager
+def atomic_open(fname, mode="wb", **kwargs):
+    """
+    Open a temporary file next to fname for writing (see open for mode and
+    kwargs), which replaces fname when the with block ends, so that fname is
+    never left half-written. If the block raises, fname is left untouched.
+    """
+    fname = os.fspath(fname)
+    fd, tmp_fname = _create_temp(fname)
+    try:
+        with os.fdopen(fd, mode, **kwargs) as f:
+            yield f
+        if os.path.exists(fname):
+            shutil.copymode(fname, tmp_fname)
+        os.replace(tmp_fname, fname)
+    except BaseException:
+        os.remove(tmp_fname)
+        raise
+
+
+def write_tree(tree, fname, **options):
+    """
+    Serialize tree (an ElementTree or element) straight to fname, without
+    building the document as a string first, through atomic_open. options are
+    those of ElementTree.write, with encoding utf-8 by default.
+    """
+    if not isinstance(tree, etree._ElementTree):
+        tree = etree.ElementTree(tree)
+    options.setdefault("encoding", "utf-8")
+    with atomic_open(fname) as f:
+        tree.write(f, **options)
+
+
+def file_hash(fname):
+    """SHA-256 of the contents of file fname (hex), read in blocks"""
+    sha = hashlib.sha256()
+    with open(fname, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
@@ -1,51 +1,170 @@
 import unicodedata
-import json
 import string
 import os
-try:
-    from cltk.corpus.greek.beta_to_unicode import Replacer
-except ModuleNotFoundError:
-    CLTK_NOT_FOUND = 1
-else:
-    CLTK_NOT_FOUND = 0
+import re
+import mmap
+import codecs
+import pickle
+from collections import deque, Counter
+from functools import lru_cache
+from importlib.util import find_spec
+from itertools import permutations
+
+from . import __version__
 
 FILE_DIR = os.path.split(__file__)[0]
-UNI_BETA_DICT = {}
-for fname in ['UNI_BETA_LOWER', 'UNI_BETA_UPPER']:
-    with open(os.path.join(FILE_DIR, f'{fname}.json')) as f:
-        UNI_BETA_DICT.update(json.load(f))
+TABLE_FILES = [os.path.join(FILE_DIR, f'{fname}.json') for fname in ['UNI_BETA_LOWER', 'UNI_BETA_UPPER']]
+TABLES_CACHE = os.path.join(FILE_DIR, '__pycache__', 'uni_beta_tables.pickle')
+
+# Attributes that are only computed on first access, see __getattr__
+LAZY_ATTRIBUTES = ['UNI_BETA_DICT', 'UNI_BETA_TRANS', 'BETA_UNI_DICT', 'RE_BETA', 'CLTK_NOT_FOUND']
+
+def _beta_variants(beta):
+    """ All accepted spellings of a beta code sequence (diacritics in any order) """
+    if beta.startswith('*'):
+        diacritics, letter = beta[1:-1], beta[-1]
+        for perm in permutations(diacritics):
+            yield '*' + ''.join(perm) + letter
+            yield '*' + letter + ''.join(perm)
+    else:
+        letter, diacritics = beta[0], beta[1:]
+        for perm in permutations(diacritics):
+            yield letter + ''.join(perm)
+
+def _trie_pattern(words):
+    """ Regex pattern of a trie of words, matching the longest word at a position """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def pattern(node):
+        alternatives = [re.escape(char) + pattern(child) for char, child in node.items() if char]
+        if not alternatives:
+            return ''
+        alt_str = alternatives[0] if len(alternatives) == 1 else f'(?:{"|".join(alternatives)})'
+        if '' in node:
+            alt_str = f'(?:{alt_str})?' # Greedy, so longer matches are preferred
+        return alt_str
+
+    return pattern(trie)
+
+def _build_tables():
+    import json # Only needed when the cache is (re)built
+
+    uni_beta_dict = {}
+    for fname in TABLE_FILES:
+        with open(fname) as f:
+            uni_beta_dict.update(json.load(f))
+
+    # Inverse of UNI_BETA_DICT, with all diacritic order variants. Canonical
+    # spellings are inserted first, so they take precedence over variants.
+    beta_uni_dict = {beta: uni for uni, beta in uni_beta_dict.items()}
+    beta_uni_dict['S'] = '\u03c3' # medial sigma, final sigma is resolved by position
+    beta_uni_dict.update({'S1': '\u03c3', 'S2': '\u03c2', 'S3': '\u03f2', '*S3': '\u03f9'})
+    for beta, uni in list(beta_uni_dict.items()):
+        for variant in _beta_variants(beta):
+            beta_uni_dict.setdefault(variant, uni)
+
+    return {
+        'UNI_BETA_DICT': uni_beta_dict,
+        'UNI_BETA_TRANS': str.maketrans(uni_beta_dict),
+        'BETA_UNI_DICT': beta_uni_dict,
+        'RE_BETA_PATTERN': _trie_pattern(beta_uni_dict),
+    }
+
+def tables_key():
+    """ Identifies the current mapping tables, changes with the tables and the package version """
+    return (__version__, *((os.stat(fname).st_mtime_ns, os.stat(fname).st_size) for fname in TABLE_FILES))
+
+@lru_cache(maxsize=None)
+def _tables():
+    """ Mapping tables, loaded from a pickled cache that is (re)built from the JSON files if needed """
+    key = tables_key()
+    try:
+        with open(TABLES_CACHE, 'rb') as f:
+            cached_key, tables = pickle.load(f)
+        if cached_key == key:
+            return tables
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        pass
+
+    tables = _build_tables()
+    try:
+        os.makedirs(os.path.dirname(TABLES_CACHE), exist_ok=True)
+        tmp_fname = f'{TABLES_CACHE}.{os.getpid()}.tmp'
+        with open(tmp_fname, 'wb') as f:
+            pickle.dump((key, tables), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_fname, TABLES_CACHE)
+    except OSError:
+        pass # Read-only installation, tables are rebuilt on every run
+    return tables
 
-UNI_BETA_TRANS = str.maketrans(UNI_BETA_DICT)
+@lru_cache(maxsize=None)
+def _re_beta():
+    return re.compile(_tables()['RE_BETA_PATTERN'])
+
+def __getattr__(name):
+    if name == 'RE_BETA':
+        return _re_beta()
+    elif name == 'CLTK_NOT_FOUND':
+        return int(find_spec('cltk') is None)
+    elif name in LAZY_ATTRIBUTES:
+        return _tables()[name]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 # str.lower(), but only for latin alphabet
 LATIN_UPPER_TRANS = str.maketrans(string.ascii_lowercase, string.ascii_uppercase)
 LATIN_LOWER_TRANS = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
 
+def codepoint(char):
+    return 'U+{:04x}'.format(ord(char))
+
+@lru_cache(maxsize=None)
+def char_name(char):
+    try:
+        return unicodedata.name(char)
+    except ValueError:
+        return ''
+
 def decompose(string, save_as=''):
     decomp = []
     for char in string:
-        if len(hex(ord(char))[2:]) <= 4:
-            hex_str = 'U+{:>4}'.format(hex(ord(char))[2:]).replace(' ','0')
-        else:
-            hex_str = hex(ord(char)).replace('0x','U+')
-
-        try:
-            name = unicodedata.name(char)
-        except ValueError:
-            name = ''
-
-        decomp.append(' '.join([char, hex_str, name]))
+        decomp.append(' '.join([char, codepoint(char), char_name(char)]))
     if save_as:
         with open(save_as, 'w') as f:
             f.write('\n'.join(decomp))
     else:
         print('\n'.join(decomp))
 
+@lru_cache(maxsize=None)
+def _beta_repl():
+    beta_uni_dict = _tables()['BETA_UNI_DICT']
+
+    def repl(match):
+        uni = beta_uni_dict[match.group()]
+        if match.group() == 'S':
+            next_char = match.string[match.end():match.end() + 1]
+            if not (next_char.isalpha() or next_char == '*'):
+                uni = '\u03c2'
+        return uni
+
+    return repl
+
 def beta2uni(text_beta):
+    """ Convert beta code to unicode in a single pass over the text """
+    text_beta = text_beta.translate(LATIN_UPPER_TRANS)
+    return _re_beta().sub(_beta_repl(), text_beta)
+
+def beta2uni_cltk(text_beta):
     """ Wrapper of the cltk.corpus.greek.beta_to_unicode.Replacer function """
-    if CLTK_NOT_FOUND:
+    try:
+        from cltk.corpus.greek.beta_to_unicode import Replacer
+    except ModuleNotFoundError:
         print(
-            'CLTK is not found in this environment. In order to use the beta2uni converter,',
+            'CLTK is not found in this environment. In order to use the beta2uni_cltk converter,',
             'install this package with `pip install cltk` or `pip install dh-utils[betacode]`'
         )
         return None
@@ -57,6 +176,237 @@ def uni2beta(text_uni, normalize=True):
     """ Inverse of beta2uni """
     if normalize:
         text_uni = unicodedata.normalize('NFC', text_uni)
-    text_beta = text_uni.translate(UNI_BETA_TRANS)
+    text_beta = text_uni.translate(_tables()['UNI_BETA_TRANS'])
     text_beta = text_beta.translate(LATIN_LOWER_TRANS)
     return text_beta
+
+# Streaming API
+
+CHUNK_SIZE = 1 << 16
+
+def _split_uni(text):
+    """ Index at which text can be split without separating a base letter from its combining marks """
+    for i in range(len(text) - 1, 0, -1):
+        if not unicodedata.combining(text[i]):
+            return i
+    return 0
+
+def _split_beta(text):
+    """ Index at which text can be split without breaking up a beta code sequence """
+    for i in range(len(text) - 1, 0, -1):
+        if text[i] != '*' and not text[i].isalpha():
+            continue
+        # Skip diacritics to find out whether this is the letter of a capital
+        j = i - 1
+        while j >= 0 and text[j] in ')(/\\=+|\'&':
+            j -= 1
+        if j >= 0 and text[j] == '*' or text[i - 1] in 'Ss':
+            continue
+        return i
+    return 0
+
+def _iter_text(source, chunk_size=CHUNK_SIZE, use_mmap=False, encoding='utf-8'):
+    """ Yield text chunks from a path, file object or iterable of strings """
+    if isinstance(source, (str, os.PathLike)):
+        if use_mmap and os.path.getsize(source) > 0: # empty files cannot be mapped
+            with open(source, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                decoder = codecs.getincrementaldecoder(encoding)()
+                for offset in range(0, len(m), chunk_size):
+                    yield decoder.decode(m[offset:offset + chunk_size])
+                yield decoder.decode(b'', final=True)
+        else:
+            with open(source, encoding=encoding) as f:
+                yield from iter(lambda: f.read(chunk_size), '')
+    elif hasattr(source, 'read'):
+        yield from iter(lambda: source.read(chunk_size), '')
+    else:
+        yield from source
+
+def _iter_chunks(source, split, chunk_size=CHUNK_SIZE, **kwargs):
+    """
+    Regroup the text of source into chunks of about chunk_size characters that
+    end after whitespace, or else at an index given by split
+    """
+    buffer, buffered = [], 0
+    for text in _iter_text(source, chunk_size, **kwargs):
+        buffer.append(text)
+        buffered += len(text)
+        if buffered < chunk_size:
+            continue
+        text = ''.join(buffer)
+        i = max(text.rfind(char) for char in ' \n\t\r') + 1 or split(text)
+        if i:
+            yield text[:i]
+            text = text[i:]
+        buffer, buffered = [text], len(text)
+    text = ''.join(buffer)
+    if text:
+        yield text
+
+def _convert_stream(convert, split, source, sink, chunk_size=CHUNK_SIZE,
+                    use_mmap=False, processes=None, encoding='utf-8'):
+    if isinstance(sink, (str, os.PathLike)):
+        with open(sink, 'w', encoding=encoding) as f:
+            return _convert_stream(
+                convert, split, source, f, chunk_size, use_mmap, processes, encoding
+            )
+
+    chunks = _iter_chunks(source, split, chunk_size, use_mmap=use_mmap, encoding=encoding)
+    if not processes:
+        for chunk in chunks:
+            sink.write(convert(chunk))
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    # Keep a bounded number of chunks in flight, and write them in order
+    with ProcessPoolExecutor(processes) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(convert, chunk))
+            if len(pending) >= 2 * processes:
+                sink.write(pending.popleft().result())
+        while pending:
+            sink.write(pending.popleft().result())
+
+def uni2beta_stream(source, sink, normalize=True, **kwargs):
+    """
+    Convert unicode to beta code chunk by chunk, from a path, file object or
+    iterable of strings to a path or writable file object. Keyword arguments:
+    chunk_size, use_mmap (for paths), processes and encoding.
+    """
+    convert = uni2beta if normalize else _uni2beta_wo_normalize
+    _convert_stream(convert, _split_uni, source, sink, **kwargs)
+
+def beta2uni_stream(source, sink, **kwargs):
+    """ Streaming variant of beta2uni, see uni2beta_stream """
+    _convert_stream(beta2uni, _split_beta, source, sink, **kwargs)
+
+def _uni2beta_wo_normalize(text_uni):
+    return uni2beta(text_uni, normalize=False)
+
+# Character inventory
+
+INVENTORY_FIELDS = ['char', 'codepoint', 'name', 'category', 'script', 'frequency']
+
+@lru_cache(maxsize=256)
+def _re_combining_seq(marks):
+    """ Pattern matching a character followed by one or more of the given combining marks """
+    marks = re.escape(marks)
+    return re.compile(f'[^{marks}][{marks}]+')
+
+@lru_cache(maxsize=None)
+def char_script(char):
+    """
+    Approximate script of a character. Unicodedata does not provide scripts,
+    so it is derived from the character name for letters (e.g. GREEK SMALL
+    LETTER ALPHA), combining marks are 'Inherited' and all others 'Common'.
+    """
+    category = unicodedata.category(char)
+    if category in ('Mn', 'Me'):
+        return 'Inherited'
+    name = char_name(char)
+    if category[0] not in 'LM' or not name:
+        return 'Common'
+    return name.split()[0].split('-')[0].title()
+
+def _count_chars(counter, text):
+    text_counter = Counter(text)
+    counter.update(text_counter)
+    # Only look for the combining marks that actually occur in the text
+    marks = ''.join(sorted(
+        char for char in text_counter if unicodedata.category(char)[0] == 'M'
+    ))
+    if marks:
+        counter.update(_re_combining_seq(marks).findall(text))
+
+def _xml_inventory(fname):
+    """ Inventory of the text nodes and attribute values of an XML file """
+    from lxml import etree
+    counter = Counter()
+    for _, el in etree.iterparse(fname, huge_tree=True):
+        for value in el.attrib.values():
+            _count_chars(counter, value)
+        if el.text:
+            _count_chars(counter, el.text)
+        # the tails of comments and processing instructions are text as well
+        for child in el:
+            if child.tail:
+                _count_chars(counter, child.tail)
+        el.clear(keep_tail=True)
+    return counter
+
+def _file_inventory(fname, encoding='utf-8', markup=True):
+    if not markup and fname.endswith('.xml'):
+        return _xml_inventory(fname)
+    counter = Counter()
+    for chunk in _iter_chunks(fname, _split_uni, encoding=encoding):
+        _count_chars(counter, chunk)
+    return counter
+
+def _inventory_files(paths, suffixes=None):
+    for path in paths:
+        if os.path.isdir(path):
+            for subdir, _, files in os.walk(path):
+                for file in sorted(files):
+                    if not suffixes or file.endswith(tuple(suffixes)):
+                        yield os.path.join(subdir, file)
+        else:
+            yield path
+
+def inventory(paths, suffixes=None, processes=None, encoding='utf-8', markup=False):
+    """
+    Count all codepoints and combining sequences (a character followed by
+    combining marks) in files and directories. Files in directories can be
+    filtered by suffix (e.g. ['.xml']) and divided over several processes.
+    Of XML files only the text nodes and attribute values are counted (in
+    the encoding they declare), unless markup is True.
+    """
+    if isinstance(paths, (str, os.PathLike)):
+        paths = [paths]
+    fnames = [os.fspath(fname) for fname in _inventory_files(paths, suffixes)]
+
+    counter = Counter()
+    if not processes:
+        for fname in fnames:
+            counter.update(_file_inventory(fname, encoding, markup))
+        return counter
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(processes) as executor:
+        for file_counter in executor.map(
+            _file_inventory, fnames, [encoding] * len(fnames), [markup] * len(fnames)
+        ):
+            counter.update(file_counter)
+    return counter
+
+def inventory_table(counter):
+    """ Rows of an inventory, sorted by frequency and codepoint """
+    rows = []
+    for chars, frequency in sorted(counter.items(), key=lambda item: (-item[1], item[0])):
+        rows.append({
+            'char': chars,
+            'codepoint': ' '.join(codepoint(char) for char in chars),
+            'name': ' + '.join(char_name(char) for char in chars),
+            'category': unicodedata.category(chars[0]),
+            'script': char_script(chars[0]),
+            'frequency': frequency,
+        })
+    return rows
+
+def save_inventory(counter, fname, format=''):
+    """ Save an inventory as CSV or JSON, format is derived from fname if not given """
+    format = format or os.path.splitext(fname)[1][1:].lower()
+    rows = inventory_table(counter)
+    if format == 'json':
+        import json
+        with open(fname, 'w', encoding='utf-8') as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2)
+    elif format == 'csv':
+        import csv
+        with open(fname, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, INVENTORY_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+    else:
+        raise ValueError(f'Format "{format}" not supported, please use csv or json')
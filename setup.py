@@ -10,7 +10,7 @@ with open(path.join(here, 'README.md')) as f:
 setup(
     name='dh-utils',
     description='Python package containing various utilities relevant in the field of digital humanities.',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     install_requires=['regex', 'lxml', 'anytree', 'markdown', 'namedentities'],
     extras_require={
         'betacode': ['cltk']
@@ -20,7 +20,7 @@ setup(
     long_description_content_type='text/markdown',
     url="https://github.com/andredelft/dh-utils",
     include_package_data=True,
-    python_requires='>=3.6',
+    python_requires='>=3.7',
     author='André van Delft',
     author_email='andrevandelft@outlook.com',
     classifiers=[
@@ -0,0 +1,88 @@
+import pytest
+
+from dh_utils import cache as cache_module
+from dh_utils import unicode
+from dh_utils.cache import CacheStats, ResultCache
+from dh_utils.tei import md2tei, tag_script
+
+WORDS = ['λόγος', 'μῆνιν', 'ἄειδε', 'θεὰ']
+
+def test_hits():
+    cache = ResultCache()
+    assert [cache.uni2beta(word) for word in WORDS] == [unicode.uni2beta(word) for word in WORDS]
+    assert cache.uni2beta(WORDS[0]) == unicode.uni2beta(WORDS[0])
+    # the same call with the default given
+    cache.uni2beta(WORDS[1], normalize=True)
+    assert cache.md2tei('*a*') == md2tei('*a*')
+    assert cache.tag_script('a שלום', 'Hebr') == tag_script('a שלום', 'Hebr')
+    assert cache.stats == CacheStats(hits=2, misses=6)
+    assert cache.stats.hit_rate == 0.25
+
+def test_uncached():
+    cache = ResultCache()
+    # sets are not JSON serializable
+    for _ in range(2):
+        assert cache.tag_script('a שלום', {'Hebr'}) == tag_script('a שלום', {'Hebr'})
+    assert cache.stats == CacheStats(uncached=2)
+
+def test_exceptions_not_cached():
+    cache = ResultCache()
+    for _ in range(2):
+        with pytest.raises(Exception):
+            cache.md2tei('a <b>unclosed')
+    assert cache.stats == CacheStats()
+    assert not cache.memory
+
+def test_memory_eviction():
+    cache = ResultCache(maxsize=2)
+    for word in WORDS[:3]:
+        cache.beta2uni(unicode.uni2beta(word))
+    assert cache.stats.evictions == 1
+    # the least recently used entry was evicted
+    cache.beta2uni(unicode.uni2beta(WORDS[0]))
+    cache.beta2uni(unicode.uni2beta(WORDS[2]))
+    assert cache.stats == CacheStats(hits=1, misses=4, evictions=2)
+
+def test_disk(tmp_path):
+    fname = tmp_path / 'cache' / 'results.sqlite'
+    with ResultCache(path=fname) as cache:
+        for word in WORDS:
+            cache.uni2beta(word)
+        assert cache.stats == CacheStats(misses=4)
+    with ResultCache(maxsize=1, path=fname) as cache:
+        assert [cache.uni2beta(word) for word in WORDS] == [unicode.uni2beta(word) for word in WORDS]
+        cache.uni2beta(WORDS[-1])
+        assert cache.stats == CacheStats(hits=1, disk_hits=4, evictions=3)
+        cache.clear()
+        cache.uni2beta(WORDS[-1])
+        assert cache.stats.misses == 1
+
+def test_disk_eviction(tmp_path):
+    with ResultCache(path=tmp_path / 'results.sqlite', max_bytes=20) as cache:
+        for word in WORDS:
+            cache.uni2beta(word)
+        assert cache.stats.evictions > 0
+        assert cache.disk.size == cache.disk._total_size() <= 20
+        # the least recently used entries were evicted
+        keys = [key for key, in cache.disk.connection.execute('SELECT key FROM entries')]
+        assert cache.key('uni2beta', (WORDS[-1],), {}) in keys
+        assert cache.key('uni2beta', (WORDS[0],), {}) not in keys
+
+def test_version_change(tmp_path, monkeypatch):
+    fname = tmp_path / 'results.sqlite'
+    with ResultCache(path=fname) as cache:
+        cache.uni2beta(WORDS[0])
+        cache.tag_script('a שלום', 'Hebr')
+
+    # a new package version changes the keys of all functions
+    monkeypatch.setattr(cache_module, '__version__', '0.0.0-test')
+    with ResultCache(path=fname) as cache:
+        cache.tag_script('a שלום', 'Hebr')
+        assert cache.stats == CacheStats(misses=1)
+
+    # and the tables of uni2beta, which empties the database on opening
+    monkeypatch.setattr(unicode, '__version__', '0.0.0-test')
+    with ResultCache(path=fname) as cache:
+        assert cache.disk.size == 0
+        cache.uni2beta(WORDS[0])
+        assert cache.stats == CacheStats(misses=1)
@@ -0,0 +1,67 @@
+import shutil
+from pathlib import Path
+
+import pytest
+from lxml import etree
+
+from dh_utils.tei.crit_app import AppIndex, build_corpus, ref_key
+
+DATA = Path(__file__).parent / 'fixtures' / 'data'
+URN = 'urn:cts:latinLit:tg1.wk1.ed-lat1'
+
+@pytest.fixture
+def data_dir(tmp_path):
+    return shutil.copytree(DATA, tmp_path / 'data')
+
+@pytest.fixture
+def index(tmp_path, data_dir):
+    with AppIndex(tmp_path / 'app_index.sqlite') as index:
+        assert [status for _, status, _ in index.update(data_dir)] == ['indexed']
+        yield index
+
+def lemmata(apps):
+    return {ref: [etree.fromstring(xml).findtext('lem') for xml in xmls] for ref, xmls in apps.items()}
+
+def test_ref_key():
+    assert sorted(['1.10', '1.2', '10.1', '2.1', '1.a'], key=ref_key) == ['1.2', '1.10', '1.a', '2.1', '10.1']
+
+def test_apps_numeric_order(index):
+    apps = index.apps(f'{URN}:1')
+    # 1.2 before 1.10, and the apps of a passage in document order
+    assert list(apps) == ['1.1.1', '1.1.2', '1.2.1', '1.10.1']
+    assert lemmata(apps)['1.2.1'] == ['fato', 'fata', 'Italiam']
+
+def test_apps_prefix(index):
+    # 1.1 is a prefix of 1.10 as a string, but not as a reference
+    assert list(index.apps(f'{URN}:1.1')) == ['1.1.1', '1.1.2']
+    assert list(index.apps(URN, '1.10')) == ['1.10.1']
+    assert index.apps(f'{URN}:1.1.1')['1.1.1'] == [
+        f'<app loc="{URN}:1.1.1"><lem wit="#A">arma</lem><rdg wit="#C">armaque</rdg>'
+        '<note xml:lang="en">see <ref target="#1.1.1">1.1.1</ref></note></app>'
+    ]
+    assert index.apps(f'{URN}:3') == {}
+
+def test_apps_range(index):
+    assert list(index.apps(f'{URN}:1.2-2')) == ['1.2.1', '1.10.1', '2.1.1']
+    assert list(index.apps(f'{URN}:1.1.2-1.2.1')) == ['1.1.2', '1.2.1']
+
+def test_apps_type(index):
+    assert lemmata(index.apps(f'{URN}:1', app_type='superior')) == {
+        '1.1.2': ['Troiae'], '1.2.1': ['fato', 'fata'], '1.10.1': ['venit']
+    }
+    assert lemmata(index.apps(f'{URN}:1.2', app_type='inferior')) == {'1.2.1': ['Italiam']}
+
+def test_update(index, data_dir):
+    # the apparatus versions are not indexed
+    build_corpus(data_dir, {'superior': 'appcrit1', None: 'appcrit'})
+    assert [status for _, status, _ in index.update(data_dir)] == ['skipped']
+
+    edition = data_dir / 'tg1' / 'wk1' / 'tg1.wk1.ed-lat1.xml'
+    edition.write_text(edition.read_text(encoding='utf-8').replace('>venit<', '>venet<'), encoding='utf-8')
+    assert [status for _, status, _ in index.update(data_dir)] == ['indexed']
+    assert lemmata(index.apps(f'{URN}:1.10')) == {'1.10.1': ['venet']}
+    assert index.connection.execute('SELECT count(*) FROM apps').fetchone() == (7,)
+
+    edition.unlink()
+    assert [status for _, status, _ in index.update(data_dir)] == ['removed']
+    assert index.connection.execute('SELECT count(*) FROM app_types').fetchone() == (0,)
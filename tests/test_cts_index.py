@@ -0,0 +1,94 @@
+import pytest
+from lxml import etree
+
+from dh_utils.tei.cts_index import CTSIndex, element_offsets, xpath_literal
+
+URN = 'urn:cts:latinLit:stoa0023.stoa001.lat1'
+
+EDITION = '''<?xml version="1.0" encoding="UTF-8"?>
+<!-- a comment with <div> -->
+<TEI xmlns="http://www.tei-c.org/ns/1.0">
+  <teiHeader/>
+  <text><body><div type="edition" n="{urn}">
+    <div type="book" n="1">
+      <div type="chapter" n="1"><l n="1">arma virumque</l><l n="2">cano</l></div>
+      <div type="chapter" n="2"><l n="1">Troiae</l><lb/><l n="2">qui primus</l></div>
+    </div>
+    <div type="book" n="2">
+      <div type="chapter" n="1"><l n="1">ab oris</l></div>
+      <div type="chapter" n="2">{extra}</div>
+    </div>
+  </div></body></text>
+</TEI>'''
+
+def write(path, urn=URN, extra=''):
+    path.write_text(EDITION.format(urn=urn, extra=extra), encoding='utf-8')
+    return path
+
+@pytest.fixture
+def index(tmp_path):
+    (tmp_path / 'data').mkdir()
+    write(tmp_path / 'data' / 'edition.xml', extra='<l n="1">Italiam</l>')
+    with CTSIndex(tmp_path / 'index.sqlite') as index:
+        assert [status for _, status, _ in index.update(tmp_path / 'data')] == ['indexed']
+        yield index
+
+def test_resolve_single(index):
+    [passage] = index.resolve(f'{URN}:1.2.1')
+    assert (passage.edition, passage.ref, passage.depth, passage.sibling) == (URN, '1.2.1', 3, 1)
+    assert passage.read() == b'<l n="1">Troiae</l>'
+    assert index.read(URN, '1.2') == [
+        b'<div type="chapter" n="2"><l n="1">Troiae</l><lb/><l n="2">qui primus</l></div>'
+    ]
+
+def test_xpath(index):
+    [passage] = index.resolve(f'{URN}:2.1.1')
+    root = etree.parse(passage.path).getroot()
+    [el] = root.xpath(passage.xpath, namespaces={'tei': 'http://www.tei-c.org/ns/1.0'})
+    assert el.text == 'ab oris'
+
+def test_resolve_range(index):
+    # across chapters and books, at the same depth
+    assert [passage.ref for passage in index.resolve(f'{URN}:1.2.2-2.2.1')] == ['1.2.2', '2.1.1', '2.2.1']
+    assert index.read(f'{URN}:1.1-1.2')[0].startswith(b'<div type="chapter" n="1">')
+    with pytest.raises(ValueError):
+        index.resolve(f'{URN}:1-1.2')
+    with pytest.raises(KeyError):
+        index.resolve(f'{URN}:3.1')
+
+def test_update(index, tmp_path):
+    data = tmp_path / 'data'
+    assert [status for _, status, _ in index.update(data)] == ['skipped']
+    write(data / 'edition.xml', extra='<l n="1">Italiam</l><l n="2">fato</l>')
+    assert [status for _, status, _ in index.update(data)] == ['indexed']
+    assert index.read(f'{URN}:2.2.2') == [b'<l n="2">fato</l>']
+    (data / 'edition.xml').unlink()
+    assert [status for _, status, _ in index.update(data)] == ['removed']
+    # the passages are removed with the file
+    assert index.connection.execute('SELECT count(*) FROM passages').fetchone() == (0,)
+
+def test_duplicate_ref(index, tmp_path):
+    data = tmp_path / 'data'
+    # within a file
+    write(data / 'duplicate.xml', urn=f'{URN}-b', extra='<l n="1">Italiam</l><l n="1">fato</l>')
+    # and of a passage indexed from another file
+    write(data / 'copy.xml')
+    results = {fname.rsplit('/', 1)[-1]: (status, error) for fname, status, error in index.update(data)}
+    assert results['edition.xml'] == ('skipped', None)
+    assert results['duplicate.xml'][0] == results['copy.xml'][0] == 'failed'
+    assert 'Duplicate passage' in results['duplicate.xml'][1]
+    assert index.connection.execute('SELECT count(*) FROM files').fetchone() == (1,)
+    with pytest.raises(KeyError):
+        index.resolve(f'{URN}-b:1.1.1')
+    assert index.read(f'{URN}:2.2.1') == [b'<l n="1">Italiam</l>']
+
+def test_element_offsets():
+    data = b'<?pi x?><a><!-- <b> --><b x="/>"/><c>t</c></a>'
+    assert [data[start:end] for start, end in element_offsets(data)] == [
+        data[8:], b'<b x="/>"/>', b'<c>t</c>'
+    ]
+
+@pytest.mark.parametrize('value', ['1', "1'a", '1"a', '1\'a"b\''])
+def test_xpath_literal(value):
+    root = etree.fromstring('<a/>')
+    assert root.xpath(xpath_literal(value)) == value
@@ -0,0 +1,38 @@
+import json
+
+import pytest
+
+from dh_utils.tei.manifest import Manifest, process_files
+from dh_utils.tei.xml_io import file_hash
+
+def read_upper(fname):
+    with open(fname) as f:
+        text = f.read()
+    if not text:
+        raise ValueError('empty file')
+    return text.upper()
+
+def run(corpus_dir, jobs=1, force=False):
+    fnames = sorted(str(fname) for fname in corpus_dir.glob('*.txt'))
+    return process_files(
+        Manifest(corpus_dir, 'manifest.json'), fnames, read_upper, jobs=jobs, force=force,
+        up_to_date=lambda fname, entry: entry and entry['hash'] == file_hash(fname),
+        entry=lambda fname, result: {'hash': file_hash(fname), 'result': result},
+    )
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_process_files(tmp_path, jobs):
+    (tmp_path / 'a.txt').write_text('a')
+    (tmp_path / 'b.txt').write_text('b')
+    (tmp_path / 'empty.txt').write_text('')
+    results = run(tmp_path, jobs)
+    assert [(status, info) for _, status, _, info in results] == [
+        ('processed', 'A'), ('processed', 'B'), ('failed', 'ValueError: empty file')
+    ]
+    manifest = json.loads((tmp_path / 'manifest.json').read_text())
+    assert sorted(manifest) == ['a.txt', 'b.txt']
+    assert manifest['a.txt']['result'] == 'A'
+
+    (tmp_path / 'b.txt').write_text('bb')
+    assert [status for _, status, _, _ in run(tmp_path, jobs)] == ['skipped', 'processed', 'failed']
+    assert [status for _, status, _, _ in run(tmp_path, jobs, force=True)] == ['processed', 'processed', 'failed']
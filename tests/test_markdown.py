@@ -0,0 +1,73 @@
+from pathlib import Path
+
+import pytest
+from markdown import Markdown
+
+from dh_utils.tei import TEIPostprocessorError, md2tei, md2tei_many
+from dh_utils.tei.markdown import TEITreeprocessor, ToTEI
+
+FIXTURES = Path(__file__).parent / 'fixtures' / 'markdown'
+
+# fixture: (extensions, whether TEITreeprocessor falls back to TEIPostprocessor)
+CASES = {
+    'lists': ([], False),
+    'emphasis': ([], False),
+    'links': ([], False),
+    'tables': (['tables', 'attr_list'], False),
+    # the footnotes extension adds a postprocessor
+    'footnotes': (['footnotes'], True),
+    'raw_html': ([], True),
+    'entities': ([], True),
+}
+
+def read_fixture(name):
+    return (FIXTURES / f'{name}.md').read_text(encoding='utf-8')
+
+def convert(name, engine):
+    extensions, _ = CASES[name]
+    md = Markdown(extensions=extensions + [ToTEI(engine=engine)])
+    return md.convert(read_fixture(name)).encode('utf-8')
+
+@pytest.fixture
+def tree_outputs(monkeypatch):
+    """ The outputs of TEITreeprocessor, None where it left the document to TEIPostprocessor """
+    outputs = []
+    run = TEITreeprocessor.run
+
+    def spy(self, root):
+        run(self, root)
+        outputs.append(self.output)
+
+    monkeypatch.setattr(TEITreeprocessor, 'run', spy)
+    return outputs
+
+def test_fixtures_covered():
+    assert sorted(CASES) == sorted(path.stem for path in FIXTURES.glob('*.md'))
+
+@pytest.mark.parametrize('name', CASES)
+def test_postprocessor(name):
+    # expected/<fixture>.xml, the output of TEIPostprocessor
+    assert convert(name, 'postprocessor') == (FIXTURES / 'expected' / f'{name}.xml').read_bytes()
+
+@pytest.mark.parametrize('name', CASES)
+def test_engines_identical(name, tree_outputs):
+    assert convert(name, 'tree') == convert(name, 'postprocessor')
+    _, fallback = CASES[name]
+    assert (tree_outputs[0] is None) == fallback
+
+def test_md2tei_default_engine(tree_outputs):
+    assert md2tei(read_fixture('emphasis')) == (FIXTURES / 'expected' / 'emphasis.xml').read_text(encoding='utf-8')
+    assert tree_outputs[0] is not None
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_md2tei_many(workers):
+    texts = [read_fixture(name) for name in CASES if not CASES[name][0]] * 3
+    texts.insert(2, 'a <b>unclosed')
+    results = list(md2tei_many(texts, workers=workers, chunksize=2))
+    assert isinstance(results.pop(2), TEIPostprocessorError)
+    del texts[2]
+    assert results == [md2tei(text) for text in texts]
+
+def test_md2tei_many_raise():
+    with pytest.raises(TEIPostprocessorError):
+        list(md2tei_many(['a', 'a <b>unclosed', 'b'], return_exceptions=False))
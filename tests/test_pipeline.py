@@ -0,0 +1,58 @@
+import shutil
+from pathlib import Path
+
+import pytest
+
+from dh_utils.tei import crit_app, pipeline, refsdecl_generator
+from dh_utils.tei.tag_script import tag_corpus
+
+DATA = Path(__file__).parent / 'fixtures' / 'data'
+EDITION = Path('tg1', 'wk1', 'tg1.wk1.ed-lat1.xml')
+
+@pytest.fixture
+def data_dir(tmp_path):
+    return shutil.copytree(DATA, tmp_path / 'data')
+
+def test_tag_script_unchanged(data_dir):
+    stages = [pipeline.TagScript(['Hebr', 'Cyrl'])]
+    [result] = pipeline.run(str(data_dir), stages)
+    assert result.reports == {'tag_script': {'tagged': 2}}
+    edition = data_dir / EDITION
+    mtime, content = edition.stat().st_mtime_ns, edition.read_bytes()
+    # the scripts are tagged already, so the file is not written again
+    [result] = pipeline.run(str(data_dir), stages)
+    assert result.status == 'processed' and result.reports == {}
+    assert (edition.stat().st_mtime_ns, edition.read_bytes()) == (mtime, content)
+
+def tree_files(root):
+    return {
+        path.relative_to(root): path.read_bytes()
+        for path in sorted(root.rglob('*')) if path.is_file() and not path.name.endswith('_manifest.json')
+    }
+
+@pytest.mark.parametrize('names', [['refsdecl', 'tag_script', 'crit_app'], ['tag_script', 'crit_app']])
+def test_same_as_tools(tmp_path, names):
+    """ The pipeline writes the same files as running the tools one after the other """
+    scripts, outputs = {'Hebr': '', 'Cyrl': 'ov-Cyrs'}, {'superior': 'appcrit1', None: 'appcrit'}
+    tools_dir = shutil.copytree(DATA, tmp_path / 'tools')
+    for name in names:
+        if name == 'refsdecl':
+            results = list(refsdecl_generator.process_path(tools_dir, update=True))
+            assert [result.status for result in results] == ['updated']
+        elif name == 'tag_script':
+            assert [status for _, status, _, _ in tag_corpus(str(tools_dir), scripts)] == ['tagged']
+        else:
+            assert [status for _, status, _, _ in crit_app.build_corpus(str(tools_dir), outputs)] == ['built']
+
+    pipeline_dir = shutil.copytree(DATA, tmp_path / 'pipeline')
+    stages = {
+        'refsdecl': pipeline.RefsDecl(),
+        'tag_script': pipeline.TagScript(scripts),
+        'crit_app': pipeline.CritApp(outputs),
+    }
+    results = pipeline.run(str(pipeline_dir), [stages[name] for name in names])
+    assert [result.status for result in results] == ['processed']
+
+    expected = tree_files(tools_dir)
+    assert len(expected) == 3
+    assert tree_files(pipeline_dir) == expected
@@ -0,0 +1,40 @@
+import pytest
+from lxml import etree
+
+from dh_utils.tei.refsdecl_generator import process_file
+
+TEI = '''<TEI xmlns="http://www.tei-c.org/ns/1.0">
+  <teiHeader><encodingDesc/></teiHeader>
+  <text><body><div type="edition" n="urn:cts:greekLit:tlg0001.tlg001.ed">{}</div></body></text>
+</TEI>'''
+
+DIV = '<div type="book" n="{0}"><div type="chapter" subtype="chapter" n="1"><l n="1">a</l></div></div>'
+
+EDITIONS = {
+    'divs': DIV.format(1) + DIV.format(2),
+    # divs take precedence over l and ab/l textparts that come before them
+    'ab_before_div': '<ab><l n="1">a</l></ab>' + DIV.format(1),
+    'l_before_div': '<l n="1">a</l>' + DIV.format(1),
+    'lines': '<l n="1">a</l><ab><l n="2">b</l></ab>',
+    'ab_lines': '<ab><l n="1">a</l><l n="2">b</l></ab>',
+}
+
+def patterns(refs_decl):
+    return [pattern.get('replacementPattern') for pattern in etree.fromstring(refs_decl)]
+
+@pytest.mark.parametrize('name', EDITIONS)
+def test_stream_agrees(tmp_path, name):
+    fname = tmp_path / f'{name}.xml'
+    fname.write_text(TEI.format(EDITIONS[name]), encoding='utf-8')
+    expected = process_file(fname, update=False, compact=False)
+    assert expected.status == 'generated'
+    assert process_file(fname, update=False).refs_decl == expected.refs_decl
+    for verify in [False, True]:
+        assert process_file(fname, update=False, stream=True, verify=verify).refs_decl == expected.refs_decl
+
+def test_div_precedence(tmp_path):
+    fname = tmp_path / 'edition.xml'
+    fname.write_text(TEI.format(EDITIONS['ab_before_div']), encoding='utf-8')
+    assert patterns(process_file(fname, update=False, stream=True).refs_decl)[-1].endswith(
+        "/tei:div[@type][@n]/tei:div[@type][@n='$1'])"
+    )
@@ -0,0 +1,69 @@
+import io
+import json
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from dh_utils import serve
+from dh_utils.serve import Worker
+from dh_utils.tei import md2tei
+from dh_utils.unicode import uni2beta
+
+REQUESTS = [
+    {'id': 1, 'method': 'uni2beta', 'params': {'text_uni': 'λόγος'}},
+    {'id': 2, 'method': 'md2tei', 'params': ['*a*']},
+    {'id': 3, 'method': 'md2tei', 'params': ['a <b>unclosed']},
+    {'id': 4, 'method': 'unknown'},
+    {'id': 5, 'method': 'uni2beta', 'params': {'text': 'λόγος'}},
+    {'id': 6, 'method': 'ping'},
+]
+
+def check_responses(responses):
+    assert sorted(response['id'] for response in responses if response['id'] is not None) == [1, 2, 3, 4, 5, 6]
+    by_id = {response['id']: response for response in responses}
+    assert by_id[1] == {'id': 1, 'result': uni2beta('λόγος')}
+    assert by_id[2] == {'id': 2, 'result': md2tei('*a*')}
+    assert by_id[3]['error']['type'] == 'TEIPostprocessorError'
+    assert by_id[4] == {'id': 4, 'error': {'type': 'MethodNotFound', 'message': "Unknown method 'unknown'"}}
+    assert by_id[5]['error']['type'] == 'TypeError'
+    assert by_id[6] == {'id': 6, 'result': 'pong'}
+    assert by_id[None]['error']['type'] == 'InvalidRequest'
+
+@pytest.mark.parametrize('options', [[], ['--workers', '4'], ['--workers', '2', '--pool', 'process', '--cache']])
+def test_round_trip(options):
+    lines = [json.dumps(request) for request in REQUESTS] + ['not json', '']
+    output = subprocess.run(
+        [sys.executable, '-m', 'dh_utils.serve', *options], input='\n'.join(lines) + '\n',
+        capture_output=True, check=True, text=True, encoding='utf-8'
+    ).stdout
+    responses = [json.loads(line) for line in output.splitlines()]
+    assert len(responses) == len(REQUESTS) + 1
+    check_responses(responses)
+
+def test_out_of_order(monkeypatch):
+    released = threading.Event()
+    monkeypatch.setitem(serve.METHODS, 'wait', lambda: released.wait(10))
+    monkeypatch.setitem(serve.METHODS, 'release', released.set)
+    requests = [{'id': 'first', 'method': 'wait'}, {'id': 'second', 'method': 'release'}]
+    output = io.StringIO()
+    with Worker(workers=2) as worker:
+        worker.serve((json.dumps(request) for request in requests), output)
+    # the response of the first request is written once the second is done
+    assert [json.loads(line) for line in output.getvalue().splitlines()] == [
+        {'id': 'second', 'result': None}, {'id': 'first', 'result': True}
+    ]
+
+def test_cache_stats():
+    output = io.StringIO()
+    requests = [{'id': i, 'method': 'uni2beta', 'params': ['λόγος']} for i in range(3)]
+    requests.append({'id': 3, 'method': 'cache_stats'})
+    try:
+        with Worker(cache_options={'maxsize': 16}) as worker:
+            worker.serve((json.dumps(request) for request in requests), output)
+    finally:
+        serve._cache = None
+    stats = json.loads(output.getvalue().splitlines()[-1])['result']
+    # the warm up does not go through the cache
+    assert (stats['hits'], stats['misses']) == (2, 1)
@@ -0,0 +1,55 @@
+import re
+import shutil
+from pathlib import Path
+
+import pytest
+from lxml import etree
+
+from dh_utils.tei import tag_script_from_file, tag_script_stream
+
+FIXTURES = Path(__file__).parent / 'fixtures' / 'tag_script'
+
+# expected/<fixture>.<script>[.<language code>].xml, the output of the
+# implementation that reparsed every text node (before the tree walk)
+CASES = [
+    (expected.name.split('.')[0], *expected.name[:-len('.xml')].split('.', 2)[1:])
+    for expected in sorted((FIXTURES / 'expected').glob('*.xml'))
+]
+
+def expected_output(name, script, language_code=''):
+    suffix = f'.{language_code}' if language_code else ''
+    return (FIXTURES / 'expected' / f'{name}.{script}{suffix}.xml').read_bytes()
+
+@pytest.mark.parametrize('case', CASES, ids='.'.join)
+def test_tag_script_from_file(tmp_path, case):
+    name, *args = case
+    fname = shutil.copy(FIXTURES / f'{name}.xml', tmp_path)
+    tag_script_from_file(fname, *args)
+    assert Path(fname).read_bytes() == expected_output(*case)
+
+# the stream is written by xmlfile (with an XML declaration, and empty elements
+# as start and end tags), so only the canonical form is the same
+@pytest.mark.parametrize('case', CASES, ids='.'.join)
+def test_tag_script_stream(tmp_path, case):
+    name, *args = case
+    output = tmp_path / 'tagged.xml'
+    tag_script_stream(FIXTURES / f'{name}.xml', *args, output=output)
+    assert etree.canonicalize(from_file=str(output)) == etree.canonicalize(expected_output(*case).decode('utf-8'))
+
+def prolog(data):
+    """ The doctype, comments and processing instructions before the root element """
+    return re.findall(rb'<!DOCTYPE.*?\]>|<\?(?!xml ).*?\?>|<!--.*?-->', data[:data.index(b'<TEI')], re.S)
+
+@pytest.mark.parametrize('before_doctype', [False, True])
+def test_tag_script_stream_prolog(tmp_path, before_doctype):
+    data = (FIXTURES / 'doctype.xml').read_bytes()
+    if before_doctype:
+        comment = b'<!-- a comment after the doctype -->'
+        data = data.replace(comment, b'').replace(b'<!DOCTYPE', comment + b'\n<!DOCTYPE')
+    fname = tmp_path / 'doctype.xml'
+    fname.write_bytes(data)
+    output = tmp_path / 'tagged.xml'
+    tag_script_stream(fname, 'Hebr', output=output)
+    # the doctype keeps its place and its internal subset
+    assert prolog(output.read_bytes()) == prolog(data)
+    assert len(prolog(data)) == 3
@@ -0,0 +1,25 @@
+import subprocess
+import sys
+
+import pytest
+
+# Run in a fresh interpreter, in which the submodules are not imported yet
+@pytest.mark.parametrize('statement', [
+    'from dh_utils.tei import tag_script',
+    'import dh_utils.tei.tag_script; from dh_utils.tei import tag_script',
+    'from dh_utils.tei import pipeline; from dh_utils.tei import tag_script',
+    'from dh_utils.tei import *',
+])
+def test_tag_script_is_function(statement):
+    code = f'{statement}; import dh_utils.tei, types; assert isinstance(tag_script, types.FunctionType); ' \
+           'assert dh_utils.tei.tag_script is tag_script'
+    subprocess.run([sys.executable, '-c', code], check=True)
+
+def test_markdown_lazy():
+    code = 'import sys, dh_utils.tei; assert "dh_utils.tei.markdown" not in sys.modules; ' \
+           'from dh_utils.tei import md2tei; assert md2tei.__module__ == "dh_utils.tei.markdown"'
+    subprocess.run([sys.executable, '-c', code], check=True)
+
+def test_all():
+    import dh_utils.tei
+    assert all(hasattr(dh_utils.tei, name) for name in dh_utils.tei.__all__)
@@ -0,0 +1,95 @@
+import csv
+import json
+import unicodedata
+from collections import Counter
+
+import pytest
+
+from dh_utils import unicode
+from dh_utils.unicode import beta2uni, beta2uni_cltk, uni2beta
+
+ILIAD = 'μῆνιν ἄειδε θεὰ Πηληϊάδεω Ἀχιλῆος οὐλομένην, ἣ μυρί᾽ Ἀχαιοῖς ἄλγε᾽ ἔθηκε'
+ODYSSEY = 'ἄνδρα μοι ἔννεπε, μοῦσα, πολύτροπον, ὃς μάλα πολλὰ πλάγχθη'
+
+def nfc(text):
+    return unicodedata.normalize('NFC', text)
+
+@pytest.mark.parametrize('uni', list(unicode.UNI_BETA_DICT))
+def test_table_round_trip(uni):
+    # a sigma on its own is at the end of a word, so it becomes a final sigma
+    expected = 'ς' if uni == 'σ' else nfc(uni)
+    assert beta2uni(uni2beta(uni)) == expected
+
+@pytest.mark.parametrize('text', [ILIAD, ODYSSEY])
+def test_text_round_trip(text):
+    assert beta2uni(uni2beta(text)) == nfc(text)
+
+def test_diacritic_order():
+    assert beta2uni('a)/ndra') == beta2uni('a/)ndra') == 'ἄνδρα'
+    assert beta2uni('*)/andra') == beta2uni('*/)andra') == 'Ἄνδρα'
+
+def test_sigma():
+    assert beta2uni('lo/gos lo/gos, lo/gos') == 'λόγος λόγος, λόγος'
+    assert beta2uni('s1 s2 s3 *s3') == 'σ ς ϲ Ϲ'
+
+def test_case_insensitive():
+    assert beta2uni('LO/GOS') == beta2uni('lo/gos')
+
+# without elision marks, which cltk does not convert
+@pytest.mark.parametrize('text', ['μῆνιν ἄειδε θεὰ Πηληϊάδεω Ἀχιλῆος', 'ἄνδρα μοι ἔννεπε μοῦσα πολύτροπον'])
+def test_agrees_with_cltk(text):
+    pytest.importorskip('cltk')
+    beta = uni2beta(text)
+    assert nfc(beta2uni(beta)) == nfc(beta2uni_cltk(beta))
+
+@pytest.mark.parametrize('use_mmap', [False, True])
+def test_stream_files(tmp_path, use_mmap):
+    for text in ['', ILIAD * 1000]:
+        source, sink = tmp_path / 'uni.txt', tmp_path / 'beta.txt'
+        source.write_text(text, encoding='utf-8')
+        unicode.uni2beta_stream(source, sink, chunk_size=1000, use_mmap=use_mmap)
+        assert sink.read_text(encoding='utf-8') == uni2beta(text)
+
+# an alpha with a combining acute in an attribute value and the text
+ALPHA_ACUTE = 'α\u0301'
+XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE TEI [<!ENTITY logos "λόγος">]>
+<TEI xmlns="http://www.tei-c.org/ns/1.0"><p n="{0}">&logos; &amp; <!-- ω --><?pi ω?>{0}<hi>μ</hi></p></TEI>'''
+
+@pytest.fixture
+def corpus(tmp_path):
+    (tmp_path / 'corpus' / 'sub').mkdir(parents=True)
+    (tmp_path / 'corpus' / 'sub' / 'edition.xml').write_text(XML.format(ALPHA_ACUTE), encoding='utf-8')
+    (tmp_path / 'corpus' / 'notes.txt').write_text('<ω>', encoding='utf-8')
+    return tmp_path / 'corpus'
+
+def test_inventory_xml(corpus):
+    counter = unicode.inventory(corpus, suffixes=['.xml'])
+    assert counter == unicode.inventory(corpus, suffixes=['.xml'], processes=2)
+    # only the text nodes and attribute values, with the entities resolved
+    assert counter == Counter(ALPHA_ACUTE * 2 + 'λόγος & μ') + Counter([ALPHA_ACUTE] * 2)
+    markup = unicode.inventory(corpus, suffixes=['.xml'], markup=True)
+    assert markup['<'] > 0 and markup['ω'] == 2
+
+def test_inventory_files(corpus):
+    # other files are counted as they are
+    assert unicode.inventory([corpus / 'notes.txt']) == Counter('<ω>')
+    assert unicode.inventory(corpus) == unicode.inventory(corpus, suffixes=['.xml']) + Counter('<ω>')
+
+def test_save_inventory(corpus, tmp_path):
+    counter = unicode.inventory(corpus, suffixes=['.xml'])
+    unicode.save_inventory(counter, tmp_path / 'inventory.json')
+    rows = json.loads((tmp_path / 'inventory.json').read_text(encoding='utf-8'))
+    assert rows == unicode.inventory_table(counter)
+    # sorted by frequency and codepoint
+    assert [row['char'] for row in rows[:4]] == [' ', '\u0301', 'α', ALPHA_ACUTE]
+    assert {
+        'char': ALPHA_ACUTE, 'codepoint': 'U+03b1 U+0301', 'name': 'GREEK SMALL LETTER ALPHA + COMBINING ACUTE ACCENT',
+        'category': 'Ll', 'script': 'Greek', 'frequency': 2,
+    } in rows
+
+    unicode.save_inventory(counter, tmp_path / 'inventory.txt', format='csv')
+    with open(tmp_path / 'inventory.txt', encoding='utf-8', newline='') as f:
+        assert list(csv.DictReader(f)) == [{**row, 'frequency': str(row['frequency'])} for row in rows]
+    with pytest.raises(ValueError):
+        unicode.save_inventory(counter, tmp_path / 'inventory.txt')